@@ -1,62 +1,106 @@
 #!/usr/bin/env python3
-from collections import defaultdict, namedtuple
+from collections import defaultdict, deque, namedtuple
 from collections.abc import Callable
+from errno import ENOBUFS
+from stat import S_ISSOCK
+import argparse
+import array
+import bisect
+import csv
+import heapq
+import itertools
+import json
+import mmap
 import os
+import pwd
 import re
+import resource
 import signal
+import socket
+import struct
 import sys
 import subprocess
 import threading
 import time
+import zlib
 
-import gi
-gi.require_version("GLib", "2.0")
-gi.require_version("Gdk", "3.0")
-gi.require_version("Gtk", "3.0")
-from gi.repository import GLib  # noqa: E402
-from gi.repository import Gdk   # noqa: E402
-from gi.repository import Gtk   # noqa: E402
+# gtk is only needed for the ui, --headless doesn't even load it.  The
+# classes of the ui derive from it, so this runs before main() parses
+# the arguments, which don't allow abbreviations for this reason
+GLib = Gdk = Gtk = cairo = None
+if not any(arg in ("--headless", "--agent") or arg.startswith("--agent=") for arg in sys.argv[1:]):
+    try:
+        import cairo
+        import gi
+        gi.require_version("GLib", "2.0")
+        gi.require_version("Gdk", "3.0")
+        gi.require_version("Gtk", "3.0")
+        from gi.repository import GLib  # noqa: E402
+        from gi.repository import Gdk   # noqa: E402
+        from gi.repository import Gtk   # noqa: E402
+    except ImportError:
+        pass
 
 
 PAGE_SIZE = None
 GROUP_BY = os.getenv('GROUP_BY', default='pid')
+NET_BACKEND = os.getenv('NET_BACKEND', default='netlink')
+# a different root allows benchmarking against fake /proc trees
+PROC_ROOT = os.getenv('PROC_ROOT', default='/proc')
+CGROUP_ROOT = os.getenv('CGROUP_ROOT', default='/sys/fs/cgroup')
+SS_COMMAND = ["ss", "--tcp", "--info", "--processes", "--extended", "--no-header", "--oneline", "--numeric"]
+TOP_K = int(os.getenv('TOP_K', default='20'))
+# threads reading /proc and processes parsing it, for hosts with lots of processes
+SCAN_WORKERS = int(os.getenv('SCAN_WORKERS', default='1'))
+PARSE_PROCESSES = int(os.getenv('PARSE_PROCESSES', default='0'))
+# where the ui keeps its history across restarts, empty to keep none
+HISTORY_FILE = os.getenv('HISTORY_FILE', default=os.path.join(
+    os.getenv('XDG_STATE_HOME') or os.path.expanduser('~/.local/state'), 'healthy', 'history'))
+# memory is resident (rss), proportional (pss) or unique (uss) memory, the
+# latter two are read from smaps_rollup within MEMORY_BUDGET seconds per sample
+MEMORY_MODE = os.getenv('MEMORY_MODE', default='rss')
+MEMORY_BUDGET = float(os.getenv('MEMORY_BUDGET', default='0.02'))
+# processes above these usages are sampled every BURST_INTERVAL seconds
+# for BURST_SECONDS, 0 turns that off
+BURST_CPU = float(os.getenv('BURST_CPU', default='80'))
+BURST_IO = float(os.getenv('BURST_IO', default='0'))
+BURST_INTERVAL = float(os.getenv('BURST_INTERVAL', default='0.1'))
+BURST_SECONDS = float(os.getenv('BURST_SECONDS', default='5'))
+# (seconds per bucket, buckets) of each resolution in the history file
+HISTORY_TIERS = ((1, 60), (10, 360), (60, 1440))
+# what an agent is called in the ranking of an aggregator
+AGENT_NAME = os.getenv('AGENT_NAME', default=socket.gethostname())
 
 
 class PIDStat():
-    def __init__(self, stat_line, statm_line, net_bytes, io_bytes):
-        name_start, name_end = stat_line.index('('), stat_line.index(')')
-        name = stat_line[name_start+1:name_end]
-        stat_line = stat_line[:name_start] + stat_line[name_end+2:]
-        fields = stat_line.split()
-        fields.insert(1, name)
-
-        self.pid = int(fields[0])
-        self.tcomm = fields[1]
-        self.ppid = int(fields[5])
-        self.utime = int(fields[13])
-        self.stime = int(fields[14])
-
-        # self.vsize = int(self.fields[21])
-        # self.rss = int(self.fields[22])
-
-        statm_fields = statm_line.split(" ")
-        self.size = int(statm_fields[0])
-        self.resident = int(statm_fields[1])
-
-        self.receive_bytes = net_bytes[0]
-        self.transmit_bytes = net_bytes[1]
-        self.net_bytes = net_bytes[0] + net_bytes[1]
-
-        self.read_bytes = io_bytes[0]
-        self.write_bytes = io_bytes[1]
-        self.io_bytes = io_bytes[0] + io_bytes[1]
+    """ One row of a ProcTable, only created for processes that are shown. """
+
+    __slots__ = ("pid", "tcomm", "ppid", "utime", "stime", "starttime", "size", "resident",
+                 "io_bytes", "key", "cmdline", "user", "cgroup",
+                 "cpu_usage", "mem_usage", "net_usage", "io_usage")
+
+    def __init__(self, table, row, key=None):
+        self.pid = table.pid[row]
+        self.tcomm = table.tcomm[row]
+        self.ppid = table.ppid[row]
+        self.utime = table.utime[row]
+        self.stime = table.stime[row]
+        # together with the pid this identifies a process, pids are reused
+        self.starttime = table.starttime[row]
+        self.size = table.size[row]
+        self.resident = table.resident[row]
+        self.io_bytes = table.io_bytes[row]
+
+        # what History knows this row by, the group when grouping
+        self.key = (self.pid, self.tcomm) if key is None else key
 
+        # only filled in for processes that are shown, see ProcessInfoCache
         self.cmdline = None
-        try:
-            with open("/proc/"+fields[0]+"/cmdline", encoding="UTF-8") as f:
-                self.cmdline = f.readline().strip().replace("\x00", " ")
-        except Exception as ex:
-            print("Ignoring", ex)
+        self.user = None
+        self.cgroup = None
+        if table.cgroup is not None:
+            self.cmdline = self.cgroup = table.cgroup[row]
+            self.user = table.user[row]
 
         self.cpu_usage = 0.0
         self.mem_usage = 0.0
@@ -67,23 +111,13 @@ class PIDStat():
         return f'PIDStat({self.pid}, "{self.tcomm}")'
 
     def __hash__(self):
-        if GROUP_BY == 'ppid':
-            return hash((self.ppid))
-        elif GROUP_BY == 'name':
-            return hash((self.tcomm))
-        else:
-            return hash((self.pid, self.tcomm))
+        return hash(self.key)
 
     def __eq__(self, other):
-        if GROUP_BY == 'ppid':
-            return self.ppid == other.ppid
-        if GROUP_BY == 'name':
-            return self.tcomm == other.tcomm
-        else:
-            return (self.pid, self.tcomm) == (other.pid, other.tcomm)
+        return isinstance(other, PIDStat) and self.key == other.key
 
 
-class Graph(Gtk.Box):
+class Graph(Gtk.Box if Gtk else object):
     def __init__(self, num_samples, name, usage):
         Gtk.Box.__init__(self)
 
@@ -91,8 +125,20 @@ class Graph(Gtk.Box):
         self.name = name
         self.pid = -1
         self.cmdline = None
-        self.usage = usage
+        self.user = None
+        self.cgroup = None
         self.alive = True
+        # matches the filter, shown regardless of its rank
+        self.pinned = False
+        self.update_usage(usage)
+        self.burst = None
+        # threads can't be stopped or drilled into on their own
+        self.actions = True
+
+        # what was drawn last, as (usage, scale, width, height)
+        self.drawn = None
+        self.surface = None
+        self.back_surface = None
 
         self.label = Gtk.Label()
         self.label.set_width_chars(20)
@@ -118,9 +164,27 @@ class Graph(Gtk.Box):
         self.pack_end(self.drawing_area, False, True, 5)
 
     def button_press(self, widget, event):
-        if event.triggers_context_menu():
+        if not self.actions:
+            return True
+
+        if event.triggers_context_menu() and self.cgroup:
+            self.menu = Gtk.Menu()
+
+            menu_show = Gtk.MenuItem(label=f"Show processes of '{self.name}'")
+            menu_show.connect('activate', lambda item: CgroupProcesses(self.cgroup, self.name).show_all())
+            self.menu.append(menu_show)
+            menu_show.show()
+
+            self.menu.popup_at_pointer(event)
+        elif event.triggers_context_menu() and self.pid > 0:
             self.menu = Gtk.Menu()
 
+            menu_threads = Gtk.MenuItem(label=f"Show threads of '{self.name}' ({self.pid})")
+            menu_threads.connect('activate', lambda item, pid, name: ProcessThreads(pid, name).show_all(),
+                                 self.pid, self.name)
+            self.menu.append(menu_threads)
+            menu_threads.show()
+
             menu_stop = Gtk.MenuItem(label=f"Stop '{self.name}' ({self.pid})")
             menu_stop.connect('activate', self.kill, self.pid, self.cmdline or self.name)
             self.menu.append(menu_stop)
@@ -158,23 +222,38 @@ class Graph(Gtk.Box):
     def update_labels(self):
         label_text = self.name[:20]
         alive_text = ""
+        markup = self.pinned or not self.alive
+        if markup:
+            label_text = GLib.markup_escape_text(label_text)
+        if self.pinned:
+            label_text = f"<b>{label_text}</b>"
         if not self.alive:
             # grey out dead processes
             label_text = f"<span color=\"#aaaaaa\">{label_text}</span>"
-            self.label.set_use_markup(True)
 
             alive_text = " (killed)"
+        self.label.set_use_markup(markup)
         self.label.set_label(label_text)
 
-        if self.cmdline:
-            self.label.set_tooltip_text(f"{self.pid}{alive_text} - {self.cmdline}")
+        user_text = f" ({self.user})" if self.user else ""
+        if self.cgroup:
+            self.label.set_tooltip_text(f"{self.cgroup}{user_text}{alive_text}")
+        elif self.cmdline:
+            self.label.set_tooltip_text(f"{self.pid}{user_text}{alive_text} - {self.cmdline}")
         else:
-            self.label.set_tooltip_text(f"{self.pid}{alive_text}")
+            self.label.set_tooltip_text(f"{self.pid}{user_text}{alive_text}")
 
         self.usage_label.set_text(f"{int(self.usage[-1])}")
 
-    def update_usage(self, usage):
+    def update_usage(self, usage, burst=None):
+        """ burst are (index, usage) of samples taken in between, index is fractional. """
         self.usage = usage
+        self.burst = burst
+        self.max = max(usage)
+        if burst:
+            # spikes are what bursts are for, they shouldn't be cut off
+            self.max = max(self.max, max(usage for _, usage in burst))
+        self.total = sum(usage)
 
     def scale(self):
         """ Returns the value to scale with, 0 to 100 by default. """
@@ -188,17 +267,165 @@ class Graph(Gtk.Box):
         # background (theme-dependent)
         Gtk.render_background(style_context, cairo_context, 0, 0, width, height)
 
+        self.render_usage(cairo_context.get_target(), width, height)
+        cairo_context.set_source_surface(self.surface, 0, 0)
+        cairo_context.paint()
+
+        return False
+
+    def render_usage(self, target, width, height):
+        """ Draws the usage line to self.surface, unless it is already there.
+
+        When the usage only moved on by a few samples, the previous image
+        is scrolled to the left and only the new samples are drawn.
+        """
         scale = self.scale()
+        if self.drawn == (self.usage, self.burst, scale, width, height):
+            return
+
+        step = width / len(self.usage)
+        shift = None
+        if self.drawn and self.drawn[1] is None and self.burst is None and \
+                self.drawn[2:] == (scale, width, height) and step.is_integer():
+            shift = scroll_shift(self.drawn[0], self.usage)
+
+        if shift is None:
+            self.surface = target.create_similar(cairo.CONTENT_COLOR_ALPHA, width, height)
+            context = cairo.Context(self.surface)
+            start = 0
+        else:
+            if self.back_surface is None or self.back_surface.get_width() != self.surface.get_width():
+                self.back_surface = target.create_similar(cairo.CONTENT_COLOR_ALPHA, width, height)
+            context = cairo.Context(self.back_surface)
+            context.set_operator(cairo.OPERATOR_SOURCE)
+            context.set_source_surface(self.surface, -shift*step, 0)
+            context.paint()
+            context.set_operator(cairo.OPERATOR_OVER)
+            self.surface, self.back_surface = self.back_surface, self.surface
+            start = len(self.usage) - 1 - shift
 
         # squiggly lines!
-        cairo_context.set_source_rgb(0.3, 0.3, 0.7)
-        for idx, usage in enumerate(self.usage):
-            cairo_context.line_to(idx*(width/self.num_samples), height - usage*(height/scale))
-        cairo_context.stroke()
+        context.set_source_rgb(0.3, 0.3, 0.7)
+        for idx in range(max(start, 0), len(self.usage)):
+            context.line_to(idx*step, height - self.usage[idx]*(height/scale))
+        context.stroke()
+
+        if self.burst:
+            # thinner, and interrupted where no burst was sampled
+            context.set_source_rgb(0.9, 0.5, 0.1)
+            context.set_line_width(1)
+            previous = None
+            for idx, usage in self.burst:
+                if previous is None or idx - previous > 0.5:
+                    context.move_to(idx*step, height - usage*(height/scale))
+                else:
+                    context.line_to(idx*step, height - usage*(height/scale))
+                previous = idx
+            context.stroke()
+
+        self.drawn = (self.usage, self.burst, scale, width, height)
+
+
+def scroll_shift(before, after, max_shift=5):
+    """ Returns by how many samples after continues before, or None. """
+    if len(before) != len(after):
+        return None
+    for shift in range(1, min(max_shift, len(after) - 1) + 1):
+        if before[shift:] == after[:-shift]:
+            return shift
+    return None
+
+
+class CgroupProcesses(Gtk.Window if Gtk else object):
+    """ Lists the processes of a cgroup, only read while the window is open. """
+
+    def __init__(self, path, name, refresh_seconds=1.0):
+        Gtk.Window.__init__(self, title=f"{name} - processes")
+        self.set_default_size(450, 300)
 
+        self.path = path
+        self.store = Gtk.ListStore(int, str, str, str)
+        view = Gtk.TreeView(model=self.store)
+        for i, title in enumerate(["PID", "Name", "CPU", "Memory"]):
+            view.append_column(Gtk.TreeViewColumn(title, Gtk.CellRendererText(), text=i))
+        scrolled = Gtk.ScrolledWindow()
+        scrolled.add(view)
+        self.add(scrolled)
+
+        self.before = {}
+        self.before_time = time.monotonic()
+        self.refresh()
+        timeout = GLib.timeout_add(int(refresh_seconds * 1000), self.refresh)
+        self.connect("destroy", lambda window: GLib.source_remove(timeout))
+
+    def refresh(self):
+        now = time.monotonic()
+        ticks = os.sysconf("SC_CLK_TCK") * (now - self.before_time)
+        stats = {}
+        for pid in cgroup_pids(self.path):
+            stat = read_stat(pid)
+            if stat:
+                stats[pid] = stat
+
+        self.store.clear()
+        for pid, stat in sorted(stats.items(), key=lambda item: int(item[0])):
+            cpu = ""
+            if pid in self.before:
+                before = self.before[pid]
+                cpu_time = (stat.utime + stat.stime) - (before.utime + before.stime)
+                cpu = f"{int(cpu_time / ticks * 100)}%"
+            self.store.append([stat.pid, stat.tcomm, cpu, format_bytes(stat.resident * PAGE_SIZE)])
+
+        self.before = stats
+        self.before_time = now
+        return True
+
+
+class ProcessThreads(Gtk.Window if Gtk else object):
+    """ The cpu and io usage of the threads of one process, only sampled while the window is open. """
+
+    def __init__(self, pid, name, sample_seconds=1.0):
+        Gtk.Window.__init__(self, title=f"{name} ({pid}) - threads")
+        self.set_default_size(450, 400)
+
+        self.sample = None
+        cpu_graphs = GraphCollection(sample_seconds, "cpu", new_graph=CPUGraph, actions=False)
+        io_graphs = GraphCollection(sample_seconds, "io", new_graph=BytesGraph, actions=False)
+        self.visible_graphs = cpu_graphs
+
+        notebook = Gtk.Notebook()
+        notebook.connect("key-press-event", on_key_press)
+        notebook.connect("switch-page", self.on_switch_page)
+        notebook.append_page(cpu_graphs, Gtk.Label(label='CPU'))
+        notebook.append_page(io_graphs, Gtk.Label(label='IO'))
+        self.add(notebook)
+
+        self.collector = PIDStatsCollector(sample_seconds, consumers=[self.on_sample], pid=pid)
+        self.collector.start()
+        self.connect("destroy", lambda window: self.collector.stop())
+
+    def on_sample(self, sample):
+        self.sample = sample
+        GLib.idle_add(self.show_sample)
+
+    def on_switch_page(self, notebook, page, page_num):
+        self.visible_graphs = page
+        self.show_sample()
+
+    def show_sample(self):
+        if self.sample is not None and self.get_mapped():
+            self.visible_graphs.show_sample(self.sample)
         return False
 
 
+def format_bytes(n):
+    if n > 1024*1024:
+        return f"{int(n / (1024*1024))}mb"
+    elif n > 1024:
+        return f"{int(n / 1024)}kb"
+    return f"{int(n)}b"
+
+
 class CPUGraph(Graph):
     def __init__(self, num_samples, name, usage: list[float]):
         super().__init__(num_samples, name, usage)
@@ -206,7 +433,7 @@ class CPUGraph(Graph):
         self.max_cpu = os.cpu_count() * 100
 
     def scale(self):
-        if max(self.usage) > 100:
+        if self.max > 100:
             return self.max_cpu
         else:
             return 100
@@ -216,15 +443,13 @@ class CPUGraph(Graph):
 
         self.usage_label.set_text(f"{int(self.usage[-1])}%")
 
-        self.drawing_area.set_tooltip_text(f"avg: {int(sum(self.usage) / len(self.usage))}%, max: {int(max(self.usage))}%")
+        self.drawing_area.set_tooltip_text(f"avg: {int(self.total / len(self.usage))}%, max: {int(self.max)}%")
 
 
 class BytesGraph(Graph):
     def __init__(self, num_samples, name, usage: list[float]):
         super().__init__(num_samples, name, usage)
 
-        self.update_usage(usage)
-
         # 5 characters, max is "999kb"
         self.usage_label.set_width_chars(5)
 
@@ -237,15 +462,13 @@ class BytesGraph(Graph):
         current_bytes = int(self.usage[-1] * self.factor)
         self.usage_label.set_text(f"{current_bytes}{self.unit}")
 
-        avg_bytes = int((sum(self.usage) / len(self.usage)) * self.factor)
+        avg_bytes = int((self.total / len(self.usage)) * self.factor)
         max_bytes = int(self.max * self.factor)
-        total_bytes = int(sum(self.usage) * self.factor)
+        total_bytes = int(self.total * self.factor)
         self.drawing_area.set_tooltip_text(f"avg: {avg_bytes}{self.unit}, max: {max_bytes}{self.unit}, total: {total_bytes}{self.unit}")
 
-    def update_usage(self, usage):
-        super().update_usage(usage)
-
-        self.max = max(self.usage)
+    def update_usage(self, usage, burst=None):
+        super().update_usage(usage, burst)
 
         if self.max > 1024*1024:
             self.unit = "mb"
@@ -258,306 +481,3674 @@ class BytesGraph(Graph):
             self.factor = 1
 
 
-class GraphCollection(Gtk.Box):
-    def __init__(self, sample_seconds, new_graph: Callable[[int, str, list[float]], Graph]):
+class GraphCollection(Gtk.Box if Gtk else object):
+    def __init__(self, sample_seconds, metric, new_graph: Callable[[int, str, list[float]], Graph], actions=True):
         Gtk.Box.__init__(self, orientation="vertical")
 
+        # the field of Sample that is shown, and what was shown last
+        self.metric = metric
+        self.shown = None
         self.sample_seconds = sample_seconds
         self.num_samples = int(60 / self.sample_seconds)
 
         self.graphs = []
-        for _ in range(20):
+        for _ in range(TOP_K):
             graph = new_graph(self.num_samples, "", [0]*self.num_samples)
+            graph.actions = actions
             self.pack_start(graph, True, True, 5)
             self.graphs.append(graph)
 
-    def update_graphs(self, usages: list[tuple[PIDStat, list[float]]], alive_pids: dict[int, bool]):
+    def show_sample(self, sample, history_file=None, tier=None):
+        """ Shows sample, or tier of history_file if given, unless it is already shown. """
+        if tier is None:
+            if self.shown != sample.time:
+                self.shown = sample.time
+                bursts = sample.bursts.get(self.metric) if sample.bursts else None
+                usages = getattr(sample, self.metric)
+                pinned = sample.pinned[self.metric] if sample.pinned else []
+                if pinned:
+                    # matches of the filter go first, in place of the lowest ranked
+                    keys = {stat.key for stat, _ in pinned}
+                    usages = (pinned + [usage for usage in usages if usage[0].key not in keys])[:TOP_K]
+                self.update_graphs(usages, sample.alive_pids, bursts, sample.time, pinned=len(pinned))
+        elif self.shown != (tier, history_file.written[tier]):
+            self.shown = (tier, history_file.written[tier])
+            self.update_graphs(history_file.top(tier, self.metric, TOP_K), sample.alive_pids)
+
+    def update_graphs(self, usages: list[tuple[PIDStat, list[float]]], alive_pids: dict[int, bool],
+                      bursts=None, now=None, pinned=0):
+        """ bursts are the (time, usage) samples in between by key, now the time of the last sample.
+
+        The first pinned usages match the filter.
+        """
         for i, usage in enumerate(usages):
-            self.graphs[i].name = usage[0].tcomm
-            self.graphs[i].pid = usage[0].pid
-            self.graphs[i].alive = alive_pids[usage[0].pid]
-            self.graphs[i].cmdline = usage[0].cmdline
+            graph = self.graphs[i]
+            alive = alive_pids[usage[0].pid]
+            burst = None
+            if bursts and usage[0].key in bursts:
+                last = len(usage[1]) - 1
+                burst = [(last + (t - now) / self.sample_seconds, value)
+                         for t, value in bursts[usage[0].key] if last + (t - now) / self.sample_seconds >= 0]
+            # rows that didn't change aren't touched, so gtk doesn't redraw them
+            if (graph.pid, graph.name, graph.alive, graph.pinned, graph.usage, graph.burst) == \
+                    (usage[0].pid, usage[0].tcomm, alive, i < pinned, usage[1], burst):
+                continue
+
+            graph.name = usage[0].tcomm
+            graph.pid = usage[0].pid
+            graph.alive = alive
+            graph.pinned = i < pinned
+            graph.cmdline = usage[0].cmdline
+            graph.user = usage[0].user
+            graph.cgroup = usage[0].cgroup
+
+            graph.update_usage(usage[1], burst)
+
+            graph.update_labels()
+            graph.drawing_area.queue_draw()
+
+        # nothing had any usage in the last window, e.g. network when offline
+        for graph in self.graphs[len(usages):]:
+            if graph.name:
+                graph.name = ""
+                graph.pid = -1
+                graph.pinned = False
+                graph.cmdline = None
+                graph.user = None
+                graph.cgroup = None
+                graph.update_usage([0]*self.num_samples)
+                graph.update_labels()
+                graph.drawing_area.queue_draw()
+
+
+class History():
+    """ The last num_samples values per key, in one array.
+
+    Each key owns a row that is used as a ring buffer indexed by the current
+    tick, together with the running sum of its window.  Keys that aren't
+    appended to in a tick implicitly get a zero.  Only non-zero values are
+    written, and the values written num_samples ticks ago are expired when
+    the next tick starts, so a tick costs O(values appended).  A key whose
+    last value expired has an all-zero window and is evicted, its row is
+    reused.  Rows are only added when all others are taken, up to
+    max_keys regardless of how many processes come and go.
+    """
+
+    def __init__(self, num_samples, max_keys):
+        self.num_samples = num_samples
+        self.max_keys = max_keys
+        self.tick = 0
+
+        self.values = array.array('d')
+        self.sums = array.array('d')
+        # last tick that was written to each row
+        self.written = array.array('q')
+        # rows written per tick, indexed like the columns of a row
+        self.rows_by_tick = [[] for _ in range(num_samples)]
+
+        self.rows = {}
+        self.free_rows = []
+        # key -> latest label appended for it, e.g. a PIDStat with fresh usages
+        self.labels = {}
+        self.keys = []
 
-            self.graphs[i].update_usage(usage[1])
+    def __len__(self):
+        return len(self.rows)
 
-            self.graphs[i].update_labels()
+    def __contains__(self, key):
+        return key in self.rows
 
-        GLib.idle_add(self.queue_draw)
+    def advance(self):
+        """ Starts the next tick, expiring the values that fall out of the window. """
+        self.tick += 1
+        expired = self.tick - self.num_samples
+        column = self.tick % self.num_samples
+        rows = self.rows_by_tick[column]
+        for row in rows:
+            self.sums[row] -= self.values[row * self.num_samples + column]
+            self.values[row * self.num_samples + column] = 0
+            if self.written[row] == expired:
+                self.evict(self.keys[row])
+        rows.clear()
+
+    def append(self, key, value, label=None):
+        row = self.rows.get(key)
+        if row is not None:
+            self.labels[key] = key if label is None else label
+        if not value:
+            return
+        if row is None:
+            row = self.allocate(key)
+            self.labels[key] = key if label is None else label
+
+        column = self.tick % self.num_samples
+        index = row * self.num_samples + column
+        self.sums[row] += value - self.values[index]
+        self.values[index] = value
+        if self.written[row] != self.tick:
+            self.written[row] = self.tick
+            self.rows_by_tick[column].append(row)
+
+    def allocate(self, key):
+        if not self.free_rows and len(self.keys) < self.max_keys:
+            self.free_rows.append(len(self.keys))
+            self.values.frombytes(bytes(8 * self.num_samples))
+            self.sums.append(0)
+            self.written.append(-1)
+            self.keys.append(None)
+        elif not self.free_rows:
+            # only happens when appending more than max_keys / num_samples keys per tick
+            row = self.rows[min(self.rows, key=self.sum)]
+            for rows in self.rows_by_tick:
+                if row in rows:
+                    rows.remove(row)
+            self.evict(self.keys[row])
+
+        row = self.free_rows.pop()
+        start = row * self.num_samples
+        self.values[start:start + self.num_samples] = array.array('d', bytes(8 * self.num_samples))
+        self.sums[row] = 0
+        self.written[row] = -1
+        self.rows[key] = row
+        self.keys[row] = key
+        return row
+
+    def evict(self, key):
+        row = self.rows.pop(key)
+        self.keys[row] = None
+        self.free_rows.append(row)
+        del self.labels[key]
+
+    def sum(self, key):
+        return self.sums[self.rows[key]]
+
+    def window(self, key):
+        """ Returns the values of key, oldest first. """
+        start = self.rows[key] * self.num_samples
+        oldest = start + (self.tick + 1) % self.num_samples
+        end = start + self.num_samples
+        return self.values[oldest:end].tolist() + self.values[start:oldest].tolist()
+
+    def top(self, k):
+        """ Returns the k keys with the highest sums, highest first. """
+        sums = self.sums
+        return [key for key, _ in heapq.nlargest(k, self.rows.items(), key=lambda item: sums[item[1]])]
+
+
+def top_k(columns, k):
+    """ Returns the indices of the k highest values of each of columns, highest first.
+
+    All columns are ranked in one pass over their rows, using a heap of
+    size k per column that starts out full of placeholders, so most rows
+    only cost a comparison with the lowest value of each heap.
+    """
+    heaps = [[(float("-inf"), -1)] * k for _ in columns]
+    lowest = [float("-inf")] * len(columns)
+    for i, usages in enumerate(zip(*columns)):
+        for j, usage in enumerate(usages):
+            if usage > lowest[j]:
+                heap = heaps[j]
+                heapq.heapreplace(heap, (usage, i))
+                lowest[j] = heap[0][0]
+
+    return [[i for _, i in sorted(heap, reverse=True) if i >= 0] for heap in heaps]
+
+
+def totals_by_name(stats, k):
+    """ Returns the summed up usages of the k names using the most per metric, as {metric: {name: usage}}.
+
+    stats are Usages.  All other names are summed up as "other", so the
+    number of names stays bounded.
+    """
+    names = stats.tcomms()
+    sums = ({}, {}, {}, {})
+    for totals, usages in zip(sums, (stats.cpu, stats.mem, stats.net, stats.io)):
+        for name, usage in zip(names, usages):
+            totals[name] = totals.get(name, 0) + usage
+
+    result = {}
+    for metric, totals in zip(METRICS, sums):
+        top = dict(heapq.nlargest(k, totals.items(), key=lambda item: item[1]))
+        other = sum(totals.values()) - sum(top.values())
+        if other > 0:
+            top["other"] = top.get("other", 0) + other
+        result[metric] = top
+    return result
+
+
+# totals are the usages summed up by name, and bursts the samples taken in
+# between of the shown keys that spiked, if the collector was asked for them.
+# pinned are the keys that match the filter of the collector, by metric, and
+# system the (name, window) of the whole system, see system_usages
+Sample = namedtuple("Sample", ["time", "cpu", "mem", "net", "io", "alive_pids", "totals", "bursts", "pinned",
+                               "system"],
+                    defaults=(None, None, None, None))
 
 
 class PIDStatsCollector():
-    def __init__(self, sample_seconds, update_cpu_fn, update_mem_fn, update_net_fn, update_io_fn):
+    """ Samples all processes and passes the top usages to consumers.
+
+    Each consumer is called with a Sample from the collector thread, once
+    per sample.  The ui, headless output and others are all consumers.
+    """
+
+    def __init__(self, sample_seconds, consumers=(), totals=False, bursts=False, pid=None, replay=None,
+                 first_sample=None, system=False):
+        """ Collects the threads of pid instead of all processes if given, or plays back a Replay.
+
+        With first_sample, the first sample is taken after that many
+        seconds instead of a whole sample, to have something to show
+        right away.  With system, the pressure and counters of the whole
+        system are sampled, too.
+        """
         self.sample_seconds = sample_seconds
+        self.first_sample = first_sample
         self.num_samples = int(60 / self.sample_seconds)
 
-        self.update_cpu_fn = update_cpu_fn
-        self.update_mem_fn = update_mem_fn
-        self.update_net_fn = update_net_fn
-        self.update_io_fn = update_io_fn
+        self.consumers = list(consumers)
+        self.totals = totals
+        self.replay = replay
+        self.bursts = None
+        if bursts and replay is None and (BURST_CPU > 0 or BURST_IO > 0):
+            self.bursts = BurstSampler(sample_seconds, self.num_samples * sample_seconds)
+        # set to a Profiler to time each cycle
+        self.profiler = None
+        # set to a CaptureWriter to record each snapshot
+        self.capture = None
+        # set to a query to pin the keys that match it, only indexed while set
+        self.filter = None
+        self.index = None
+        # replayed processes didn't run on this system
+        self.system_wide = system and pid is None and replay is None
+
+        self.reset()
 
-        self.cpu = {}
-        self.mem = {}
-        self.net = {}
-        self.io = {}
+        self.pid = pid
+        if pid is None:
+            self.scanner = ProcScanner(SCAN_WORKERS, PARSE_PROCESSES)
+        else:
+            self.scanner = ThreadScanner(pid)
+        self.infos = ProcessInfoCache()
+        self.memory = None
+        if pid is None and replay is None and MEMORY_MODE in ("pss", "uss"):
+            self.memory = SmapsCache(MEMORY_MODE)
+        self.stopped = threading.Event()
 
+    def start(self):
+        """ Collects in a background thread. """
         self.bg_thread = threading.Thread(target=self.update, daemon=True)
         self.bg_thread.start()
 
+    def stop(self):
+        """ Stops collecting after the current sample. """
+        self.stopped.set()
+        if self.replay:
+            self.replay.stop()
+
+    def reset(self):
+        """ Forgets the windows of all keys. """
+        # a key can only stay while it was in the top k in the last window
+        # all keys in a window fit up to a minute at one sample per second,
+        # faster samples evict the least used keys instead of growing quadratically
+        max_keys = TOP_K * min(self.num_samples, 60)
+        self.cpu = History(self.num_samples, max_keys)
+        self.mem = History(self.num_samples, max_keys)
+        self.net = History(self.num_samples, max_keys)
+        self.io = History(self.num_samples, max_keys)
+        # only allocated while there is a filter, see collect_pinned
+        self.pinned = None
+        # one key per row of system_usages
+        self.system = History(self.num_samples, os.cpu_count() + 16) if self.system_wide else None
+
     def update(self):
-        while True:
-            group_by = None
-            if GROUP_BY == 'ppid':
-                def group_by(stat):
-                    return stat.ppid
-            elif GROUP_BY == 'name':
-                def group_by(stat):
-                    return stat.tcomm
-            stats = process_stats(self.sample_seconds, group_by=group_by)
+        group_by = None
+        if self.pid is None:
+            group_by = {'ppid': 'ppid', 'name': 'tcomm'}.get(GROUP_BY)
+
+        cgroup_mode = self.pid is None and self.replay is None and GROUP_BY in CGROUP_MODES
+        if cgroup_mode and not os.path.exists(CGROUP_ROOT+"/cgroup.controllers"):
+            print(f"GROUP_BY={GROUP_BY} needs cgroup v2 mounted at {CGROUP_ROOT}, not grouping")
+            cgroup_mode = False
+
+        if self.capture and cgroup_mode:
+            print(f"can't record GROUP_BY={GROUP_BY}, only processes are recorded")
+            self.capture = None
+
+        if self.replay:
+            def snapshot(profiler=None):
+                # paced by the replay
+                return self.replay.next()
+
+            def diff(before, after):
+                return diff_snapshots(before, after, group_by=group_by)
+        elif cgroup_mode:
+            def snapshot(profiler=None):
+                snapshot = take_cgroup_snapshot(GROUP_BY)
+                if profiler:
+                    profiler.lap("scan")
+                return snapshot
+
+            def diff(before, after):
+                return diff_cgroup_snapshots(before, after)
+        else:
+            def snapshot(profiler=None):
+                # there are no connections per thread
+                snapshot = take_snapshot(self.scanner, profiler, net=self.pid is None)
+                if self.capture:
+                    self.capture.write(snapshot)
+                    if profiler:
+                        profiler.lap("capture")
+                if self.memory:
+                    self.memory.refresh(snapshot.stats)
+                    if profiler:
+                        profiler.lap("memory")
+                return snapshot
+
+            def diff(before, after):
+                return diff_snapshots(before, after, group_by=group_by, memory=self.memory)
+
+        before = snapshot()
+        if before is None:
+            # an empty capture
+            self.scanner.close()
+            return
+        system = SystemScanner() if self.system_wide else None
+        if system:
+            # filled in again each sample, after and before swap
+            system_before, system_after = system.scan(), SystemStats(system.num_cpus)
+        next_sample = before.timestamp + (self.first_sample or self.sample_seconds)
+        first = self.first_sample is not None and self.replay is None
+        while not self.stopped.is_set():
+            if self.bursts:
+                self.bursts.run_until(next_sample)
+            elif self.replay is None and self.stopped.wait(max(next_sample - time.monotonic(), 0)):
+                break
+            profiler = self.profiler
+            if profiler:
+                profiler.start(time.monotonic() - next_sample, self.scanner)
+            after = snapshot(profiler)
+            if after is None:
+                break
+            if system:
+                system.scan(system_after)
+                if profiler:
+                    profiler.lap("system")
+            if self.replay and self.replay.jumped:
+                # seeked, there is nothing to diff to across the gap
+                self.replay.jumped = False
+                self.reset()
+                before = after
+                continue
+            stats = diff(before, after)
+            if first:
+                # bytes are per sample, the first one was shorter
+                factor = self.sample_seconds / (after.timestamp - before.timestamp)
+                stats.net = array.array('d', [n * factor for n in stats.net])
+                stats.io = array.array('d', [n * factor for n in stats.io])
+                first = False
+            before = after
+            if profiler:
+                profiler.lap("diff")
+
+            # fixed rate: when a scan overran, skip the missed samples
+            # instead of taking them back to back
+            next_sample += self.sample_seconds
+            behind = time.monotonic() - next_sample
+            if behind > 0:
+                next_sample += (behind // self.sample_seconds + 1) * self.sample_seconds
 
             alive_pids = defaultdict(lambda: False)
-            for pidstat in stats:
-                alive_pids[pidstat.pid] = True
+            alive_pids.update(dict.fromkeys(stats.pids(), True))
+
+            top_cpu, top_mem, top_net, top_io = stats.top_k(TOP_K)
+            if profiler:
+                profiler.lap("top_k")
+            if self.bursts:
+                self.bursts.trigger(stats, top_cpu, top_io)
 
-            top_20_cpu = self.collect_top_20(self.cpu, stats, sort_key=lambda stat: stat.cpu_usage)
-            GLib.idle_add(self.update_cpu_fn, top_20_cpu, alive_pids)
+            sample = Sample(
+                time=after.wall_time or time.time(),
+                cpu=self.collect_top_k(self.cpu, top_cpu, usage=lambda stat: stat.cpu_usage),
+                mem=self.collect_top_k(self.mem, top_mem, usage=lambda stat: stat.mem_usage),
+                # TODO: calculate max bytes over last 60 seconds (not max cpu)
+                # TODO: display avg/max in bytes
+                net=self.collect_top_k(self.net, top_net, usage=lambda stat: stat.net_usage),
+                io=self.collect_top_k(self.io, top_io, usage=lambda stat: stat.io_usage),
+                alive_pids=alive_pids,
+                totals=totals_by_name(stats, TOP_K) if self.totals else None)
+            if system:
+                usages = system_usages(system_before, system_after, self.sample_seconds)
+                system_before, system_after = system_after, system_before
+                sample = sample._replace(system=self.collect_system(usages))
+            if self.bursts:
+                sample = sample._replace(bursts=self.bursts.detail(sample))
+            if profiler:
+                profiler.lap("history")
 
-            top_20_mem = self.collect_top_20(self.mem, stats, sort_key=lambda stat: stat.mem_usage)
-            GLib.idle_add(self.update_mem_fn, top_20_mem, alive_pids)
+            query = self.filter
+            if query:
+                sample = sample._replace(pinned=self.collect_pinned(query, stats, after, cgroup_mode))
+                if profiler:
+                    profiler.lap("filter")
+            elif self.index is not None:
+                self.index = None
+                self.pinned = None
+            # replayed processes aren't on this system, their metadata isn't recorded
+            if not cgroup_mode and self.replay is None:
+                self.infos.retain(after.stats)
+            if self.replay is None:
+                for metric in (sample.cpu, sample.mem, sample.net, sample.io,
+                               *(sample.pinned.values() if sample.pinned else ())):
+                    for stat, _ in metric:
+                        # labels stay the same while a process is ranked, resolve them once
+                        if stat.user is None:
+                            self.infos.resolve(stat)
+            if profiler:
+                profiler.lap("metadata")
 
-            top_20_net = self.collect_top_20(self.net, stats, sort_key=lambda stat: stat.net_usage)
-            # TODO: calculate max bytes over last 60 seconds (not max cpu)
-            # TODO: display avg/max in bytes
-            GLib.idle_add(self.update_net_fn, top_20_net, alive_pids)
+            for consumer in self.consumers:
+                consumer(sample)
+            if profiler:
+                profiler.lap("consumers")
+                profiler.finish()
 
-            top_20_io = self.collect_top_20(self.io, stats, sort_key=lambda stat: stat.io_usage)
-            GLib.idle_add(self.update_io_fn, top_20_io, alive_pids)
+        self.scanner.close()
+        if system:
+            system.close()
 
-    def collect_top_20(self, per_pid_stats, stats, sort_key=lambda stat: stat.cpu_usage):
-        stats.sort(key=sort_key, reverse=True)
-        top_20 = stats[:20]
+    def collect_system(self, usages):
+        """ Returns the windows of usages, which are the same keys every sample. """
+        history = self.system
+        history.advance()
+        for name, usage in usages:
+            history.append(name, usage)
+        return [(name, history.window(name) if name in history else [0.0] * self.num_samples)
+                for name, _ in usages]
 
-        usages = []
-        for pid in top_20:
-            if pid not in per_pid_stats:
-                per_pid_stats[pid] = [0]*self.num_samples
+    def collect_pinned(self, query, stats, after, cgroup_mode):
+        """ Returns the windows of the top keys of stats that match query, by metric. """
+        query = query.lower()
+        if cgroup_mode:
+            # there are only few cgroups
+            table = stats.table
+            positions = [i for i, (name, row) in enumerate(zip(stats.tcomms(), stats.rows))
+                         if query in f"{name}\0{table.cgroup[row]}\0{table.user[row]}".lower()]
+        else:
+            if self.index is None:
+                # replayed processes only have their names
+                self.index = ProcessIndex(metadata=self.replay is None)
+            self.index.update(after.stats)
+            matches = self.index.search(query)
+            table = after.stats
+            if stats.column is None:
+                # rows are in the order of the table
+                rows = stats.rows
+                positions = []
+                for pid in matches:
+                    row = table.index[pid]
+                    i = bisect.bisect_left(rows, row)
+                    if i < len(rows) and rows[i] == row:
+                        positions.append(i)
+            else:
+                # a group matches when one of its processes does
+                column = getattr(table, stats.column)
+                keys = {column[table.index[pid]] for pid in matches}
+                positions = [i for i, key in enumerate(stats.keys) if key in keys]
 
-            per_pid_stats[pid].append(sort_key(pid))
-            if len(per_pid_stats[pid]) > self.num_samples:
-                per_pid_stats[pid].pop(0)
+        if self.pinned is None:
+            self.pinned = [History(self.num_samples, TOP_K * min(self.num_samples, 60)) for _ in METRICS]
+        views = {}
+        windows = {}
+        for metric, history in zip(METRICS, self.pinned):
+            # each tab shows the matches that use the most of its metric
+            usages = getattr(stats, metric)
+            pinned = [views[i] if i in views else views.setdefault(i, stats.view(i))
+                      for i in heapq.nlargest(TOP_K, positions, key=usages.__getitem__)]
+            history.advance()
+            for stat in pinned:
+                history.append(stat.key, getattr(stat, f"{metric}_usage"), label=stat)
+            windows[metric] = sorted(((stat, history.window(stat.key) if stat.key in history
+                                       else [0.0] * self.num_samples) for stat in pinned),
+                                     key=lambda item: sum(item[1]), reverse=True)
+        return windows
 
-        for pid in per_pid_stats:
-            if pid not in top_20:
-                per_pid_stats[pid].append(0)
-                if len(per_pid_stats[pid]) > self.num_samples:
-                    per_pid_stats[pid].pop(0)
+    def collect_top_k(self, history, top, usage):
+        """ Appends the usage of the current top stats and returns the top keys of the window. """
+        history.advance()
+        for stat in top:
+            history.append(stat, usage(stat), label=stat)
 
-            usages.append((pid, per_pid_stats[pid]))
+        return [(history.labels[key], history.window(key)) for key in history.top(TOP_K)]
 
-        usages = list(per_pid_stats.items())
-        usages.sort(key=lambda u: sum(u[1]), reverse=True)
-        return usages[:20]
 
+class BurstSampler():
+    """ Samples the few keys that spiked at a high rate, for a while.
 
-# https://git.kernel.org/pub/scm/linux/kernel/git/torvalds/linux.git/tree/Documentation/filesystems/proc.rst
-def read_stat(pid):
-    try:
-        with open("/proc/"+pid+"/stat", encoding="UTF-8") as f:
-            stat_line = f.readline().strip()
-        with open("/proc/"+pid+"/statm") as f:
-            statm_line = f.readline().strip()
+    The full scan stays at its rate.  When a key of the top cpu or io
+    usages crosses BURST_CPU or BURST_IO, only its processes (or its
+    cgroup) are read every BURST_INTERVAL seconds for BURST_SECONDS, in
+    the time the collector would otherwise sleep.  A key only gets
+    another burst once it went below the thresholds, so something that is
+    busy all the time isn't read at the high rate forever.  The usages are
+    in the units of a full sample, so they can be drawn into the same graphs.
+    """
+
+    MAX_BURSTS = 4
+    # groups with more processes are too expensive to read that often
+    MAX_PIDS = 16
+
+    def __init__(self, sample_seconds, keep_seconds, interval=None, duration=None, cpu=None, io=None):
+        self.sample_seconds = sample_seconds
+        self.keep_seconds = keep_seconds
+        self.interval = interval or BURST_INTERVAL
+        self.duration = duration or BURST_SECONDS
+        self.cpu = BURST_CPU if cpu is None else cpu
+        self.io = BURST_IO if io is None else io
+
+        # schedstat and io of all processes of all bursts stay open
+        self.handles = ProcHandles(max_fds=2 * self.MAX_PIDS * self.MAX_BURSTS)
+        # key -> [pids or cgroup path, until (monotonic), last counters by pid or path, last time]
+        self.bursts = {}
+        # key -> (deque of (time, cpu), deque of (time, io))
+        self.points = {}
+        # keys whose burst ended while they were still above the thresholds
+        self.finished = set()
+
+    def trigger(self, stats, top_cpu, top_io):
+        """ Starts bursts for the keys of stats above the thresholds. """
+        spiked = []
+        if self.cpu > 0:
+            spiked += [stat for stat in top_cpu if stat.cpu_usage >= self.cpu]
+        if self.io > 0:
+            spiked += [stat for stat in top_io if stat.io_usage >= self.io]
+
+        # keys that went below the thresholds can burst again
+        self.finished &= {stat.key for stat in spiked}
+
+        now = time.monotonic()
+        for stat in spiked:
+            if stat.key in self.bursts or stat.key in self.finished or len(self.bursts) >= self.MAX_BURSTS:
+                continue
+            target = stat.cgroup or stats.member_pids(stat)
+            if len(target) > self.MAX_PIDS and not stat.cgroup:
+                continue
+            counters = self.read(target)
+            if counters is None:
+                continue
+            self.bursts[stat.key] = [target, now + self.duration, counters, now]
+            self.points.setdefault(stat.key, (deque(), deque()))
+
+    def read(self, target):
+        """ Returns {pid: (cpu seconds, io bytes)} of a list of pids, or the same by path of a cgroup. """
+        if isinstance(target, str):
+            stat = read_cgroup(target, "")
+            return {target: (stat.cpu_usec / 1_000_000, stat.io_bytes)} if stat else None
+
+        counters = {}
+        for pid in target:
+            try:
+                # nanoseconds on the cpu, finer than the ticks in stat
+                cpu = int(self.handles.read(pid, "schedstat").split()[0]) / 1_000_000_000
+            except OSError:
+                continue
+            io = 0
+            try:
+                io_lines = self.handles.read(pid, "io").split(b"\n")
+                io = int(io_lines[4].split()[1]) + int(io_lines[5].split()[1])
+            except OSError:
+                pass
+            counters[pid] = (cpu, io)
+        return counters or None
+
+    def tick(self):
+        now = time.monotonic()
+        wall = time.time()
+        for key, burst in list(self.bursts.items()):
+            target, until, counters_before, before = burst
+            counters = self.read(target)
+            if counters is None or now >= until:
+                del self.bursts[key]
+                self.finished.add(key)
+                if isinstance(target, list):
+                    for pid in target:
+                        self.handles.close(pid)
+                if counters is None:
+                    continue
+
+            elapsed = now - before
+            if elapsed > 0:
+                # only processes that were there before count, and a reused pid
+                # starts over, so the sums of exited processes can't go backwards
+                cpu, io = 0.0, 0
+                for pid, (cpu_after, io_after) in counters.items():
+                    if pid in counters_before:
+                        cpu += max(cpu_after - counters_before[pid][0], 0)
+                        io += max(io_after - counters_before[pid][1], 0)
+                cpu_points, io_points = self.points[key]
+                cpu_points.append((wall, cpu / elapsed * 100.0))
+                io_points.append((wall, io * self.sample_seconds / elapsed))
+            burst[2:] = [counters, now]
+
+    def run_until(self, deadline):
+        """ Samples the bursts until the monotonic deadline, or just sleeps if there are none. """
+        while True:
+            remaining = deadline - time.monotonic()
+            if not self.bursts:
+                time.sleep(max(remaining, 0))
+                return
+            if remaining <= 0:
+                return
+            time.sleep(min(self.interval, remaining))
+            self.tick()
+
+    def detail(self, sample):
+        """ Returns {"cpu": {key: [(time, usage), ...]}, "io": ...} of the keys shown in sample. """
+        oldest = sample.time - self.keep_seconds
+        for key in list(self.points):
+            for points in self.points[key]:
+                while points and points[0][0] < oldest:
+                    points.popleft()
+            if key not in self.bursts and not any(self.points[key]):
+                del self.points[key]
+
+        detail = {}
+        for i, metric in enumerate(("cpu", "io")):
+            detail[metric] = {stat.key: list(self.points[stat.key][i])
+                              for stat, _ in getattr(sample, metric)
+                              if stat.key in self.points and self.points[stat.key][i]}
+        return detail
+
+
+class Profiler():
+    """ Records how long each stage of a collection cycle takes, and what healthy itself costs.
+
+    The collector only calls it while profiling, otherwise a stage costs
+    one check of a local variable.  Timings are in ms, the cpu, syscalls
+    and opened files are counted from one finished cycle to the next, so
+    they include the ui.
+    """
+
+    STAGES = ("late", "scan", "read", "parse", "net", "capture", "memory", "system", "diff", "top_k",
+              "history", "filter", "metadata", "consumers", "ui", "total")
+    COUNTERS = ("cpu %", "rss MB", "rw calls", "opened", "open fds")
+
+    def __init__(self, num_cycles=60):
+        self.cycles = deque(maxlen=num_cycles)
+        self.lock = threading.Lock()
+        self.current = None
+        self.scanner = None
+        self.previous = self.counters(None)
+
+    def counters(self, scanner):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        read_time, parse_time, opened = 0, 0, 0
+        if scanner:
+            read_time, parse_time, opened = scanner.read_time, scanner.parse_time, scanner.opened
+        return (time.perf_counter(), usage.ru_utime + usage.ru_stime, read_syscalls(),
+                read_time, parse_time, opened)
+
+    def start(self, lateness, scanner=None):
+        if scanner is not self.scanner:
+            self.scanner = scanner
+            self.previous = self.counters(scanner)
+        with self.lock:
+            self.current = {"late": max(lateness, 0) * 1000}
+        self.started = self.last = time.perf_counter()
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self.add(stage, (now - self.last) * 1000)
+        self.last = now
+
+    def add(self, stage, ms):
+        """ Adds ms to stage of the current cycle, or of the last one when between cycles. """
+        with self.lock:
+            cycle = self.current if self.current is not None else (self.cycles[-1] if self.cycles else None)
+            if cycle is not None:
+                cycle[stage] = cycle.get(stage, 0) + ms
 
-        read_bytes = 0
-        write_bytes = 0
+    def finish(self):
+        counters = self.counters(self.scanner)
+        wall, cpu, syscalls, read_time, parse_time, opened = (now - before for now, before in
+                                                              zip(counters, self.previous))
+        self.previous = counters
+
+        with self.lock:
+            cycle = self.current
+            cycle["total"] = (time.perf_counter() - self.started) * 1000
+            cycle["read"] = read_time * 1000
+            cycle["parse"] = parse_time * 1000
+            cycle["cpu %"] = cpu / wall * 100 if wall > 0 else 0
+            cycle["rss MB"] = read_rss() / (1024 * 1024)
+            cycle["rw calls"] = syscalls
+            cycle["opened"] = opened
+            cycle["open fds"] = len(os.listdir("/proc/self/fd"))
+            self.cycles.append(cycle)
+            self.current = None
+
+    def report(self):
+        """ Returns a table of the last, median and maximum value of each stage and counter. """
+        with self.lock:
+            cycles = list(self.cycles)
+        if not cycles:
+            return "no cycles profiled yet\n"
+
+        keys = self.STAGES + self.COUNTERS
+        names = [f"{stage} ms" for stage in self.STAGES] + list(self.COUNTERS)
+        lines = [f"{'':<12} {'last':>10} {'median':>10} {'max':>10}   ({len(cycles)} cycles)"]
+        for key, name in zip(keys, names):
+            values = sorted(cycle.get(key, 0) for cycle in cycles)
+            lines.append(f"{name:<12} {cycles[-1].get(key, 0):>10.2f} "
+                         f"{values[len(values) // 2]:>10.2f} {values[-1]:>10.2f}")
+        return "\n".join(lines) + "\n"
+
+
+def read_syscalls():
+    """ Returns the number of read and write syscalls of this process so far.
+
+    open, close and friends aren't counted by the kernel.
+    """
+    with open("/proc/self/io") as f:
+        lines = f.read().split("\n")
+    return int(lines[2].split()[1]) + int(lines[3].split()[1])
+
+
+def read_rss():
+    """ Returns the resident memory of this process in bytes. """
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def raise_fd_limit(limit=65536):
+    """ Raises the soft RLIMIT_NOFILE towards the hard limit, returns the soft limit. """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    if soft != resource.RLIM_INFINITY and soft < limit:
         try:
-            with open("/proc/"+pid+"/io") as f:
-                f.readline() # rchar - chars read
-                f.readline() # wchar - chars written
-                f.readline() # syscr - syscalls read
-                f.readline() # syscw - syscalls write
-                read_bytes = int(f.readline().strip().split()[1])
-                write_bytes = int(f.readline().strip().split()[1])
-        except:
-            # can't read io usage for non-user processes?
+            resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+            soft = limit
+        except (ValueError, OSError):
             pass
+    return soft
 
-        return PIDStat(stat_line, statm_line, (0, 0), (read_bytes, write_bytes))
-    except Exception as ex:
-        print("Ignoring", ex)
-        # return fake stat that should never appear in stuff
-        return PIDStat("-1 (<error>) Z 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0", "0 0 0 0 0 0 0", (0, 0), (0, 0))
 
+class FdBudget():
+    """ The number of fds all ProcHandles together may keep open. """
 
-def read_global_cpu():
-    # user + nice + system + idle + iowait + irq + softirq + steal
-    with open("/proc/stat") as f:
-        global_stat = [int(x) for x in f.readline().strip()[len("cpu  "):].split()]
-        return sum(global_stat[:8])
+    # fds left for gtk, sockets, `ss` and uncached reads
+    RESERVED_FDS = 256
 
+    def __init__(self, limit=None):
+        if limit is None:
+            limit = raise_fd_limit() - self.RESERVED_FDS
+        self.limit = limit
+        self.used = 0
+        self.lock = threading.Lock()
 
-def read_global_mem():
-    # inspired by https://github.com/Alexays/Waybar/blob/600afaf530974c9ef2fec1e61808836712dfde0a/src/modules/memory/common.cpp#L16-L22
-    with open("/proc/meminfo") as f:
-        mem_total = int(f.readline().strip().split()[1])
-        f.readline() # skip mem_free
-        mem_avail = int(f.readline().strip().split()[1])
-        return (mem_total - mem_avail) * 1024
+    def acquire(self):
+        with self.lock:
+            if self.used >= self.limit:
+                return False
+            self.used += 1
+            return True
 
+    def release(self, n=1):
+        with self.lock:
+            self.used -= n
 
-ConnectionInfo = namedtuple("ConnectionInfo",
-                            ["pid", "fd", "bytes_sent", "bytes_received"])
 
+fd_budget = None
 
-ss_tip_re = re.compile(
-    r"pid=(\d+),fd=(\d+).*bytes_sent:(\d+).*bytes_received:(\d+)"
-)
 
+def shared_fd_budget():
+    global fd_budget
+    if fd_budget is None:
+        fd_budget = FdBudget()
+    return fd_budget
 
-def parse_ss_tip(line):
-    """ Parses lines output by `ss -tipHOn`. """
-    match = ss_tip_re.search(line)
-    if not match:
+
+class ProcHandles():
+    """ Keeps /proc/<pid>/{stat,statm,io} open across samples.
+
+    Reading an open proc file again from offset 0 returns fresh contents,
+    so each sample only costs one pread per file instead of open, read and
+    close.  Handles of exited processes fail with ESRCH, even when the pid
+    has been reused since, so they are closed and opened again.
+    """
+
+    FILES = ("stat", "statm", "io")
+    # marks files we are not allowed to read, e.g. io of other users
+    UNREADABLE = -1
+
+    def __init__(self, max_fds=None, budget=None):
+        """ Keeps up to max_fds open, as far as the budget shared with other handles allows. """
+        self.max_fds = float("inf") if max_fds is None else max(max_fds, 0)
+        self.budget = budget
+        if self.budget is None and self.max_fds > 0:
+            self.budget = shared_fd_budget()
+        self.num_fds = 0
+        self.fds = {}
+        self.buf = bytearray(4096)
+        # files opened so far, for profiling
+        self.opened = 0
+
+    def read(self, pid, name):
+        """ Returns the contents of /proc/<pid>/<name>, raises OSError if that fails. """
+        fds = self.fds.get(pid)
+        fd = fds.get(name) if fds else None
+        if fd == self.UNREADABLE:
+            raise PermissionError(f"{PROC_ROOT}/{pid}/{name} is not readable")
+        if fd is not None:
+            try:
+                return self.pread(fd)
+            except ProcessLookupError:
+                # process is gone, its pid might belong to a new one already
+                self.close(pid)
+                fds = None
+
+        try:
+            fd = os.open(f"{PROC_ROOT}/{pid}/{name}", os.O_RDONLY | os.O_CLOEXEC)
+            self.opened += 1
+        except PermissionError:
+            if fds is not None:
+                fds[name] = self.UNREADABLE
+            raise
+
+        if self.num_fds >= self.max_fds or not self.budget.acquire():
+            try:
+                return self.pread(fd)
+            finally:
+                os.close(fd)
+
+        if fds is None:
+            fds = self.fds.setdefault(pid, {})
+        fds[name] = fd
+        self.num_fds += 1
+        return self.pread(fd)
+
+    def pread(self, fd):
+        data, self.buf = pread_file(fd, self.buf)
+        return data
+
+    def close(self, pid):
+        for fd in self.fds.pop(pid, {}).values():
+            if fd != self.UNREADABLE:
+                os.close(fd)
+                self.num_fds -= 1
+                self.budget.release()
+
+    def retain(self, pids):
+        """ Closes the handles of all processes not in pids. """
+        for pid in self.fds.keys() - pids:
+            self.close(pid)
+
+    def close_all(self):
+        for pid in list(self.fds):
+            self.close(pid)
+
+
+# only used by read_stat() callers that don't keep their own handles
+uncached_handles = ProcHandles(max_fds=0)
+
+
+# https://git.kernel.org/pub/scm/linux/kernel/git/torvalds/linux.git/tree/Documentation/filesystems/proc.rst
+def read_stat(pid, handles=None):
+    """ Returns a PIDStat of pid, or None if it exited. """
+    table = parse_stats([(pid, read_raw_stat(pid, handles or uncached_handles))])
+    return table.view(0) if len(table) else None
+
+
+def pread_file(fd, buf):
+    """ Returns the contents of fd read from offset 0 into buf, and buf or a bigger one if it didn't fit. """
+    while True:
+        n = os.preadv(fd, [buf], 0)
+        if n < len(buf):
+            return memoryview(buf)[:n].tobytes(), buf
+        # didn't fit, retry with a bigger buffer
+        buf = bytearray(len(buf) * 2)
+
+
+def read_raw_stat(pid, handles):
+    """ Returns the contents of stat, statm and io of pid, or None if it exited. """
+    try:
+        stat = handles.read(pid, "stat")
+        statm = handles.read(pid, "statm")
+    except OSError:
+        # exited since listing /proc, happens all the time
         return None
 
-    return ConnectionInfo(pid=int(match.group(1)), fd=int(match.group(2)),
-                          bytes_sent=int(match.group(3)),
-                          bytes_received=int(match.group(4)))
+    try:
+        io = handles.read(pid, "io")
+    except OSError:
+        # can't read io usage for non-user processes
+        io = None
 
+    return (stat, statm, io)
 
-def read_net_per_process():
-    ss_tip = subprocess.run(["ss", "--tcp", "--info", "--processes",
-                                   "--no-header", "--oneline", "--numeric"],
-                            capture_output=True)
-    return (parse_ss_tip(
-        line.decode("utf-8")) for line in ss_tip.stdout.strip().split(b"\n"))
 
+def parse_stats(raws):
+    """ Returns a ProcTable of all (pid, raw) that didn't exit, which is cheap to send between processes. """
+    table = ProcTable()
+    for _, raw in raws:
+        if raw is not None:
+            table.append_raw(*raw)
+    return table
 
-# inspired by https://github.com/scaidermern/top-processes/blob/master/top_proc.c
-def process_stats(sample_seconds=1.0, group_by=None):
-    global_cpu = read_global_cpu()
-    net_before = read_net_per_process()
-    pid_stats_before = dict(((pid, read_stat(pid)) for pid in os.listdir("/proc") if pid.isnumeric()))
-    time.sleep(sample_seconds)
-    pid_stats_after = dict(((pid, read_stat(pid)) for pid in os.listdir("/proc") if pid.isnumeric()))
-    global_cpu = read_global_cpu() - global_cpu
-    net_after = read_net_per_process()
-    global_mem = read_global_mem()
 
-    net_stats = {}
-    for info in net_after:
-        if not info:
-            continue
-        if info.pid not in net_stats:
-            net_stats[info.pid] = 0
-        net_stats[info.pid] += info.bytes_sent + info.bytes_received
-    for info in net_before:
-        if not info:
-            continue
-        if info.pid not in net_stats:
-            # connection disappeared, can't calculate difference
-            # TODO: what about differing fds though?
-            print(info, "disappeared")
-            continue
+class ProcTable():
+    """ The stats of many processes, as one typed array per field.
 
-        net_stats[info.pid] -= info.bytes_sent + info.bytes_received
+    Scanning thousands of processes every second would otherwise create as
+    many objects, and as much garbage.  Rows are only turned into PIDStats
+    for the few processes that are shown, see Usages.
+    """
 
-    cpu_count = os.cpu_count()
+    COLUMNS = ("pid", "ppid", "utime", "stime", "starttime", "size", "resident", "io_bytes")
 
-    pid_stats = []
-    for pid in pid_stats_after:
-        if pid in pid_stats_before:
-            pid_before = pid_stats_before[pid]
-            pid_after = pid_stats_after[pid]
-            cpu_time = (pid_after.utime + pid_after.stime) - (pid_before.utime + pid_before.stime)
-            pid_after.cpu_usage = (cpu_time / global_cpu) * 100.0 * cpu_count
-            pid_after.mem_usage = ((pid_after.resident * PAGE_SIZE) / global_mem) * 100
-            if int(pid) in net_stats and net_stats[int(pid)] > 0.0:
-                pid_after.net_usage = net_stats[int(pid)]
-            else:
-                pid_after.net_usage = 0
-            io_bytes = pid_after.io_bytes - pid_before.io_bytes
-            if io_bytes > 0.0:
-                pid_after.io_usage = io_bytes
+    def __init__(self):
+        for column in self.COLUMNS:
+            setattr(self, column, array.array('q'))
+        self.tcomm = []
+        # only set for tables of cgroups, their paths and owners
+        self.cgroup = None
+        self.user = None
+        self._index = None
 
-            pid_stats.append(pid_after)
+    def __len__(self):
+        return len(self.pid)
 
-    if group_by:
-        grouped = defaultdict(list)
-        for stat in pid_stats:
-            by = group_by(stat)
-            if by not in grouped:
-                grouped[by] = stat
-                grouped[by].num_processes = 1
+    def append(self, pid, tcomm, ppid=0, utime=0, stime=0, starttime=0, size=0, resident=0, io_bytes=0):
+        self.pid.append(pid)
+        self.tcomm.append(tcomm)
+        self.ppid.append(ppid)
+        self.utime.append(utime)
+        self.stime.append(stime)
+        self.starttime.append(starttime)
+        self.size.append(size)
+        self.resident.append(resident)
+        self.io_bytes.append(io_bytes)
+        self._index = None
+
+    def append_raw(self, stat, statm, io):
+        """ Appends a process from the contents of its stat, statm and io files. """
+        # the name may contain spaces and parentheses itself
+        name_start, name_end = stat.index(b"("), stat.rindex(b")")
+        fields = stat[name_end+2:].split()
+
+        io_bytes = 0
+        if io:
+            # rchar, wchar, syscr, syscw, read_bytes, write_bytes, ...
+            io_lines = io.split(b"\n")
+            io_bytes = int(io_lines[4].split()[1]) + int(io_lines[5].split()[1])
+
+        statm_fields = statm.split(None, 2)
+        self.append(int(stat[:name_start]), stat[name_start+1:name_end].decode(errors="replace"),
+                    ppid=int(fields[1]), utime=int(fields[11]), stime=int(fields[12]),
+                    starttime=int(fields[19]), size=int(statm_fields[0]),
+                    resident=int(statm_fields[1]), io_bytes=io_bytes)
+
+    def extend(self, other):
+        for column in self.COLUMNS:
+            getattr(self, column).extend(getattr(other, column))
+        self.tcomm.extend(other.tcomm)
+        self._index = None
+
+    @property
+    def index(self):
+        """ pid -> row """
+        if self._index is None:
+            self._index = dict(zip(self.pid, range(len(self.pid))))
+        return self._index
+
+    def view(self, row):
+        return PIDStat(self, row)
+
+
+class Usages():
+    """ The usages of some rows of a ProcTable, usually those of a diff of two snapshots.
+
+    The usages are arrays in the order of rows.  When rows were grouped,
+    names and keys are the names and History keys of the groups.
+    """
+
+    def __init__(self, table, rows, cpu, mem, net, io, names=None, keys=None, column=None):
+        self.table = table
+        self.rows = rows
+        self.cpu = cpu
+        self.mem = mem
+        self.net = net
+        self.io = io
+        self.names = names
+        self.keys = keys
+        # the column grouped by, if any
+        self.column = column
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return (self.view(i) for i in range(len(self.rows)))
+
+    def view(self, i):
+        stat = PIDStat(self.table, self.rows[i], None if self.keys is None else self.keys[i])
+        if self.names is not None:
+            stat.tcomm = self.names[i]
+        stat.cpu_usage = self.cpu[i]
+        stat.mem_usage = self.mem[i]
+        stat.net_usage = self.net[i]
+        stat.io_usage = self.io[i]
+        return stat
+
+    def pids(self):
+        pids = self.table.pid
+        return [pids[row] for row in self.rows]
+
+    def member_pids(self, stat):
+        """ Returns the pids that make up stat, more than one if it is a group. """
+        if self.column is None:
+            return [stat.pid]
+        key = stat.key
+        return [pid for pid, value in zip(self.table.pid, getattr(self.table, self.column)) if value == key]
+
+    def tcomms(self):
+        if self.names is not None:
+            return self.names
+        tcomm = self.table.tcomm
+        return [tcomm[row] for row in self.rows]
+
+    def top_k(self, k):
+        """ Returns the k PIDStats with the highest cpu, mem, net and io usage, see top_k().
+
+        Only the rows that are ranked are turned into PIDStats.
+        """
+        views = {}
+        result = []
+        for top in top_k((self.cpu, self.mem, self.net, self.io), k):
+            for i in top:
+                if i not in views:
+                    views[i] = self.view(i)
+            result.append([views[i] for i in top])
+        return result
+
+    def group(self, column):
+        """ Returns the usages added up by the values of column, named after their lowest pid. """
+        table = self.table
+        keys = getattr(table, column)
+        pids = table.pid
+        groups = {}
+        rows, cpu, mem, net, io = array.array('q'), array.array('d'), array.array('d'), \
+            array.array('d'), array.array('d')
+        counts, group_keys = [], []
+        for i, row in enumerate(self.rows):
+            key = keys[row]
+            g = groups.get(key)
+            if g is None:
+                groups[key] = len(rows)
+                rows.append(row)
+                cpu.append(self.cpu[i])
+                mem.append(self.mem[i])
+                net.append(self.net[i])
+                io.append(self.io[i])
+                counts.append(1)
+                group_keys.append(key)
             else:
-                grouped[by].num_processes += 1
-                if stat.pid < grouped[by].pid:
-                    grouped[by].pid = stat.pid
-                    grouped[by].tcomm = stat.tcomm
-                grouped[by].cpu_usage += stat.cpu_usage
-                grouped[by].mem_usage += stat.mem_usage
-                grouped[by].net_usage += stat.net_usage
-                grouped[by].io_usage += stat.io_usage
-        for by, stat in grouped.items():
-            if stat.num_processes > 1:
-                # TODO: this count is never updated in the ui
-                grouped[by].tcomm += f" ({stat.num_processes})"
-        pid_stats = list(grouped.values())
-    return pid_stats
+                counts[g] += 1
+                if pids[row] < pids[rows[g]]:
+                    rows[g] = row
+                cpu[g] += self.cpu[i]
+                mem[g] += self.mem[i]
+                net[g] += self.net[i]
+                io[g] += self.io[i]
 
+        names = [f"{table.tcomm[row]} ({count})" if count > 1 else table.tcomm[row]
+                 for row, count in zip(rows, counts)]
+        return Usages(table, rows, cpu, mem, net, io, names=names, keys=group_keys, column=column)
 
-def on_key_press(widget, event):
-    alt = event.state & Gdk.ModifierType.MOD1_MASK
-    if alt and event.keyval == Gdk.KEY_1:
-        widget.set_current_page(0)
-    elif alt and event.keyval == Gdk.KEY_2:
-        widget.set_current_page(1)
-    elif alt and event.keyval == Gdk.KEY_3:
-        widget.set_current_page(2)
-    elif alt and event.keyval == Gdk.KEY_4:
-        widget.set_current_page(3)
 
+class ProcScanner():
+    """ Reads stat, statm and io of all processes.
 
-class Healthy:
-    def on_startup(self, app):
-        global PAGE_SIZE
-        getconf = subprocess.run(["getconf", "PAGE_SIZE"], capture_output=True)
-        PAGE_SIZE = int(getconf.stdout.strip())
+    With more than one worker the pids are split into shards by pid, each
+    read by its own thread with its own ProcHandles, so that a pid always
+    lands in the same shard and keeps its handles.  The reads are mostly
+    syscalls which release the GIL.  Parsing needs the GIL, so it can
+    optionally be moved to a pool of parse_processes processes.
+    """
 
-        self.win = Gtk.ApplicationWindow(application=app)
-        self.win.set_keep_above(True)
+    def __init__(self, workers=1, parse_processes=0, max_fds=None):
+        self.workers = max(workers, 1)
+        if max_fds is not None:
+            max_fds //= self.workers
+        self.handles = [ProcHandles(max_fds) for _ in range(self.workers)]
 
-        sample_seconds = 1.0
-        cpu_graphs = GraphCollection(sample_seconds, new_graph=CPUGraph)
-        mem_graphs = GraphCollection(sample_seconds, new_graph=CPUGraph)
-        net_graphs = GraphCollection(sample_seconds, new_graph=BytesGraph)
-        io_graphs = GraphCollection(sample_seconds, new_graph=BytesGraph)
-        pid_stats_collector = PIDStatsCollector(sample_seconds,
-                cpu_graphs.update_graphs, mem_graphs.update_graphs,
-                net_graphs.update_graphs, io_graphs.update_graphs)
+        self.pool = None
+        if self.workers > 1:
+            # only imported when needed, they take a while to import
+            from concurrent.futures import ThreadPoolExecutor
+            self.pool = ThreadPoolExecutor(self.workers, thread_name_prefix="healthy-scan")
+        self.parse_pool = None
+        if parse_processes > 0:
+            from concurrent.futures import ProcessPoolExecutor
+            import multiprocessing
+            # forking a process that runs gtk and threads is asking for trouble
+            context = multiprocessing.get_context("forkserver")
+            self.parse_pool = ProcessPoolExecutor(parse_processes, mp_context=context)
 
-        if os.getenv('ONLY_CPU'):
-            self.win.add(cpu_graphs)
+        # seconds spent reading and parsing so far, added up over all shards
+        self.read_time = 0.0
+        self.parse_time = 0.0
+        self.timing_lock = threading.Lock()
+
+    @property
+    def opened(self):
+        return sum(handles.opened for handles in self.handles)
+
+    def scan(self):
+        """ Returns a ProcTable of all running processes. """
+        pids = [pid for pid in os.listdir(PROC_ROOT) if pid.isnumeric()]
+        if self.pool is None:
+            return self.scan_shard(0, pids)
+
+        shards = [[] for _ in range(self.workers)]
+        for pid in pids:
+            shards[int(pid) % self.workers].append(pid)
+
+        table = ProcTable()
+        for shard_table in self.pool.map(self.scan_shard, range(self.workers), shards):
+            table.extend(shard_table)
+        return table
+
+    def scan_shard(self, shard, pids):
+        handles = self.handles[shard]
+        start = time.perf_counter()
+        raws = [(pid, read_raw_stat(pid, handles)) for pid in pids]
+        handles.retain(set(pids))
+        read = time.perf_counter()
+
+        if self.parse_pool:
+            parsed = self.parse_pool.submit(parse_stats, raws).result()
         else:
-            notebook = Gtk.Notebook()
-            notebook.connect("key-press-event", on_key_press)
-            notebook.append_page(cpu_graphs, Gtk.Label(label='CPU'))
-            notebook.append_page(mem_graphs, Gtk.Label(label='Memory'))
-            notebook.append_page(net_graphs, Gtk.Label(label='Network'))
-            notebook.append_page(io_graphs, Gtk.Label(label='IO'))
-            notebook.foreach(lambda child:
-                             notebook.child_set_property(child,
-                                                         "tab-expand",
-                                                         True))
-            self.win.add(notebook)
+            parsed = parse_stats(raws)
 
-        self.win.show_all()
+        # shards run in parallel, but += on floats isn't atomic across threads
+        with self.timing_lock:
+            self.read_time += read - start
+            self.parse_time += time.perf_counter() - read
+        return parsed
 
-    def on_activate(self, app):
-        self.win.present_with_time(int(time.time()))
+    def close(self):
+        if self.pool:
+            self.pool.shutdown()
+        if self.parse_pool:
+            self.parse_pool.shutdown()
+        for handles in self.handles:
+            handles.close_all()
 
 
-if __name__ == '__main__':
-    app = Gtk.Application(application_id='org.papill0n.Healthy')
-    healthy = Healthy()
-    app.connect('startup', healthy.on_startup)
-    app.connect('activate', healthy.on_activate)
-    app.run(sys.argv)
+class ThreadScanner():
+    """ Reads stat, statm and io of the threads of one process, like ProcScanner does for processes. """
+
+    def __init__(self, pid, max_fds=256):
+        self.pid = pid
+        self.handles = ProcHandles(max_fds)
+        self.read_time = 0.0
+        self.parse_time = 0.0
+
+    @property
+    def opened(self):
+        return self.handles.opened
+
+    def scan(self):
+        """ Returns a ProcTable of the threads, their tids as pids. """
+        try:
+            tids = [tid for tid in os.listdir(f"{PROC_ROOT}/{self.pid}/task") if tid.isnumeric()]
+        except OSError:
+            # the process is gone
+            tids = []
+
+        start = time.perf_counter()
+        paths = [f"{self.pid}/task/{tid}" for tid in tids]
+        raws = [(path, read_raw_stat(path, self.handles)) for path in paths]
+        self.handles.retain(set(paths))
+        read = time.perf_counter()
+        table = parse_stats(raws)
+        self.read_time += read - start
+        self.parse_time += time.perf_counter() - read
+        return table
+
+    def close(self):
+        self.handles.close_all()
+
+
+class ProcessInfo():
+    """ Metadata of a process that doesn't change while it runs. """
+
+    def __init__(self, pid, starttime):
+        self.pid = pid
+        self.starttime = starttime
+
+        self.cmdline = None
+        try:
+            with open(f"{PROC_ROOT}/{pid}/cmdline", "rb") as f:
+                self.cmdline = f.read().decode("UTF-8", errors="replace").strip("\x00").replace("\x00", " ")
+        except OSError:
+            pass
+
+        self.uid = None
+        self.user = None
+        try:
+            self.uid = os.stat(f"{PROC_ROOT}/{pid}").st_uid
+            self.user = user_name(self.uid)
+        except OSError:
+            pass
+
+
+user_names = {}
+
+
+def user_name(uid):
+    if uid not in user_names:
+        try:
+            user_names[uid] = pwd.getpwuid(uid).pw_name
+        except KeyError:
+            user_names[uid] = str(uid)
+    return user_names[uid]
+
+
+class ProcessInfoCache():
+    """ ProcessInfos by (pid, starttime), so a reused pid gets new ones.
+
+    Infos are only loaded for processes that are actually shown, and are
+    dropped once their process is gone.
+    """
+
+    def __init__(self):
+        self.infos = {}
+
+    def get(self, pid, starttime):
+        key = (pid, starttime)
+        info = self.infos.get(key)
+        if info is None:
+            info = self.infos[key] = ProcessInfo(pid, starttime)
+        return info
+
+    def resolve(self, stat):
+        """ Fills in the metadata of stat. """
+        info = self.get(stat.pid, stat.starttime)
+        stat.cmdline = info.cmdline
+        stat.user = info.user
+
+    def retain(self, table):
+        """ Drops infos of processes that aren't in table anymore. """
+        index = table.index
+        for pid, starttime in list(self.infos):
+            row = index.get(pid)
+            if row is None or table.starttime[row] != starttime:
+                del self.infos[(pid, starttime)]
+
+
+class ProcessIndex():
+    """ The comm, cmdline, user and cgroup of all processes, to find processes by.
+
+    Only kept while there is a filter.  An update reads the metadata of
+    the processes that started since the last one and drops those that
+    exited, and keeps the matches of the query up to date the same way,
+    so only a new query goes over all processes.
+    """
+
+    def __init__(self, metadata=True):
+        """ Without metadata only the names are indexed. """
+        self.metadata = metadata
+        # pid -> (starttime, lowercase text to search)
+        self.texts = {}
+        self.query = None
+        self.matches = set()
+
+    def update(self, table):
+        index, starttime = table.index, table.starttime
+        texts = self.texts
+        exited = [pid for pid, (started, _) in texts.items()
+                  if pid not in index or starttime[index[pid]] != started]
+        for pid in exited:
+            del texts[pid]
+            self.matches.discard(pid)
+
+        for pid, row in index.items():
+            if pid in texts:
+                continue
+            text = self.text(table, row)
+            texts[pid] = (starttime[row], text)
+            if self.query and self.query in text:
+                self.matches.add(pid)
+
+    def text(self, table, row):
+        pid = table.pid[row]
+        parts = [table.tcomm[row]]
+        if self.metadata:
+            info = ProcessInfo(pid, table.starttime[row])
+            parts += [info.cmdline, info.user, cgroup_of(pid)]
+        return "\0".join(part for part in parts if part).lower()
+
+    def search(self, query):
+        """ Returns the pids of the processes that contain query, which is lowercase. """
+        if query != self.query:
+            self.query = query
+            self.matches = {pid for pid, (_, text) in self.texts.items() if query in text}
+        return self.matches
+
+
+class SmapsCache():
+    """ Proportional or unique memory of processes, from their smaps_rollup.
+
+    Reading smaps_rollup makes the kernel walk all page tables of a
+    process, far too slow for all processes every second.  So each
+    refresh only reads as many as fit into budget seconds: first those
+    never read, biggest first, then those with the most resident memory
+    times time since the last read, more so when their resident memory
+    changed since.  In between, the last value is scaled by how much the
+    resident memory changed.
+    """
+
+    UNREADABLE = None
+
+    def __init__(self, mode="pss", budget=None):
+        self.mode = mode
+        self.budget = MEMORY_BUDGET if budget is None else budget
+        # (pid, starttime) -> (bytes, resident pages when read, monotonic time of the read)
+        self.entries = {}
+
+    def read(self, pid):
+        """ Returns the pss or uss of pid in bytes, raises OSError if it can't be read. """
+        with open(f"{PROC_ROOT}/{pid}/smaps_rollup", "rb") as f:
+            content = f.read()
+        pss = uss = 0
+        for line in content.split(b"\n"):
+            if line.startswith(b"Pss:"):
+                pss = int(line.split()[1]) * 1024
+            elif line.startswith((b"Private_Clean:", b"Private_Dirty:")):
+                uss += int(line.split()[1]) * 1024
+        return uss if self.mode == "uss" else pss
+
+    def refresh(self, table):
+        """ Reads the processes of table that need it most, as far as the budget allows. """
+        now = time.monotonic()
+        index = table.index
+        for key in list(self.entries):
+            row = index.get(key[0])
+            if row is None or table.starttime[row] != key[1]:
+                del self.entries[key]
+
+        entries = self.entries
+        candidates = []
+        for row, key in enumerate(zip(table.pid, table.starttime)):
+            resident = table.resident[row]
+            if resident == 0:
+                # kernel threads
+                continue
+            # 0 for never read
+            entry = entries.get(key, 0)
+            if entry is self.UNREADABLE:
+                continue
+            if entry == 0:
+                score = float("inf")
+            else:
+                change = abs(resident - entry[1]) / max(entry[1], 1)
+                score = resident * (now - entry[2]) * (1 + 10 * change)
+            candidates.append((-score, -resident, row))
+        heapq.heapify(candidates)
+
+        deadline = now + self.budget
+        # at least one per refresh, however small the budget
+        while candidates:
+            _, _, row = heapq.heappop(candidates)
+            key = (table.pid[row], table.starttime[row])
+            try:
+                entries[key] = (self.read(key[0]), table.resident[row], time.monotonic())
+            except (OSError, ValueError, IndexError):
+                entries[key] = self.UNREADABLE
+            if time.monotonic() >= deadline:
+                break
+
+    def estimate(self, table, rows):
+        """ Returns the memory of rows in bytes, resident memory for those not read yet. """
+        entries = self.entries
+        pids, starttimes, residents = table.pid, table.starttime, table.resident
+        estimates = []
+        for row in rows:
+            entry = entries.get((pids[row], starttimes[row]))
+            resident = residents[row]
+            if entry and entry[1]:
+                estimates.append(entry[0] * resident / entry[1])
+            else:
+                estimates.append(resident * PAGE_SIZE)
+        return estimates
+
+
+def read_global_cpu():
+    # user + nice + system + idle + iowait + irq + softirq + steal
+    with open(PROC_ROOT+"/stat") as f:
+        global_stat = [int(x) for x in f.readline().strip()[len("cpu  "):].split()]
+        return sum(global_stat[:8])
+
+
+def read_global_mem():
+    # inspired by https://github.com/Alexays/Waybar/blob/600afaf530974c9ef2fec1e61808836712dfde0a/src/modules/memory/common.cpp#L16-L22
+    with open(PROC_ROOT+"/meminfo") as f:
+        mem_total = int(f.readline().strip().split()[1])
+        f.readline() # skip mem_free
+        mem_avail = int(f.readline().strip().split()[1])
+        return (mem_total - mem_avail) * 1024
+
+
+class SystemStats():
+    """ The system wide counters read by SystemScanner, in arrays that are filled in again each sample. """
+
+    # busy, iowait, steal and total jiffies of all cpus, then of each cpu
+    CPU_FIELDS = 4
+
+    def __init__(self, num_cpus):
+        self.timestamp = 0.0
+        self.cpu = array.array('q', bytes(8 * self.CPU_FIELDS * (num_cpus + 1)))
+        # microseconds some and all tasks stalled on cpu, memory and io
+        self.pressure = array.array('q', bytes(8 * 6))
+        self.has_pressure = False
+        # sectors read, sectors written and milliseconds busy per disk
+        self.disks = []
+        self.disk = array.array('q')
+        # pages swapped in and out
+        self.swap = array.array('q', bytes(8 * 2))
+
+
+class SystemScanner():
+    """ Reads the per-cpu lines of /proc/stat, pressure, diskstats and vmstat.
+
+    Like ProcHandles, the files are kept open and read again from offset 0
+    into one buffer, which all of them share.  Files that don't exist,
+    e.g. pressure on kernels without CONFIG_PSI, are left out.
+    """
+
+    FILES = ("stat", "pressure/cpu", "pressure/memory", "pressure/io", "diskstats", "vmstat")
+    # partitions and devices stacked on disks would count their io twice
+    SKIPPED_DISKS = (b"loop", b"ram", b"dm-", b"md")
+
+    def __init__(self):
+        # cpus that are offline now might come online later
+        self.num_cpus = os.cpu_count()
+        self.buf = bytearray(16384)
+        self.fds = {}
+        for name in self.FILES:
+            try:
+                self.fds[name] = os.open(f"{PROC_ROOT}/{name}", os.O_RDONLY | os.O_CLOEXEC)
+            except OSError:
+                pass
+
+    def read(self, name):
+        fd = self.fds.get(name)
+        if fd is None:
+            return b""
+        data, self.buf = pread_file(fd, self.buf)
+        return data
+
+    def scan(self, stats=None):
+        """ Fills in stats, or new SystemStats, and returns them. """
+        if stats is None:
+            stats = SystemStats(self.num_cpus)
+        stats.timestamp = time.monotonic()
+
+        cpu = stats.cpu
+        for line in self.read("stat").split(b"\n"):
+            if not line.startswith(b"cpu"):
+                break
+            fields = line.split()
+            row = 0 if fields[0] == b"cpu" else int(fields[0][3:]) + 1
+            if row > self.num_cpus:
+                continue
+            user, nice, system, idle, iowait, irq, softirq, steal = (int(field) for field in fields[1:9])
+            busy = user + nice + system + irq + softirq + steal
+            start = row * SystemStats.CPU_FIELDS
+            cpu[start:start + SystemStats.CPU_FIELDS] = array.array('q', (busy, iowait, steal,
+                                                                          busy + idle + iowait))
+
+        pressure = stats.pressure
+        for i, name in enumerate(("pressure/cpu", "pressure/memory", "pressure/io")):
+            # some avg10=0.00 avg60=0.00 avg300=0.00 total=0, then the same for full
+            lines = self.read(name).split(b"\n")
+            for j, line in enumerate(lines[:2]):
+                total = line.rfind(b"total=")
+                pressure[2 * i + j] = int(line[total + 6:]) if total >= 0 else 0
+            stats.has_pressure = stats.has_pressure or len(lines) > 1
+
+        disks = []
+        disk = stats.disk
+        n = 0
+        last = None
+        for line in self.read("diskstats").split(b"\n"):
+            fields = line.split()
+            if len(fields) < 13:
+                continue
+            name = fields[2]
+            # partitions follow their disk, e.g. sda1 or nvme0n1p1
+            if name.startswith(self.SKIPPED_DISKS) or (last and name.startswith(last)):
+                continue
+            last = name
+            disks.append(name)
+            values = (int(fields[5]), int(fields[9]), int(fields[12]))
+            if n + 3 > len(disk):
+                disk.extend(values)
+            else:
+                disk[n:n + 3] = array.array('q', values)
+            n += 3
+        del disk[n:]
+        stats.disks = disks
+
+        vmstat = self.read("vmstat")
+        for i, name in enumerate((b"\npswpin ", b"\npswpout ")):
+            start = vmstat.find(name)
+            stats.swap[i] = int(vmstat[start + len(name):vmstat.find(b"\n", start + 1)]) if start >= 0 else 0
+        return stats
+
+    def close(self):
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
+
+
+# rows of the system tab that are bytes per sample, the others are percentages
+SYSTEM_BYTES = {"disk read", "disk written", "swapped in", "swapped out"}
+SYSTEM_DESCRIPTIONS = {
+    "cpu pressure": "time some runnable tasks waited for a cpu",
+    "memory pressure": "time some tasks waited for memory, e.g. reclaim or swap-in",
+    "memory stalled": "time all non-idle tasks waited for memory at once",
+    "io pressure": "time some tasks waited for io",
+    "io stalled": "time all non-idle tasks waited for io at once",
+    "cpu": "busy time of all cpus",
+    "iowait": "time cpus were idle with io outstanding",
+    "steal": "time the hypervisor ran something else",
+    "disk busy": "time the busiest disk had io in flight",
+    "disk read": "bytes read from all disks",
+    "disk written": "bytes written to all disks",
+    "swapped in": "bytes read back from swap",
+    "swapped out": "bytes written to swap",
+}
+
+
+def system_usages(before, after, sample_seconds):
+    """ Returns (name, usage) of the whole system between two SystemStats, in the order they are shown. """
+    elapsed = after.timestamp - before.timestamp
+    # bytes are per sample like those of processes, a shorter one is scaled up
+    factor = sample_seconds / elapsed if elapsed > 0 else 0.0
+
+    usages = []
+    if after.has_pressure:
+        stalled = [max(a - b, 0) / 10000 / elapsed if elapsed > 0 else 0.0
+                   for a, b in zip(after.pressure, before.pressure)]
+        usages += [("cpu pressure", stalled[0]), ("memory pressure", stalled[2]),
+                   ("memory stalled", stalled[3]), ("io pressure", stalled[4]), ("io stalled", stalled[5])]
+
+    fields = SystemStats.CPU_FIELDS
+    deltas = [a - b for a, b in zip(after.cpu, before.cpu)]
+    cpus = []
+    for start in range(0, len(deltas), fields):
+        total = deltas[start + 3]
+        cpus.append([100.0 * delta / total if total > 0 else 0.0 for delta in deltas[start:start + 3]])
+    usages += [("cpu", cpus[0][0]), ("iowait", cpus[0][1]), ("steal", cpus[0][2])]
+
+    read = written = busy = 0
+    if after.disks == before.disks:
+        disk = [a - b for a, b in zip(after.disk, before.disk)]
+        read, written = sum(disk[0::3]) * 512, sum(disk[1::3]) * 512
+        busy = max(disk[2::3], default=0)
+    usages += [("disk busy", min(busy / 10 / elapsed, 100.0) if elapsed > 0 else 0.0),
+               ("disk read", read * factor), ("disk written", written * factor)]
+
+    swap = [(a - b) * PAGE_SIZE * factor for a, b in zip(after.swap, before.swap)]
+    usages += [("swapped in", swap[0]), ("swapped out", swap[1])]
+
+    usages += [(f"cpu{i}", usage[0]) for i, usage in enumerate(cpus[1:])]
+    return usages
+
+
+# inode identifies a socket, 0 if unknown.  snapshots have one per pid, with all it sent and received
+ConnectionInfo = namedtuple("ConnectionInfo",
+                            ["pid", "fd", "bytes_sent", "bytes_received", "inode"], defaults=[0])
+
+
+ss_tip_re = re.compile(
+    r"pid=(\d+),fd=(\d+).*bytes_sent:(\d+).*bytes_received:(\d+)"
+)
+ss_inode_re = re.compile(r" ino:(\d+)")
+
+
+def parse_ss_tip(line):
+    """ Parses lines output by `ss -tipeHOn`. """
+    match = ss_tip_re.search(line)
+    if not match:
+        return None
+
+    inode = ss_inode_re.search(line)
+    return ConnectionInfo(pid=int(match.group(1)), fd=int(match.group(2)),
+                          bytes_sent=int(match.group(3)),
+                          bytes_received=int(match.group(4)),
+                          inode=int(inode.group(1)) if inode else 0)
+
+
+def read_net_per_process_ss():
+    ss_tip = subprocess.run(SS_COMMAND, capture_output=True)
+    return (parse_ss_tip(
+        line.decode("utf-8")) for line in ss_tip.stdout.strip().split(b"\n"))
+
+
+# https://man7.org/linux/man-pages/man7/sock_diag.7.html
+NETLINK_SOCK_DIAG = 4
+SOCK_DIAG_BY_FAMILY = 20
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+INET_DIAG_INFO = 2
+# multicast groups of the sockets being freed, with their final counters
+SKNLGRP_INET_TCP_DESTROY = 1
+SKNLGRP_INET6_TCP_DESTROY = 3
+# everything but SYN_RECV, TIME_WAIT, CLOSE and LISTEN, like `ss` without --all
+TCP_STATES = 0xfff & ~(1 << 3 | 1 << 6 | 1 << 7 | 1 << 10)
+
+nlmsghdr = struct.Struct("=IHHII")
+# family, protocol, ext, states and an all-zero inet_diag_sockid
+inet_diag_req_v2 = struct.Struct("=BBBxI48x")
+# family, state, timer, retrans, inet_diag_sockid (up to its cookie), expires, rqueue, wqueue, uid, inode
+inet_diag_msg = struct.Struct("=BBBB40xQIIIII")
+rtattr = struct.Struct("=HH")
+u64 = struct.Struct("=Q")
+
+# offsets into struct tcp_info, see include/uapi/linux/tcp.h
+TCPI_BYTES_ACKED = 120
+TCPI_BYTES_RECEIVED = 128
+TCPI_BYTES_SENT = 200
+
+
+class SockDiag():
+    """ Reads TCP sockets and their byte counters from the kernel via netlink.
+
+    This returns the same information as `ss --tcp --info --processes`
+    without forking and parsing text.  Sockets are mapped to processes
+    using an inode to (pid, fd) index built from /proc/<pid>/fd, which is
+    only rebuilt when sockets show up that are not in it yet.
+
+    A socket that was closed while its connection is still shutting down
+    has no inode anymore, but keeps its cookie.  Such sockets are still
+    returned as their last owner's, with their final counters.  Sockets
+    that are gone, or only wait in TIME_WAIT, are returned once more
+    with their final counters, too, if we may listen for them being
+    freed, which needs CAP_NET_ADMIN.
+    """
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK,
+                                  socket.SOCK_RAW | socket.SOCK_CLOEXEC,
+                                  NETLINK_SOCK_DIAG)
+        self.buf = bytearray(64 * 1024)
+        self.seq = 0
+
+        self.owners = {}
+        # sockets of processes we can't look into, e.g. of other users
+        self.unowned = set()
+        # cookie -> ConnectionInfo of the sockets in the last dump that had an owner
+        self.cookies = {}
+        # and in the one before, their final counters may only arrive a dump later
+        self.older_cookies = {}
+
+        self.events = socket.socket(socket.AF_NETLINK,
+                                    socket.SOCK_RAW | socket.SOCK_CLOEXEC | socket.SOCK_NONBLOCK,
+                                    NETLINK_SOCK_DIAG)
+        try:
+            # a burst of closed connections shouldn't overflow it between two dumps
+            self.events.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+            self.events.bind((0, 1 << (SKNLGRP_INET_TCP_DESTROY - 1) | 1 << (SKNLGRP_INET6_TCP_DESTROY - 1)))
+        except OSError:
+            self.events.close()
+            self.events = None
+
+    def close(self):
+        self.sock.close()
+        if self.events:
+            self.events.close()
+
+    def dump(self, family, sockets):
+        """ Appends (inode, cookie, bytes_sent, bytes_received) of all TCP sockets of family to sockets. """
+        self.seq += 1
+        req = inet_diag_req_v2.pack(family, socket.IPPROTO_TCP,
+                                    1 << (INET_DIAG_INFO - 1), TCP_STATES)
+        hdr = nlmsghdr.pack(nlmsghdr.size + len(req), SOCK_DIAG_BY_FAMILY,
+                            NLM_F_REQUEST | NLM_F_DUMP, self.seq, 0)
+        self.sock.send(hdr + req)
+
+        buf = self.buf
+        while True:
+            n = self.sock.recv_into(buf)
+            offset = 0
+            while offset < n:
+                msg_len, msg_type, _, seq, _ = nlmsghdr.unpack_from(buf, offset)
+                if seq == self.seq:
+                    if msg_type == NLMSG_DONE:
+                        return
+                    elif msg_type == NLMSG_ERROR:
+                        errno = -struct.unpack_from("=i", buf, offset + nlmsghdr.size)[0]
+                        raise OSError(errno, f"sock_diag: {os.strerror(errno)}")
+                    elif msg_type == SOCK_DIAG_BY_FAMILY:
+                        sockets.append(self.parse(buf, offset, msg_len))
+                offset += (msg_len + 3) & ~3
+
+    def parse(self, buf, offset, msg_len):
+        _, _, _, _, cookie, _, _, _, _, inode = inet_diag_msg.unpack_from(buf, offset + nlmsghdr.size)
+        bytes_sent, bytes_received = 0, 0
+
+        end = offset + msg_len
+        offset += nlmsghdr.size + inet_diag_msg.size
+        while offset + rtattr.size <= end:
+            rta_len, rta_type = rtattr.unpack_from(buf, offset)
+            if rta_len < rtattr.size:
+                break
+            if rta_type == INET_DIAG_INFO:
+                info = offset + rtattr.size
+                info_len = rta_len - rtattr.size
+                if info_len >= TCPI_BYTES_RECEIVED + 8:
+                    bytes_received = u64.unpack_from(buf, info + TCPI_BYTES_RECEIVED)[0]
+                # tcpi_bytes_sent is only available since linux 4.19
+                if info_len >= TCPI_BYTES_SENT + 8:
+                    bytes_sent = u64.unpack_from(buf, info + TCPI_BYTES_SENT)[0]
+                elif info_len >= TCPI_BYTES_ACKED + 8:
+                    bytes_sent = u64.unpack_from(buf, info + TCPI_BYTES_ACKED)[0]
+            offset += (rta_len + 3) & ~3
+
+        return (inode, cookie, bytes_sent, bytes_received)
+
+    def drain(self, sockets):
+        """ Appends (0, cookie, bytes_sent, bytes_received) of the TCP sockets freed since the last drain. """
+        buf = self.buf
+        while True:
+            try:
+                n = self.events.recv_into(buf)
+            except BlockingIOError:
+                return
+            except OSError as ex:
+                # more sockets were freed than fit, the ones after that are still there
+                if ex.errno == ENOBUFS:
+                    continue
+                raise
+            offset = 0
+            while offset < n:
+                msg_len, msg_type, _, _, _ = nlmsghdr.unpack_from(buf, offset)
+                if msg_type == SOCK_DIAG_BY_FAMILY:
+                    sockets.append(self.parse(buf, offset, msg_len))
+                offset += (msg_len + 3) & ~3
+
+    def scan_owners(self):
+        owners = {}
+        for pid in os.listdir(PROC_ROOT):
+            if not pid.isnumeric():
+                continue
+            try:
+                with os.scandir(PROC_ROOT+"/"+pid+"/fd") as fds:
+                    for fd in fds:
+                        try:
+                            target = os.readlink(fd.path)
+                        except OSError:
+                            continue
+                        if target.startswith("socket:["):
+                            owners.setdefault(int(target[8:-1]), (int(pid), int(fd.name)))
+            except OSError:
+                # process exited or belongs to another user
+                continue
+        self.owners = owners
+
+    def connections(self):
+        sockets = []
+        self.dump(socket.AF_INET, sockets)
+        self.dump(socket.AF_INET6, sockets)
+
+        owners = self.owners
+        if any(inode and inode not in owners and inode not in self.unowned for inode, _, _, _ in sockets):
+            self.scan_owners()
+            owners = self.owners
+
+        unowned = set()
+        # only the cookies of the last two dumps are kept, finished connections are forgotten after that
+        cookies, last_cookies = {}, self.cookies
+        for inode, cookie, bytes_sent, bytes_received in sockets:
+            if inode == 0:
+                # closed by its process, but not done yet
+                closed = last_cookies.get(cookie)
+                if closed is not None:
+                    cookies[cookie] = closed._replace(bytes_sent=bytes_sent, bytes_received=bytes_received)
+                continue
+            owner = owners.get(inode)
+            if owner is None:
+                unowned.add(inode)
+                continue
+            cookies[cookie] = ConnectionInfo(pid=owner[0], fd=owner[1],
+                                             bytes_sent=bytes_sent,
+                                             bytes_received=bytes_received,
+                                             inode=inode)
+
+        # after the dump, sockets freed while it ran are in it or in these
+        freed = []
+        if self.events:
+            self.drain(freed)
+        closed = []
+        for _, cookie, bytes_sent, bytes_received in freed:
+            info = cookies.pop(cookie, None) or last_cookies.get(cookie) or self.older_cookies.get(cookie)
+            if info is not None:
+                closed.append(info._replace(bytes_sent=bytes_sent, bytes_received=bytes_received))
+
+        self.unowned = unowned
+        self.older_cookies = last_cookies
+        self.cookies = cookies
+        return list(cookies.values()) + closed
+
+
+sock_diag = None
+
+
+def read_net_per_process():
+    """ Returns a ConnectionInfo for each TCP connection, using netlink if possible. """
+    global NET_BACKEND, sock_diag
+
+    if NET_BACKEND == 'netlink':
+        try:
+            if sock_diag is None:
+                sock_diag = SockDiag()
+            return sock_diag.connections()
+        except OSError as ex:
+            print("Falling back to `ss`, netlink sock_diag failed:", ex)
+            NET_BACKEND = 'ss'
+            if sock_diag:
+                sock_diag.close()
+                sock_diag = None
+
+    return read_net_per_process_ss()
+
+
+class NetCounter():
+    """ Charges what TCP sockets sent and received to the processes owning them.
+
+    Sockets are told apart by their inode, and each is charged only what
+    it sent and received since it was last seen, to whichever process
+    owns it now.  A socket handed to another process doesn't bring its
+    past along, and one that closed is charged up to its final counters,
+    even when they only show up a read after it went missing.
+    """
+
+    def __init__(self):
+        # inode, or pid and fd without one -> bytes sent and received when last seen
+        self.sockets = None
+        self.older_sockets = {}
+        # pid -> bytes sent and received charged so far, of the processes with sockets
+        self.totals = {}
+
+    def update(self, connections):
+        """ Returns a ConnectionInfo per process in connections, with all it was charged so far.
+
+        Sockets in the first connections are not charged what they did before.
+        """
+        last, older = self.sockets, self.older_sockets
+        sockets, totals, charged = {}, {}, self.totals
+        for info in connections:
+            key = info.inode or (info.pid, -info.fd)
+            counters = (info.bytes_sent, info.bytes_received)
+            before = sockets.get(key)
+            if before is None:
+                before = counters if last is None else last.get(key) or older.get(key) or (0, 0)
+            sockets[key] = counters
+
+            total = totals.get(info.pid)
+            if total is None:
+                totals[info.pid] = total = charged.get(info.pid) or [0, 0]
+            total[0] += max(counters[0] - before[0], 0)
+            total[1] += max(counters[1] - before[1], 0)
+
+        self.older_sockets = last or {}
+        self.sockets = sockets
+        # processes without sockets are dropped, after their last ones were charged
+        self.totals = totals
+        return [ConnectionInfo(pid=pid, fd=0, bytes_sent=sent, bytes_received=received)
+                for pid, (sent, received) in totals.items()]
+
+
+net_counter = NetCounter()
+
+
+def read_net_per_pid():
+    """ Returns a ConnectionInfo per process with TCP connections, with all they sent and received so far. """
+    return net_counter.update(info for info in read_net_per_process() if info)
+
+
+class Snapshot():
+    """ The counters of all processes and of the whole system at one point in time. """
+
+    def __init__(self, stats, net, global_cpu, global_mem, timestamp, wall_time=None, num_cpus=None):
+        self.stats = stats
+        self.net = net
+        self.global_cpu = global_cpu
+        self.global_mem = global_mem
+        self.timestamp = timestamp
+        # of the system the snapshot was taken on, which is not this one when replaying
+        self.wall_time = wall_time
+        self.num_cpus = num_cpus
+        self._net_totals = None
+
+    def net_totals(self):
+        """ pid -> bytes sent and received so far. """
+        if self._net_totals is None:
+            # kept, this snapshot is compared to the next one, too.  older
+            # captures have a ConnectionInfo per socket instead of per pid
+            totals = self._net_totals = {}
+            for info in self.net:
+                totals[info.pid] = totals.get(info.pid, 0) + info.bytes_sent + info.bytes_received
+        return self._net_totals
+
+
+def take_snapshot(scanner=None, profiler=None, net=True):
+    """ Reads all processes using scanner, or without keeping any handles open. """
+    scanner = scanner or ProcScanner(max_fds=0)
+    # all processes are read after this, however long that takes
+    timestamp = time.monotonic()
+    wall_time = time.time()
+    global_cpu = read_global_cpu()
+    stats = scanner.scan()
+    if profiler:
+        profiler.lap("scan")
+    net = read_net_per_pid() if net else []
+    global_mem = read_global_mem()
+    if profiler:
+        profiler.lap("net")
+    return Snapshot(stats, net, global_cpu, global_mem, timestamp, wall_time, os.cpu_count())
+
+
+def net_per_pid(before, after):
+    """ Returns the bytes sent and received per pid between two snapshots.
+
+    What each process was charged by NetCounter is compared, a process
+    that had no sockets in before counts with all it was charged.
+    """
+    before_totals = before.net_totals()
+    return {pid: max(total - before_totals.get(pid, 0), 0) for pid, total in after.net_totals().items()}
+
+
+# inspired by https://github.com/scaidermern/top-processes/blob/master/top_proc.c
+def diff_snapshots(before, after, group_by=None, memory=None):
+    """ Returns the Usages of the processes in after that were in before, too.
+
+    group_by is a column of ProcTable, e.g. "tcomm", to add up usages by.
+    memory is a SmapsCache to use instead of resident memory.
+    """
+    global_cpu = after.global_cpu - before.global_cpu
+    global_mem = after.global_mem
+
+    net_stats = net_per_pid(before, after)
+
+    # nothing ran at all between snapshots taken very shortly after another
+    cpu_factor = 100.0 * (after.num_cpus or os.cpu_count()) / global_cpu if global_cpu else 0.0
+    mem_factor = PAGE_SIZE / global_mem * 100
+
+    old, new = before.stats, after.stats
+    old_index = old.index
+    old_utime, old_stime, old_starttime, old_io = old.utime, old.stime, old.starttime, old.io_bytes
+    new_utime, new_stime, new_starttime, new_io = new.utime, new.stime, new.starttime, new.io_bytes
+    new_resident = new.resident
+
+    # matching rows first, then each usage in one go over them.  new
+    # processes, and reused pids, have nothing to compare to yet
+    old_rows = [old_index.get(pid) for pid in new.pid]
+    rows = array.array('q', [row for row, row_before in enumerate(old_rows)
+                             if row_before is not None and old_starttime[row_before] == new_starttime[row]])
+    matched = [old_rows[row] for row in rows]
+
+    cpu = array.array('d', [((new_utime[row] + new_stime[row]) - (old_utime[row_before] + old_stime[row_before]))
+                            * cpu_factor for row, row_before in zip(rows, matched)])
+    if memory is None:
+        mem = array.array('d', [new_resident[row] * mem_factor for row in rows])
+    else:
+        mem = array.array('d', [n * 100 / global_mem for n in memory.estimate(new, rows)])
+    new_pid = new.pid
+    net = array.array('d', [max(net_stats.get(new_pid[row], 0), 0) for row in rows] if net_stats
+                      else bytes(8 * len(rows)))
+    io = array.array('d', [max(new_io[row] - old_io[row_before], 0) for row, row_before in zip(rows, matched)])
+
+    usages = Usages(new, rows, cpu, mem, net, io)
+    if group_by:
+        usages = usages.group(group_by)
+    return usages
+
+
+def process_stats(sample_seconds=1.0, group_by=None, scanner=None):
+    """ Samples all processes twice, sample_seconds apart.
+
+    PIDStatsCollector reuses the previous snapshot instead, this is for
+    one-off measurements.
+    """
+    before = take_snapshot(scanner)
+    time.sleep(sample_seconds)
+    return diff_snapshots(before, take_snapshot(scanner), group_by=group_by)
+
+
+# https://docs.kernel.org/admin-guide/cgroup-v2.html
+CGROUP_MODES = ("cgroup", "unit", "container")
+
+container_re = re.compile(r"^(?:docker-|libpod-|crio-|cri-containerd-)?([0-9a-f]{64})(?:\.scope)?$")
+
+
+class CgroupStat():
+    """ The usage of a cgroup, from the counters the kernel keeps for all its processes. """
+
+    def __init__(self, path, name, cgroup_id, uid, cpu_usec, memory, io_bytes):
+        self.path = path
+        self.tcomm = name
+        # negative, so it can't be mistaken for a process, e.g. when killing
+        self.pid = -cgroup_id
+        self.ppid = 0
+        self.starttime = 0
+        self.cmdline = path
+        self.user = user_name(uid)
+        self.cgroup = path
+
+        self.cpu_usec = cpu_usec
+        self.memory = memory
+        self.io_bytes = io_bytes
+
+    def __repr__(self):
+        return f'CgroupStat("{self.path}")'
+
+
+def find_cgroups(mode, path=None):
+    """ Yields (path, name) of the cgroups to show for mode, relative to CGROUP_ROOT.
+
+    Counters of a cgroup include all cgroups below it, so the walk stops
+    at the first matching unit or container.  In cgroup mode only leaves
+    are shown, as processes only live in those.
+    """
+    path = path or CGROUP_ROOT
+    try:
+        with os.scandir(path) as entries:
+            children = [entry for entry in entries if entry.is_dir(follow_symlinks=False)]
+    except OSError:
+        # removed while walking
+        return
+
+    for child in children:
+        if mode == 'unit' and child.name.endswith((".service", ".scope")) \
+                and not child.name.startswith("user@"):
+            yield child.path, child.name
+            continue
+        if mode == 'container':
+            match = container_re.match(child.name)
+            if match:
+                yield child.path, match.group(1)[:12]
+                continue
+        yield from find_cgroups(mode, child.path)
+
+    if mode == 'cgroup' and not children and path != CGROUP_ROOT:
+        yield path, os.path.relpath(path, CGROUP_ROOT)
+
+
+def read_cgroup(path, name):
+    """ Returns a CgroupStat with the current counters of path, or None if it is gone. """
+    try:
+        info = os.stat(path)
+        with open(path+"/cpu.stat") as f:
+            cpu_usec = int(next(line for line in f if line.startswith("usage_usec")).split()[1])
+    except (OSError, StopIteration):
+        return None
+
+    memory = 0
+    try:
+        with open(path+"/memory.current") as f:
+            memory = int(f.read())
+    except OSError:
+        # memory controller not enabled for this cgroup
+        pass
+
+    io_bytes = 0
+    try:
+        with open(path+"/io.stat") as f:
+            # 8:0 rbytes=1 wbytes=2 rios=3 wios=4 dbytes=0 dios=0
+            for line in f:
+                for field in line.split()[1:]:
+                    if field.startswith(("rbytes=", "wbytes=")):
+                        io_bytes += int(field[7:])
+    except OSError:
+        pass
+
+    return CgroupStat(path, name, info.st_ino, info.st_uid, cpu_usec, memory, io_bytes)
+
+
+def take_cgroup_snapshot(mode):
+    """ Like take_snapshot(), but reads the counters of cgroups instead of all processes. """
+    timestamp = time.monotonic()
+    wall_time = time.time()
+    stats = {}
+    for path, name in find_cgroups(mode):
+        stat = read_cgroup(path, name)
+        if stat:
+            stats[path] = stat
+    net = read_net_per_pid()
+    return Snapshot(stats, net, None, read_global_mem(), timestamp, wall_time, os.cpu_count())
+
+
+def cgroup_of(pid):
+    """ Returns the cgroup v2 path of pid, or None. """
+    try:
+        with open(f"{PROC_ROOT}/{pid}/cgroup") as f:
+            for line in f:
+                if line.startswith("0::"):
+                    return CGROUP_ROOT + line[3:].strip().rstrip("/")
+    except OSError:
+        pass
+    return None
+
+
+def diff_cgroup_snapshots(before, after):
+    """ Returns the Usages of the cgroups in after that were in before, too. """
+    elapsed_usec = (after.timestamp - before.timestamp) * 1_000_000
+
+    # the kernel doesn't count network traffic per cgroup, so it is
+    # attributed using the cgroups of the few processes with connections
+    net_stats = defaultdict(int)
+    for pid, net_bytes in net_per_pid(before, after).items():
+        if net_bytes <= 0:
+            continue
+        path = cgroup_of(pid)
+        while path and len(path) > len(CGROUP_ROOT):
+            if path in after.stats:
+                net_stats[path] += net_bytes
+                break
+            path = os.path.dirname(path)
+
+    table = ProcTable()
+    table.cgroup = []
+    table.user = []
+    cpu, mem, net, io = array.array('d'), array.array('d'), array.array('d'), array.array('d')
+    for path, stat in after.stats.items():
+        stat_before = before.stats.get(path)
+        if stat_before is None:
+            continue
+        table.append(stat.pid, stat.tcomm)
+        table.cgroup.append(path)
+        table.user.append(stat.user)
+        cpu.append((stat.cpu_usec - stat_before.cpu_usec) / elapsed_usec * 100.0)
+        mem.append(stat.memory / after.global_mem * 100)
+        net.append(net_stats[path])
+        io.append(max(stat.io_bytes - stat_before.io_bytes, 0))
+
+    return Usages(table, range(len(table)), cpu, mem, net, io, keys=table.cgroup)
+
+
+def cgroup_pids(path):
+    """ Returns the pids of all processes in path and the cgroups below it. """
+    pids = []
+    for root, _, _ in os.walk(path):
+        try:
+            with open(root+"/cgroup.procs") as f:
+                pids.extend(line.strip() for line in f if line.strip())
+        except OSError:
+            pass
+    return pids
+
+
+METRICS = ("cpu", "mem", "net", "io")
+
+
+def sample_rows(sample):
+    """ Yields (metric, rank, stat, usages) for all ranked entries of sample. """
+    for metric in METRICS:
+        for rank, (stat, usages) in enumerate(getattr(sample, metric)):
+            yield metric, rank, stat, usages
+
+
+class NDJSONWriter():
+    """ Writes one JSON object per sample and line. """
+
+    header = None
+
+    def __init__(self, out):
+        self.out = out
+
+    def __call__(self, sample):
+        line = {"time": round(sample.time, 3)}
+        for metric in METRICS:
+            line[metric] = []
+        for metric, rank, stat, usages in sample_rows(sample):
+            line[metric].append({
+                "pid": stat.pid,
+                "name": stat.tcomm,
+                "usage": usages[-1],
+                "avg": sum(usages) / len(usages),
+                "max": max(usages),
+                "alive": sample.alive_pids[stat.pid],
+            })
+        self.out.write(json.dumps(line) + "\n")
+        self.out.flush()
+
+
+class CSVWriter():
+    """ Writes one row per ranked entry, with metric and rank columns. """
+
+    header = "time,metric,rank,pid,name,usage,avg,max,alive\r\n"
+
+    def __init__(self, out):
+        self.out = out
+        self.writer = csv.writer(out)
+
+    def __call__(self, sample):
+        timestamp = round(sample.time, 3)
+        for metric, rank, stat, usages in sample_rows(sample):
+            self.writer.writerow((timestamp, metric, rank, stat.pid, stat.tcomm,
+                                  usages[-1], sum(usages) / len(usages), max(usages),
+                                  int(sample.alive_pids[stat.pid])))
+        self.out.flush()
+
+
+class RotatingFile():
+    """ A text file that is rotated to path.1, path.2, ... when it gets bigger than max_bytes. """
+
+    def __init__(self, path, max_bytes=0, backup_count=5, header=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.header = header
+        self.open()
+
+    def open(self):
+        self.f = open(self.path, "a", encoding="utf-8", newline="")
+        if self.header and self.f.tell() == 0:
+            self.f.write(self.header)
+
+    def write(self, text):
+        if self.max_bytes > 0 and self.f.tell() + len(text) > self.max_bytes and self.f.tell() > 0:
+            self.rotate()
+        self.f.write(text)
+
+    def flush(self):
+        self.f.flush()
+
+    def rotate(self):
+        self.f.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i+1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.open()
+
+
+class RecordedStat():
+    """ A process read back from a HistoryFile or from an agent, looks enough like a PIDStat for the graphs. """
+
+    def __init__(self, pid, tcomm):
+        self.pid = pid
+        self.tcomm = tcomm
+        self.key = (pid, tcomm)
+        self.alive = True
+        self.cmdline = None
+        self.user = None
+        self.cgroup = None
+
+
+class HistoryFile():
+    """ A round-robin history of the top processes, in a memory-mapped file.
+
+    For each tier in HISTORY_TIERS and each metric there are as many
+    fixed-size records as the tier has buckets.  A record holds the start
+    of its bucket and the top_k processes of that bucket with their
+    average and maximum usage, and is overwritten when its slot comes
+    around again.  Samples are added up in memory until their bucket is
+    over, so writing is one record per tier and metric per bucket, and
+    reading needs no parsing beyond struct.
+
+    The bucket start is written last, so a concurrent reader sees either
+    a complete record or one from outside its time range.
+    """
+
+    MAGIC = b"healthy1"
+    HEADER = struct.Struct("<8sII")
+    TIER = struct.Struct("<II")
+    BUCKET = struct.Struct("<qI4x")
+    ENTRY = struct.Struct("<q16sdd")
+
+    def __init__(self, path, top_k=None, tiers=HISTORY_TIERS):
+        self.top_k = top_k or TOP_K
+        self.tiers = tuple(tuple(tier) for tier in tiers)
+        self.record_size = self.BUCKET.size + self.top_k * self.ENTRY.size
+        self.header = self.HEADER.pack(self.MAGIC, self.top_k, len(self.tiers)) + \
+            b"".join(self.TIER.pack(*tier) for tier in self.tiers)
+
+        self.offsets = []
+        offset = len(self.header)
+        for _, buckets in self.tiers:
+            self.offsets.append(offset)
+            offset += len(METRICS) * buckets * self.record_size
+        size = offset
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            with open(fd, "r+b", closefd=False) as f:
+                if f.read(len(self.header)) != self.header or os.fstat(fd).st_size != size:
+                    # written with other settings, start over
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, size)
+                    f.seek(0)
+                    f.write(self.header)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+        self.lock = threading.Lock()
+        # per tier: [bucket, samples, {metric: {(pid, name): [sum, max]}}]
+        self.pending = [[None, 0, {metric: {} for metric in METRICS}] for _ in self.tiers]
+        # per tier, the last bucket written, to notice when to redraw
+        self.written = [None] * len(self.tiers)
+
+    def __call__(self, sample):
+        """ Adds the current usage of the ranked processes of sample. """
+        with self.lock:
+            for tier, (seconds, _) in enumerate(self.tiers):
+                bucket = int(sample.time // seconds)
+                pending = self.pending[tier]
+                if pending[0] != bucket:
+                    if pending[0] is not None:
+                        self.write(tier, pending)
+                    pending[:] = [bucket, 0, {metric: {} for metric in METRICS}]
+
+                pending[1] += 1
+                for metric in METRICS:
+                    usages = pending[2][metric]
+                    for stat, window in getattr(sample, metric):
+                        if window[-1] <= 0:
+                            continue
+                        usage = usages.setdefault((stat.pid, stat.tcomm), [0, 0])
+                        usage[0] += window[-1]
+                        usage[1] = max(usage[1], window[-1])
+
+    def write(self, tier, pending):
+        bucket, samples, usages = pending
+        seconds, buckets = self.tiers[tier]
+        for m, metric in enumerate(METRICS):
+            top = heapq.nlargest(self.top_k, usages[metric].items(), key=lambda item: item[1][0])
+            offset = self.record_offset(tier, m, bucket % buckets)
+            self.BUCKET.pack_into(self.map, offset, -1, 0)
+            for i, ((pid, name), (total, peak)) in enumerate(top):
+                self.ENTRY.pack_into(self.map, offset + self.BUCKET.size + i * self.ENTRY.size,
+                                     pid, name.encode(errors="replace")[:16], total / samples, peak)
+            self.BUCKET.pack_into(self.map, offset, bucket * seconds, len(top))
+        self.written[tier] = bucket
+
+    def record_offset(self, tier, m, slot):
+        buckets = self.tiers[tier][1]
+        return self.offsets[tier] + (m * buckets + slot) * self.record_size
+
+    def read(self, tier, metric, now=None):
+        """ Returns (bucket start, [(pid, name, avg, max), ...]) of the last buckets, oldest first. """
+        seconds, buckets = self.tiers[tier]
+        m = METRICS.index(metric)
+        now = time.time() if now is None else now
+        # the current bucket isn't written until it is over
+        oldest = (int(now // seconds) - buckets) * seconds
+
+        records = []
+        for slot in range(buckets):
+            offset = self.record_offset(tier, m, slot)
+            start, count = self.BUCKET.unpack_from(self.map, offset)
+            if start < oldest or start >= now:
+                continue
+            entries = []
+            for i in range(count):
+                pid, name, avg, peak = self.ENTRY.unpack_from(self.map, offset + self.BUCKET.size + i * self.ENTRY.size)
+                entries.append((pid, name.rstrip(b"\0").decode(errors="replace"), avg, peak))
+            records.append((start, entries))
+        records.sort(key=lambda record: record[0])
+        return records
+
+    def top(self, tier, metric, k, now=None):
+        """ Returns the k processes with the highest usage in tier, like the lists of a Sample.
+
+        Each is a RecordedStat and its average usage per bucket, oldest first.
+        """
+        seconds, buckets = self.tiers[tier]
+        now = time.time() if now is None else now
+        oldest = int(now // seconds) - buckets
+
+        windows = {}
+        for start, entries in self.read(tier, metric, now):
+            for pid, name, avg, _ in entries:
+                if (pid, name) not in windows:
+                    windows[(pid, name)] = [0] * buckets
+                windows[(pid, name)][start // seconds - oldest] = avg
+
+        top = heapq.nlargest(k, windows.items(), key=lambda item: sum(item[1]))
+        return [(RecordedStat(pid, name), window) for (pid, name), window in top]
+
+    def close(self):
+        self.map.close()
+
+
+def little_endian(values):
+    """ Returns an array of values as they are stored in a capture, which is little-endian. """
+    if sys.byteorder == "big":
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values
+
+
+class CaptureWriter():
+    """ Records every snapshot of a collector, to be replayed with CaptureReader.
+
+    A capture is a header followed by zlib compressed chunks of
+    chunk_snapshots snapshots.  The first snapshot of a chunk is stored
+    whole, each following one as the differences of its columns to the
+    row of the same pid in the one before, and only the names that
+    changed.  Most counters don't change from one second to the next, so
+    that is mostly zeros, which compress well.  A chunk is written once it
+    is full or spans chunk_seconds, so a crash loses at most that much.
+
+    The metadata of processes, e.g. cmdlines, is not recorded.
+    """
+
+    MAGIC = b"hlthcap2"
+    # magic, page size, number of cpus, seconds between snapshots
+    HEADER = struct.Struct("<8sIId")
+    # magic, wall time of the first and last snapshot, snapshots, bytes
+    CHUNK = struct.Struct("<4sddII")
+    CHUNK_MAGIC = b"chnk"
+    # timestamp, wall time, global cpu, global mem, rows, renamed rows, bytes of names, connections
+    RECORD = struct.Struct("<ddqqIIII")
+
+    def __init__(self, path, sample_seconds, chunk_snapshots=60, chunk_seconds=30):
+        self.chunk_snapshots = chunk_snapshots
+        self.chunk_seconds = chunk_seconds
+        self.lock = threading.Lock()
+        self.f = open(path, "wb")
+        self.f.write(self.HEADER.pack(self.MAGIC, PAGE_SIZE, os.cpu_count(), sample_seconds))
+        self.f.flush()
+
+        self.records = []
+        self.first = None
+        self.last = None
+        self.previous = None
+
+    def write(self, snapshot):
+        with self.lock:
+            if self.f is None:
+                return
+            self.records.append(self.encode(snapshot, self.previous))
+            self.previous = snapshot.stats
+            if self.first is None:
+                self.first = snapshot.wall_time
+            self.last = snapshot.wall_time
+            if len(self.records) >= self.chunk_snapshots or self.last - self.first >= self.chunk_seconds:
+                self.write_chunk()
+
+    def encode(self, snapshot, previous):
+        table = snapshot.stats
+        if previous is None:
+            old_rows = [None] * len(table)
+        else:
+            old_index = previous.index
+            old_rows = [old_index.get(pid) for pid in table.pid]
+
+        parts = [None, little_endian(table.pid).tobytes()]
+        for column in ProcTable.COLUMNS[1:]:
+            values = getattr(table, column)
+            if previous is not None:
+                old = getattr(previous, column)
+                values = array.array('q', [value if row is None else value - old[row]
+                                           for value, row in zip(values, old_rows)])
+            parts.append(little_endian(values).tobytes())
+
+        tcomm = table.tcomm
+        renamed = array.array('q', [row for row, old_row in enumerate(old_rows)
+                                    if old_row is None or previous.tcomm[old_row] != tcomm[row]])
+        names = "\0".join(tcomm[row] for row in renamed).encode()
+        parts += [little_endian(renamed).tobytes(), names]
+
+        net = snapshot.net
+        for field in range(len(ConnectionInfo._fields)):
+            parts.append(little_endian(array.array('q', [info[field] for info in net])).tobytes())
+
+        parts[0] = self.RECORD.pack(snapshot.timestamp, snapshot.wall_time, snapshot.global_cpu,
+                                    snapshot.global_mem, len(table), len(renamed), len(names), len(net))
+        return b"".join(parts)
+
+    def write_chunk(self):
+        if self.records:
+            data = zlib.compress(b"".join(self.records), 1)
+            self.f.write(self.CHUNK.pack(self.CHUNK_MAGIC, self.first, self.last, len(self.records), len(data)))
+            self.f.write(data)
+            self.f.flush()
+        self.records = []
+        self.first = self.last = None
+        # each chunk can be read on its own
+        self.previous = None
+
+    def close(self):
+        with self.lock:
+            if self.f is not None:
+                self.write_chunk()
+                self.f.close()
+                self.f = None
+
+
+class CaptureReader():
+    """ Reads a capture written by CaptureWriter, one chunk at a time.
+
+    Only the chunk headers are read upfront, to find the chunk of a time,
+    chunks are decompressed when their snapshots are reached.  A capture
+    that is still being written can be read, too.
+    """
+
+    HEADER = CaptureWriter.HEADER
+    CHUNK = CaptureWriter.CHUNK
+    RECORD = CaptureWriter.RECORD
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDONLY)
+        header = os.pread(self.fd, self.HEADER.size, 0)
+        if len(header) < self.HEADER.size or header[:8] != CaptureWriter.MAGIC:
+            os.close(self.fd)
+            raise ValueError(f"{path} is not a capture")
+        _, self.page_size, self.num_cpus, self.sample_seconds = self.HEADER.unpack(header)
+
+        # (offset, first wall time, last wall time, snapshots, bytes) of each chunk
+        self.chunks = []
+        self.scanned = self.HEADER.size
+        self.refresh()
+
+    def refresh(self):
+        """ Finds the chunks written since the last refresh. """
+        while True:
+            header = os.pread(self.fd, self.CHUNK.size, self.scanned)
+            if len(header) < self.CHUNK.size:
+                return
+            magic, first, last, count, length = self.CHUNK.unpack(header)
+            if magic != CaptureWriter.CHUNK_MAGIC:
+                raise ValueError(f"corrupt chunk at {self.scanned}")
+            offset = self.scanned + self.CHUNK.size
+            if os.fstat(self.fd).st_size < offset + length:
+                # still being written
+                return
+            self.chunks.append((offset, first, last, count, length))
+            self.scanned = offset + length
+
+    @property
+    def start(self):
+        return self.chunks[0][1] if self.chunks else None
+
+    @property
+    def end(self):
+        return self.chunks[-1][2] if self.chunks else None
+
+    def __len__(self):
+        return sum(chunk[3] for chunk in self.chunks)
+
+    def snapshots(self, start=None):
+        """ Yields the snapshots from wall time start on, or all of them. """
+        i = 0
+        if start is not None:
+            i = bisect.bisect_left([chunk[2] for chunk in self.chunks], start)
+        while True:
+            if i == len(self.chunks):
+                self.refresh()
+                if i == len(self.chunks):
+                    return
+            for snapshot in self.read_chunk(i):
+                if start is None or snapshot.wall_time >= start:
+                    yield snapshot
+            i += 1
+
+    def read_chunk(self, i):
+        """ Yields the snapshots of the i-th chunk. """
+        start, _, _, count, length = self.chunks[i]
+        data = memoryview(zlib.decompress(os.pread(self.fd, length, start)))
+        offset = 0
+
+        def take(n):
+            nonlocal offset
+            values = array.array('q')
+            values.frombytes(data[offset:offset + 8 * n])
+            offset += 8 * n
+            return little_endian(values)
+
+        previous = None
+        for _ in range(count):
+            timestamp, wall_time, global_cpu, global_mem, rows, renamed, names_length, connections = \
+                self.RECORD.unpack_from(data, offset)
+            offset += self.RECORD.size
+
+            table = ProcTable()
+            table.pid = take(rows)
+            if previous is None:
+                old_rows = [None] * rows
+            else:
+                old_index = previous.index
+                old_rows = [old_index.get(pid) for pid in table.pid]
+            for column in ProcTable.COLUMNS[1:]:
+                values = take(rows)
+                if previous is not None:
+                    old = getattr(previous, column)
+                    values = array.array('q', [value if row is None else value + old[row]
+                                               for value, row in zip(values, old_rows)])
+                setattr(table, column, values)
+
+            tcomm = [None if row is None else previous.tcomm[row] for row in old_rows]
+            renamed_rows = take(renamed)
+            names = bytes(data[offset:offset + names_length]).decode().split("\0")
+            offset += names_length
+            for row, name in zip(renamed_rows, names):
+                tcomm[row] = name
+            table.tcomm = tcomm
+
+            net = list(map(ConnectionInfo, *(take(connections) for _ in ConnectionInfo._fields)))
+            previous = table
+            yield Snapshot(table, net, global_cpu, global_mem, timestamp, wall_time, self.num_cpus)
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Replay():
+    """ Plays back the snapshots of a capture at the pace they were taken, or speed times as fast.
+
+    The collector takes its snapshots from next() instead of /proc.
+    Pausing, seeking and changing the speed work from any thread, after
+    a seek jumped is set so the collector doesn't diff across the gap.
+    """
+
+    def __init__(self, reader, speed=1.0, hold=False):
+        """ A speed of 0 plays as fast as possible.  With hold, waits for a seek at the end. """
+        self.reader = reader
+        self.speed = speed
+        self.hold = hold
+        self.paused = False
+        self.stopped = False
+        self.jumped = False
+
+        self.changed = threading.Condition()
+        self.seek_to = None
+        self.pending = None
+        self.snapshots = reader.snapshots()
+        # (wall time in the capture, monotonic time) the pace is kept from
+        self.anchor = None
+
+    def seek(self, wall_time):
+        with self.changed:
+            self.seek_to = wall_time
+            self.changed.notify()
+
+    def pause(self, paused=True):
+        with self.changed:
+            self.paused = paused
+            self.anchor = None
+            self.changed.notify()
+
+    def set_speed(self, speed):
+        with self.changed:
+            self.speed = speed
+            self.anchor = None
+            self.changed.notify()
+
+    def stop(self):
+        with self.changed:
+            self.stopped = True
+            self.changed.notify()
+
+    def next(self):
+        """ Returns the next snapshot once it is due, or None at the end or when stopped. """
+        with self.changed:
+            while not self.stopped:
+                if self.seek_to is not None:
+                    self.snapshots = self.reader.snapshots(self.seek_to)
+                    self.seek_to = None
+                    self.pending = None
+                    self.anchor = None
+                    self.jumped = True
+                if self.pending is None:
+                    self.pending = next(self.snapshots, None)
+                    if self.pending is None:
+                        if not self.hold:
+                            return None
+                        self.changed.wait()
+                        continue
+                if self.paused:
+                    self.changed.wait()
+                    continue
+
+                wall_time = self.pending.wall_time
+                if self.anchor is None or self.speed <= 0:
+                    self.anchor = (wall_time, time.monotonic())
+                delay = self.anchor[1] + (wall_time - self.anchor[0]) / (self.speed or 1) - time.monotonic()
+                if delay > 0:
+                    self.changed.wait(delay)
+                    continue
+
+                snapshot, self.pending = self.pending, None
+                return snapshot
+        return None
+
+
+class MetricsExporter():
+    """ Serves the last sample in the OpenMetrics text format over http.
+
+    The response is rendered once per sample and kept, so a scrape only
+    copies bytes and never reads /proc.  Top processes are labeled by
+    rank and name, the pid is a value of its own, so that short-lived
+    processes don't add series for every pid.
+    """
+
+    CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+    FAMILIES = {
+        "cpu": ("cpu_percent", "CPU usage in percent of one core"),
+        "mem": ("memory_percent", "{memory} memory in percent of all memory"),
+        "net": ("network_bytes_per_second", "TCP traffic sent and received"),
+        "io": ("io_bytes_per_second", "Bytes read from and written to storage"),
+    }
+
+    # what MEMORY_MODE measures
+    MEMORY_KINDS = {"rss": "Resident", "pss": "Proportional", "uss": "Unique"}
+
+    def __init__(self, address, memory_mode="rss"):
+        """ memory_mode is the MEMORY_MODE of the collector, replays only have resident memory. """
+        self.address = address
+        self.memory = self.MEMORY_KINDS.get(memory_mode, "Resident")
+        self.body = b"# EOF\n"
+
+    def __call__(self, sample):
+        self.body = self.render(sample).encode()
+
+    def render(self, sample):
+        lines = []
+        lines.append("# TYPE healthy_sample_timestamp_seconds gauge")
+        lines.append(f"healthy_sample_timestamp_seconds {sample.time:.3f}")
+
+        lines.append("# TYPE healthy_top_pid gauge")
+        lines.append("# HELP healthy_top_pid The pid of the process at a rank.")
+        for metric in METRICS:
+            for rank, (stat, _) in enumerate(getattr(sample, metric)):
+                lines.append(f'healthy_top_pid{{metric="{metric}",rank="{rank}"}} {stat.pid}')
+
+        for metric in METRICS:
+            family, help_text = self.FAMILIES[metric]
+            help_text = help_text.format(memory=self.memory)
+            lines.append(f"# TYPE healthy_top_{family} gauge")
+            lines.append(f"# HELP healthy_top_{family} {help_text}, of the top processes.")
+            for rank, (stat, usages) in enumerate(getattr(sample, metric)):
+                lines.append(f'healthy_top_{family}{{rank="{rank}",name="{escape_label(stat.tcomm)}"}} '
+                             f'{usages[-1]:g}')
+
+            if sample.totals:
+                lines.append(f"# TYPE healthy_group_{family} gauge")
+                lines.append(f"# HELP healthy_group_{family} {help_text}, of all processes by name.")
+                for name, usage in sample.totals[metric].items():
+                    lines.append(f'healthy_group_{family}{{name="{escape_label(name)}"}} {usage:g}')
+
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def serve(self):
+        """ Listens on host:port or unix:path in a background thread. """
+        # only imported when serving, they take a while to import
+        import http.server
+        import socketserver
+
+        exporter = self
+
+        class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+            daemon_threads = True
+
+            def get_request(self):
+                request, _ = super().get_request()
+                # the request handler expects a (host, port) like address
+                return request, ("unix", 0)
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = exporter.body
+                self.send_response(200)
+                self.send_header("Content-Type", exporter.CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        if self.address.startswith("unix:"):
+            path = self.address[len("unix:"):]
+            remove_socket(path)
+            self.server = UnixHTTPServer(path, Handler)
+        else:
+            host, _, port = self.address.rpartition(":")
+            self.server = http.server.ThreadingHTTPServer((host or "127.0.0.1", int(port)), Handler)
+            self.server.daemon_threads = True
+
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def start_metrics_exporter(address, replay=False):
+    """ Returns a serving MetricsExporter for address, or None if there is none. """
+    if not address:
+        return None
+    exporter = MetricsExporter(address, memory_mode="rss" if replay else MEMORY_MODE)
+    exporter.serve()
+    return exporter
+
+
+def socket_address(address):
+    """ Returns the family and address of [host:]port or unix:path. """
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+
+def remove_socket(path):
+    """ Removes the socket a previous run left at path, refuses to remove anything else. """
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not S_ISSOCK(mode):
+        raise FileExistsError(f"{path} exists and is not a socket")
+    os.remove(path)
+
+
+# the messages between agents and an aggregator, each framed by its type and length
+AGENT_FRAME = struct.Struct("<BI")
+AGENT_HELLO, AGENT_CYCLE = 1, 2
+# magic, seconds between samples, bytes of the name of the host
+AGENT_HELLO_HEADER = struct.Struct("<8sdH")
+AGENT_MAGIC = b"hlthagt1"
+# new keys, rows, dead keys, forgotten keys
+AGENT_CYCLE_HEADER = struct.Struct("<IIII")
+# id, pid, bytes of name, user and cmdline
+AGENT_KEY = struct.Struct("<IqHHH")
+# frames bigger than this are from something else
+AGENT_MAX_FRAME = 16 << 20
+
+
+class AgentStream():
+    """ Streams the samples of this host to an aggregator, see Aggregator.
+
+    Per sample only the keys whose latest usages changed since the last
+    sample are sent, the aggregator keeps the others.  A key is sent with
+    its name once, after that it is referred to by a number, until it
+    drops out of the top keys.  Sending happens in a background thread that always
+    sends the latest sample: when the aggregator or the network can't
+    keep up, samples in between are skipped instead of queued, and the
+    collector never waits.  Lost connections are retried with backoff,
+    and all keys sent again.
+    """
+
+    def __init__(self, address, name=None, sample_seconds=1.0, timeout=10):
+        self.address = address
+        self.name = name or AGENT_NAME
+        self.sample_seconds = sample_seconds
+        self.timeout = timeout
+
+        self.pending = None
+        self.changed = threading.Condition()
+        self.stopped = False
+        self.sent = 0
+        self.skipped = 0
+
+    def __call__(self, sample):
+        with self.changed:
+            if self.pending is not None:
+                self.skipped += 1
+            self.pending = sample
+            self.changed.notify()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.changed:
+            self.stopped = True
+            self.changed.notify()
+
+    def run(self):
+        backoff = 1
+        while not self.stopped:
+            family, address = socket_address(self.address)
+            try:
+                with socket.socket(family, socket.SOCK_STREAM) as sock:
+                    sock.settimeout(self.timeout)
+                    sock.connect(address)
+                    backoff = 1
+                    self.stream(sock)
+            except OSError as ex:
+                print(f"agent: sending to {self.address} failed, retrying in {backoff}s: {ex}")
+            with self.changed:
+                self.changed.wait_for(lambda: self.stopped, backoff)
+            backoff = min(backoff * 2, 30)
+
+    def stream(self, sock):
+        name = self.name.encode()
+        sock.sendall(self.frame(AGENT_HELLO, AGENT_HELLO_HEADER.pack(AGENT_MAGIC, self.sample_seconds,
+                                                                     len(name)) + name))
+        # key -> id of the keys the aggregator knows on this connection, the dead
+        # ones, and key -> the usages it has of them
+        ids = {}
+        dead = set()
+        next_id = itertools.count()
+        sent = {}
+        while True:
+            with self.changed:
+                self.changed.wait_for(lambda: self.pending is not None or self.stopped)
+                if self.stopped:
+                    return
+                sample, self.pending = self.pending, None
+            sock.sendall(self.frame(AGENT_CYCLE, self.encode(sample, ids, dead, next_id, sent)))
+            self.sent += 1
+
+    def frame(self, kind, payload):
+        return AGENT_FRAME.pack(kind, len(payload)) + payload
+
+    def encode(self, sample, ids, dead, next_id, sent):
+        """ Returns the cycle of sample, and updates the keys and usages known on the connection. """
+        labels = {}
+        latest = defaultdict(lambda: [0.0] * len(METRICS))
+        for i, metric in enumerate(METRICS):
+            for stat, window in getattr(sample, metric):
+                labels[stat.key] = stat
+                if window[-1]:
+                    latest[stat.key][i] = window[-1]
+        # all zeros is how a key that had usages goes back to none
+        usages = {key: latest[key] for key in labels if latest[key] != sent.get(key, [0.0] * len(METRICS))}
+        sent.update(usages)
+
+        new = []
+        for key, stat in labels.items():
+            if key not in ids:
+                ids[key] = next(next_id)
+                new.append((ids[key], stat))
+        forgotten = [ids.pop(key) for key in list(ids) if key not in labels]
+        for key in list(sent):
+            if key not in labels or not any(sent[key]):
+                del sent[key]
+        died = [ids[key] for key, stat in labels.items()
+                if not sample.alive_pids[stat.pid] and key not in dead]
+        dead.intersection_update(labels)
+        dead.update(key for key, stat in labels.items() if not sample.alive_pids[stat.pid])
+
+        parts = [AGENT_CYCLE_HEADER.pack(len(new), len(usages), len(died), len(forgotten))]
+        for key_id, stat in new:
+            name, user, cmdline = ((value or "").encode()[:0xffff] for value in (stat.tcomm, stat.user, stat.cmdline))
+            parts += [AGENT_KEY.pack(key_id, stat.pid, len(name), len(user), len(cmdline)), name, user, cmdline]
+        parts.append(little_endian(array.array('q', [ids[key] for key in usages])).tobytes())
+        parts.append(little_endian(array.array('d', [value for values in usages.values() for value in values]))
+                     .tobytes())
+        parts.append(little_endian(array.array('q', died)).tobytes())
+        parts.append(little_endian(array.array('q', forgotten)).tobytes())
+        return b"".join(parts)
+
+
+class AgentHost():
+    """ What an Aggregator knows of one agent, with a History per metric. """
+
+    def __init__(self, name, num_samples):
+        self.name = name
+        self.sample_seconds = None
+        # id -> RecordedStat of the keys of the current connection
+        self.labels = {}
+        self.connections = 0
+        # id -> latest usages, agents only send those that changed
+        self.usages = {}
+        # (monotonic time, {label: usages}) of the latest cycle
+        self.latest = None
+        max_keys = TOP_K * min(num_samples, 60)
+        self.histories = [History(num_samples, max_keys) for _ in METRICS]
+
+
+class Aggregator():
+    """ Merges the samples that agents stream into one ranking across hosts.
+
+    Each host has a History per metric, that is advanced on the
+    aggregator's own clock with the latest usages its agent sent, so all
+    windows line up.  A host that stops sending fades out like any
+    process that stops using something.  The top keys of all hosts are
+    ranked together into a Sample, so everything that shows or writes
+    samples works with a fleet, too.
+    """
+
+    def __init__(self, address, sample_seconds, consumers=()):
+        self.address = address
+        self.sample_seconds = sample_seconds
+        self.num_samples = int(60 / sample_seconds)
+        self.consumers = list(consumers)
+        self.hosts = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        # the ui profiles the collector, there is not much to profile here
+        self.profiler = None
+
+    def serve(self):
+        """ Accepts agents on host:port or unix:path in a background thread. """
+        import socketserver
+
+        aggregator = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    aggregator.receive(self.rfile)
+                except (OSError, ValueError, struct.error) as ex:
+                    print(f"aggregator: dropping agent {self.client_address}: {ex}")
+
+        family, address = socket_address(self.address)
+        if family == socket.AF_UNIX:
+            remove_socket(address)
+            self.server = socketserver.ThreadingUnixStreamServer(address, Handler, bind_and_activate=False)
+        else:
+            self.server = socketserver.ThreadingTCPServer(address, Handler, bind_and_activate=False)
+            # agents reconnect right away when the aggregator is restarted
+            self.server.allow_reuse_address = True
+        self.server.daemon_threads = True
+        try:
+            self.server.server_bind()
+            self.server.server_activate()
+        except OSError:
+            self.server.server_close()
+            raise
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def read_frame(self, f):
+        header = f.read(AGENT_FRAME.size)
+        if len(header) < AGENT_FRAME.size:
+            return None, None
+        kind, length = AGENT_FRAME.unpack(header)
+        if length > AGENT_MAX_FRAME:
+            raise ValueError(f"frame of {length} bytes")
+        payload = f.read(length)
+        if len(payload) < length:
+            return None, None
+        return kind, payload
+
+    def receive(self, f):
+        """ Reads the frames of one agent connection until it is closed. """
+        kind, payload = self.read_frame(f)
+        if kind is None:
+            return
+        if kind != AGENT_HELLO:
+            raise ValueError("not an agent")
+        magic, sample_seconds, name_length = AGENT_HELLO_HEADER.unpack_from(payload)
+        if magic != AGENT_MAGIC or sample_seconds <= 0:
+            raise ValueError("not an agent")
+        name = payload[AGENT_HELLO_HEADER.size:AGENT_HELLO_HEADER.size + name_length].decode(errors="replace")
+
+        with self.lock:
+            host = self.hosts.get(name)
+            if host is None:
+                host = self.hosts[name] = AgentHost(name, self.num_samples)
+            host.sample_seconds = sample_seconds
+            host.labels = {}
+            host.usages = {}
+            host.connections += 1
+        try:
+            while True:
+                kind, payload = self.read_frame(f)
+                if kind is None:
+                    return
+                if kind == AGENT_CYCLE:
+                    self.apply(host, payload)
+        finally:
+            with self.lock:
+                host.connections -= 1
+
+    def apply(self, host, payload):
+        new, rows, died, forgotten = AGENT_CYCLE_HEADER.unpack_from(payload)
+        offset = AGENT_CYCLE_HEADER.size
+        labels = []
+        for _ in range(new):
+            key_id, pid, name_length, user_length, cmdline_length = AGENT_KEY.unpack_from(payload, offset)
+            offset += AGENT_KEY.size
+            name, user, cmdline = (payload[start:start + length].decode(errors="replace") for start, length in (
+                (offset, name_length), (offset + name_length, user_length),
+                (offset + name_length + user_length, cmdline_length)))
+            offset += name_length + user_length + cmdline_length
+
+            label = RecordedStat(pid, f"{name}@{host.name}")
+            label.user = user or None
+            label.cmdline = cmdline or None
+            label.key = (host.name, pid, name)
+            labels.append((key_id, label))
+
+        def take(typecode, n):
+            nonlocal offset
+            values = array.array(typecode)
+            values.frombytes(payload[offset:offset + 8 * n])
+            offset += 8 * n
+            return little_endian(values)
+
+        row_ids = take('q', rows)
+        values = take('d', rows * len(METRICS))
+        died_ids = take('q', died)
+        forgotten_ids = take('q', forgotten)
+
+        # bytes are per sample, which may be longer or shorter on the agent
+        factor = self.sample_seconds / host.sample_seconds
+        with self.lock:
+            host.labels.update(labels)
+            for key_id in died_ids:
+                if key_id in host.labels:
+                    host.labels[key_id].alive = False
+            usages = host.usages
+            for i, key_id in enumerate(row_ids):
+                usage = values[i * len(METRICS):(i + 1) * len(METRICS)]
+                if any(usage):
+                    usages[key_id] = [usage[0], usage[1], usage[2] * factor, usage[3] * factor]
+                else:
+                    usages.pop(key_id, None)
+            for key_id in forgotten_ids:
+                host.labels.pop(key_id, None)
+                usages.pop(key_id, None)
+            host.latest = (time.monotonic(), {host.labels[key_id]: usage for key_id, usage in usages.items()
+                                              if key_id in host.labels})
+
+    def start(self):
+        self.serve()
+        self.bg_thread = threading.Thread(target=self.update, daemon=True)
+        self.bg_thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def update(self):
+        next_sample = time.monotonic() + self.sample_seconds
+        while not self.stopped.wait(max(next_sample - time.monotonic(), 0)):
+            next_sample += self.sample_seconds
+            sample = self.sample()
+            for consumer in self.consumers:
+                consumer(sample)
+
+    def sample(self):
+        """ Advances the histories of all hosts and returns the top keys across them. """
+        now = time.monotonic()
+        with self.lock:
+            for name, host in list(self.hosts.items()):
+                for history in host.histories:
+                    history.advance()
+                # a late cycle is used twice rather than counted as nothing
+                if host.latest and now - host.latest[0] < 2 * max(self.sample_seconds, host.sample_seconds):
+                    for label, usage in host.latest[1].items():
+                        for history, value in zip(host.histories, usage):
+                            history.append(label.key, value, label=label)
+                if not host.connections and not any(len(history) for history in host.histories):
+                    del self.hosts[name]
+
+            top = []
+            for i in range(len(METRICS)):
+                candidates = [(host.histories[i], key) for host in self.hosts.values()
+                              for key in host.histories[i].top(TOP_K)]
+                ranked = heapq.nlargest(TOP_K, candidates, key=lambda candidate: candidate[0].sum(candidate[1]))
+                top.append([(history.labels[key], history.window(key)) for history, key in ranked])
+
+        alive_pids = defaultdict(lambda: False)
+        for metric in top:
+            for label, _ in metric:
+                # pids of different hosts can collide, alive wins
+                alive_pids[label.pid] = alive_pids[label.pid] or label.alive
+        return Sample(time=time.time(), cpu=top[0], mem=top[1], net=top[2], io=top[3], alive_pids=alive_pids)
+
+    def close(self):
+        self.stop()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def run_headless(args):
+    global PAGE_SIZE
+    PAGE_SIZE = read_page_size()
+
+    if args.agent:
+        # agents only stream their samples, see Aggregator
+        agent = AgentStream(args.agent, sample_seconds=args.interval)
+        agent.start()
+        consumers = [agent]
+    else:
+        writer_class = CSVWriter if args.format == 'csv' else NDJSONWriter
+        if args.output:
+            out = RotatingFile(args.output, args.max_bytes, args.backup_count,
+                               header=writer_class.header)
+        else:
+            out = sys.stdout
+            if writer_class.header:
+                out.write(writer_class.header)
+        consumers = [writer_class(out)]
+
+    # the history file is for the ui, only kept headless when asked for
+    if os.getenv('HISTORY_FILE') and not args.replay:
+        consumers.append(HistoryFile(HISTORY_FILE))
+    exporter = start_metrics_exporter(args.metrics, replay=bool(args.replay))
+    if exporter:
+        consumers.append(exporter)
+
+    interval, replay = args.interval, None
+    if args.replay:
+        reader = CaptureReader(args.replay)
+        PAGE_SIZE, interval = reader.page_size, reader.sample_seconds
+        replay = Replay(reader, args.speed)
+
+    if args.aggregate:
+        collector = Aggregator(args.aggregate, interval, consumers=consumers)
+        collector.serve()
+    else:
+        collector = PIDStatsCollector(interval, consumers=consumers, totals=exporter is not None, replay=replay)
+        if args.record:
+            collector.capture = CaptureWriter(args.record, interval)
+        if args.profile:
+            collector.profiler = Profiler()
+
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt()
+
+    # stopping the service or closing the terminal finishes up like ctrl+c
+    for signum in (signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, interrupt)
+    try:
+        collector.update()
+    except KeyboardInterrupt:
+        pass
+    except BrokenPipeError:
+        # e.g. `healthy --headless | head`, keep python from complaining on exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    finally:
+        if args.record and collector.capture:
+            collector.capture.close()
+        if collector.profiler:
+            sys.stderr.write(collector.profiler.report())
+
+
+def read_page_size():
+    return os.sysconf("SC_PAGE_SIZE")
+
+
+def on_key_press(widget, event):
+    alt = event.state & Gdk.ModifierType.MOD1_MASK
+    if alt and event.keyval == Gdk.KEY_1:
+        widget.set_current_page(0)
+    elif alt and event.keyval == Gdk.KEY_2:
+        widget.set_current_page(1)
+    elif alt and event.keyval == Gdk.KEY_3:
+        widget.set_current_page(2)
+    elif alt and event.keyval == Gdk.KEY_4:
+        widget.set_current_page(3)
+    elif alt and event.keyval == Gdk.KEY_5:
+        widget.set_current_page(4)
+
+
+class ProfileView(Gtk.ScrolledWindow if Gtk else object):
+    """ The hidden "Self" tab, shows what healthy itself costs. """
+
+    def __init__(self, collector):
+        Gtk.ScrolledWindow.__init__(self)
+        self.collector = collector
+        self.label = Gtk.Label()
+        self.label.set_xalign(0)
+        self.label.set_yalign(0)
+        self.label.set_selectable(True)
+        self.add(self.label)
+
+    def show_sample(self, sample, history_file=None, tier=None):
+        if self.collector.profiler:
+            self.label.set_markup(f"<tt>{GLib.markup_escape_text(self.collector.profiler.report())}</tt>")
+
+
+class SystemView(Gtk.ScrolledWindow if Gtk else object):
+    """ The "System" tab, the pressure and counters of the whole system. """
+
+    def __init__(self, sample_seconds):
+        Gtk.ScrolledWindow.__init__(self)
+        self.num_samples = int(60 / sample_seconds)
+        self.box = Gtk.Box(orientation="vertical")
+        self.add(self.box)
+        # name -> Graph, added as the rows first show up
+        self.graphs = {}
+        self.shown = None
+
+    def show_sample(self, sample, history_file=None, tier=None):
+        # the history file only has processes
+        if not sample.system or self.shown == sample.time:
+            return
+        self.shown = sample.time
+
+        for name, window in sample.system:
+            graph = self.graphs.get(name)
+            if graph is None:
+                new_graph = BytesGraph if name in SYSTEM_BYTES else CPUGraph
+                graph = self.graphs[name] = new_graph(self.num_samples, name, window)
+                graph.actions = False
+                self.box.pack_start(graph, False, True, 5)
+                graph.show_all()
+            elif graph.usage == window:
+                continue
+
+            graph.update_usage(window)
+            graph.update_labels()
+            graph.label.set_tooltip_text(SYSTEM_DESCRIPTIONS.get(name, f"busy time of {name}"))
+            graph.drawing_area.queue_draw()
+
+
+class LazyTab(Gtk.Box if Gtk else object):
+    """ A tab that only builds its content once it is first shown. """
+
+    def __init__(self, build):
+        Gtk.Box.__init__(self)
+        self.build = build
+        self.content = None
+        self.connect("map", lambda tab: self.ensure_content())
+
+    def ensure_content(self):
+        if self.content is None:
+            self.content = self.build()
+            self.pack_start(self.content, True, True, 0)
+            self.content.show_all()
+        return self.content
+
+    def show_sample(self, sample, history_file=None, tier=None):
+        self.ensure_content().show_sample(sample, history_file, tier)
+
+
+class Healthy:
+    # seconds until the first sample, the others are a whole sample apart
+    FIRST_SAMPLE = 0.2
+
+    def __init__(self, metrics_address=None, profile=False, record=None, replay=None, speed=1.0,
+                 aggregate=None):
+        """ record and replay are paths of captures, see CaptureWriter, aggregate an address to take agents on. """
+        self.metrics_address = metrics_address
+        self.profile = profile
+        self.record = record
+        self.replay_path = replay
+        self.speed = speed
+        self.aggregate = aggregate
+        # only set in the primary instance, a second launch just activates that
+        self.collector = None
+
+    def on_startup(self, app):
+        global PAGE_SIZE
+        PAGE_SIZE = read_page_size()
+
+        self.win = Gtk.ApplicationWindow(application=app)
+        self.win.set_keep_above(True)
+
+        sample_seconds = 1.0
+        self.replay = None
+        self.seek_scale = None
+        if self.replay_path:
+            reader = CaptureReader(self.replay_path)
+            PAGE_SIZE, sample_seconds = reader.page_size, reader.sample_seconds
+            # stays at the end, to seek back from there
+            self.replay = Replay(reader, self.speed, hold=True)
+            self.win.set_title(f"healthy: {os.path.basename(self.replay_path)}")
+
+        self.sample = None
+        # None shows the last minute as sampled, others a tier of the history file
+        self.tier = None
+
+        def update_graphs(sample):
+            self.sample = sample
+            GLib.idle_add(self.show_sample)
+
+        consumers = [update_graphs]
+        self.history_file = None
+        if HISTORY_FILE and not (self.replay or self.aggregate):
+            try:
+                self.history_file = HistoryFile(HISTORY_FILE)
+                consumers.append(self.history_file)
+            except OSError as ex:
+                print(f"not keeping history in {HISTORY_FILE}: {ex}")
+
+        exporter = start_metrics_exporter(self.metrics_address, replay=bool(self.replay))
+        if exporter:
+            consumers.append(exporter)
+
+        # collecting starts before any widget is built, the first sample comes in the meantime
+        if self.aggregate:
+            self.collector = Aggregator(self.aggregate, sample_seconds, consumers=consumers)
+        else:
+            self.collector = PIDStatsCollector(sample_seconds, consumers=consumers, totals=exporter is not None,
+                                               bursts=True, replay=self.replay,
+                                               first_sample=None if self.replay else self.FIRST_SAMPLE,
+                                               system=True)
+            if self.record:
+                self.collector.capture = CaptureWriter(self.record, sample_seconds)
+            if self.profile:
+                self.collector.profiler = Profiler()
+        self.collector.start()
+
+        # replayed and remote processes can't be killed or looked into
+        actions = not (self.replay or self.aggregate)
+
+        def graphs(metric, new_graph):
+            return lambda: GraphCollection(sample_seconds, metric, new_graph=new_graph, actions=actions)
+
+        # hidden or minimized windows aren't updated, they catch up when shown
+        self.win.connect("map-event", lambda window, event: self.show_sample())
+        self.win.connect("window-state-event", lambda window, event: self.show_sample())
+
+        if os.getenv('ONLY_CPU'):
+            self.visible_graphs = graphs("cpu", CPUGraph)()
+            self.win.add(self.visible_graphs)
+        else:
+            notebook = Gtk.Notebook()
+            notebook.connect("key-press-event", on_key_press)
+            # only the visible tab is built, the others when they are first shown
+            for label, metric, new_graph in (("CPU", "cpu", CPUGraph), ("Memory", "mem", CPUGraph),
+                                             ("Network", "net", BytesGraph), ("IO", "io", BytesGraph)):
+                notebook.append_page(LazyTab(graphs(metric, new_graph)), Gtk.Label(label=label))
+            if not (self.replay or self.aggregate):
+                notebook.append_page(LazyTab(lambda: SystemView(sample_seconds)), Gtk.Label(label="System"))
+            self.visible_graphs = notebook.get_nth_page(0)
+            notebook.connect("switch-page", self.on_switch_page)
+            # only shown with alt+0, see on_toggle_self
+            self.profile_view = ProfileView(self.collector)
+            notebook.append_page(self.profile_view, Gtk.Label(label='Self'))
+            notebook.connect("key-press-event", self.on_toggle_self)
+            notebook.foreach(lambda child:
+                             notebook.child_set_property(child,
+                                                         "tab-expand",
+                                                         True))
+            # agents don't index their processes for the aggregator
+            if not self.aggregate:
+                notebook.set_action_widget(self.filter_entry(), Gtk.PackType.START)
+            if self.replay:
+                notebook.set_action_widget(self.replay_controls(), Gtk.PackType.END)
+            elif self.history_file:
+                notebook.set_action_widget(self.time_range_chooser(), Gtk.PackType.END)
+            self.win.add(notebook)
+
+        self.win.show_all()
+        if not os.getenv('ONLY_CPU'):
+            self.profile_view.hide()
+
+    def on_toggle_self(self, notebook, event):
+        if not (event.state & Gdk.ModifierType.MOD1_MASK and event.keyval == Gdk.KEY_0):
+            return False
+
+        if self.profile_view.get_visible():
+            self.profile_view.hide()
+            if not self.profile:
+                self.collector.profiler = None
+        else:
+            if not self.collector.profiler:
+                self.collector.profiler = Profiler()
+            self.profile_view.show_all()
+            notebook.set_current_page(notebook.page_num(self.profile_view))
+        return True
+
+    def filter_entry(self):
+        """ Pins the processes that match, shown from the next sample on. """
+        entry = Gtk.SearchEntry(placeholder_text="Filter")
+        entry.connect("search-changed",
+                      lambda entry: setattr(self.collector, "filter", entry.get_text().strip() or None))
+        entry.show()
+        return entry
+
+    def time_range_chooser(self):
+        chooser = Gtk.ComboBoxText()
+        chooser.append_text("1 minute")
+        for seconds, buckets in HISTORY_TIERS[1:]:
+            minutes = seconds * buckets // 60
+            chooser.append_text(f"{minutes // 60} hours" if minutes >= 120 else
+                                f"{minutes // 60} hour" if minutes >= 60 else f"{minutes} minutes")
+        chooser.set_active(0)
+        chooser.connect("changed", self.on_time_range_changed)
+        chooser.show()
+        return chooser
+
+    def replay_controls(self):
+        """ Pausing, seeking and the speed of the replay. """
+        box = Gtk.Box(spacing=5)
+
+        pause = Gtk.ToggleButton(label="Pause")
+        pause.connect("toggled", lambda button: self.replay.pause(button.get_active()))
+        box.pack_start(pause, False, False, 0)
+
+        reader = self.replay.reader
+        self.seek_scale = Gtk.Scale.new_with_range(Gtk.Orientation.HORIZONTAL, reader.start,
+                                                   max(reader.end, reader.start + 1), reader.sample_seconds)
+        self.seek_scale.set_size_request(200, -1)
+        self.seek_scale.connect("format-value",
+                                lambda scale, value: time.strftime("%H:%M:%S", time.localtime(value)))
+        # only moved by the user, the position of the replay is set in show_sample
+        self.seek_scale.connect("change-value", lambda scale, scroll, value: self.replay.seek(value))
+        box.pack_start(self.seek_scale, True, True, 0)
+
+        speeds = [1, 2, 10, 60, 0]
+        if self.speed not in speeds:
+            speeds.insert(0, self.speed)
+        chooser = Gtk.ComboBoxText()
+        for speed in speeds:
+            chooser.append_text(f"{speed:g}x" if speed else "max")
+        chooser.set_active(speeds.index(self.speed))
+        chooser.connect("changed", lambda chooser: self.replay.set_speed(speeds[chooser.get_active()]))
+        box.pack_start(chooser, False, False, 0)
+
+        box.show_all()
+        return box
+
+    def on_time_range_changed(self, chooser):
+        self.tier = chooser.get_active() or None
+        self.show_sample()
+
+    def on_switch_page(self, notebook, page, page_num):
+        self.visible_graphs = page
+        self.show_sample()
+
+    def show_sample(self):
+        """ Shows the latest sample on the visible tab only, if the window is visible. """
+        window = self.win.get_window()
+        if self.sample is None or window is None or not self.win.get_mapped():
+            return False
+        if window.get_state() & (Gdk.WindowState.ICONIFIED | Gdk.WindowState.WITHDRAWN):
+            return False
+
+        profiler = self.collector.profiler
+        start = time.perf_counter()
+        if self.seek_scale:
+            self.seek_scale.set_value(self.sample.time)
+        self.visible_graphs.show_sample(self.sample, self.history_file, self.tier)
+        if profiler:
+            profiler.add("ui", (time.perf_counter() - start) * 1000)
+        return False
+
+    def on_activate(self, app):
+        self.win.present_with_time(int(time.time()))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="healthy", description="A tiny Linux process monitor.",
+                                     allow_abbrev=False)
+    parser.add_argument("--headless", action="store_true",
+                        help="write samples to stdout or a file instead of showing a window")
+    parser.add_argument("--format", choices=("ndjson", "csv"), default="ndjson",
+                        help="output format for --headless")
+    parser.add_argument("--output", "-o", metavar="PATH",
+                        help="write to PATH instead of stdout")
+    parser.add_argument("--max-bytes", type=int, default=0,
+                        help="rotate --output when it gets bigger than this")
+    parser.add_argument("--backup-count", type=int, default=5,
+                        help="number of rotated files to keep")
+    parser.add_argument("--interval", type=float, default=1.0,
+                        help="seconds between samples")
+    parser.add_argument("--profile", action="store_true",
+                        help="time each stage of collecting, and print that on exit")
+    parser.add_argument("--metrics", metavar="ADDRESS",
+                        help="serve OpenMetrics on [host:]port or unix:path, "
+                             "e.g. 127.0.0.1:9101")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--record", metavar="PATH",
+                        help="record all snapshots to a capture at PATH")
+    source.add_argument("--replay", metavar="PATH",
+                        help="play back the capture at PATH instead of sampling this system")
+    source.add_argument("--agent", metavar="ADDRESS",
+                        help="only stream samples to an aggregator at host:port or unix:path")
+    source.add_argument("--aggregate", metavar="ADDRESS",
+                        help="rank the processes of the agents that connect to [host:]port or unix:path "
+                             "instead of those of this system")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="how many times faster than recorded to replay, 0 for as fast as possible")
+    args, gtk_args = parser.parse_known_args(argv[1:])
+    if args.record and GROUP_BY in CGROUP_MODES:
+        parser.error(f"can't --record with GROUP_BY={GROUP_BY}, only processes are recorded")
+
+    if args.headless or args.agent:
+        return run_headless(args)
+
+    if Gtk is None:
+        parser.error("gtk is not available, try --headless")
+    if args.replay:
+        # the replay controls seek between the first and the last snapshot
+        try:
+            reader = CaptureReader(args.replay)
+        except (OSError, ValueError) as ex:
+            parser.error(str(ex))
+        empty = len(reader) == 0
+        reader.close()
+        if empty:
+            parser.error(f"{args.replay} has no snapshots yet")
+
+    app = Gtk.Application(application_id='org.papill0n.Healthy')
+    healthy = Healthy(metrics_address=args.metrics, profile=args.profile,
+                      record=args.record, replay=args.replay, speed=args.speed, aggregate=args.aggregate)
+    app.connect('startup', healthy.on_startup)
+    app.connect('activate', healthy.on_activate)
+    # quit cleanly, so that a recording keeps its last chunk
+    for signum in (signal.SIGTERM, signal.SIGHUP):
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signum, app.quit)
+    status = app.run(argv[:1] + gtk_args)
+    collector = healthy.collector
+    if collector and args.record and collector.capture:
+        collector.capture.close()
+    if collector and collector.profiler:
+        sys.stderr.write(collector.profiler.report())
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+""" Measures healthy's own overhead against fake /proc trees.
+
+    python healthy_bench.py --sizes 1000,10000,50000
+
+Each size gets a generated /proc with that many processes and canned
+`ss` output, which is then sampled a few times per stage while the
+counters of some processes change in between.
+"""
+import argparse
+import os
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import healthy
+
+
+COMMS = ["bash", "python3", "cc1plus", "node", "postgres", "java", "rustc",
+         "ld", "make", "sshd", "systemd", "kworker/3:1-events", "Web Content"]
+
+
+class FakeProc():
+    """ A directory that looks like /proc to healthy, with num_processes processes. """
+
+    def __init__(self, root, num_processes, num_cpus=8, seed=0):
+        self.root = root
+        self.num_cpus = num_cpus
+        self.rand = random.Random(seed)
+
+        self.pids = [i + 1 for i in range(num_processes)]
+        self.comms = [self.rand.choice(COMMS) for _ in self.pids]
+        self.ppids = [1 if i < 10 else self.rand.choice(self.pids[:i]) for i in range(num_processes)]
+        self.starttimes = [100 + i for i in range(num_processes)]
+        self.utimes = [self.rand.randrange(10000) for _ in self.pids]
+        self.stimes = [self.rand.randrange(1000) for _ in self.pids]
+        self.residents = [self.rand.randrange(100, 100000) for _ in self.pids]
+        self.read_bytes = [self.rand.randrange(1 << 30) for _ in self.pids]
+        self.write_bytes = [self.rand.randrange(1 << 30) for _ in self.pids]
+        # about one in ten processes has a few tcp connections
+        self.connections = {pid: [[fd, self.rand.randrange(1 << 20), self.rand.randrange(1 << 24)]
+                                  for fd in range(3, 3 + self.rand.randrange(1, 4))]
+                            for pid in self.pids if self.rand.random() < 0.1}
+        self.global_cpu = [10000 * num_cpus, 0, 5000 * num_cpus, 100000 * num_cpus, 100, 0, 50, 0]
+        # microseconds stalled as some and full, for cpu, memory and io
+        self.pressure = [[500000, 0], [20000, 10000], [80000, 40000]]
+        # sectors read, sectors written and ms busy of one disk, pages swapped in and out
+        self.disk = [100000, 200000, 3000]
+        self.swap = [10, 20]
+
+    @property
+    def ss_command(self):
+        return ["cat", os.path.join(self.root, "ss.txt")]
+
+    def create(self):
+        os.makedirs(self.root, exist_ok=True)
+        for i, pid in enumerate(self.pids):
+            os.makedirs(os.path.join(self.root, str(pid), "fd"), exist_ok=True)
+            with open(os.path.join(self.root, str(pid), "cmdline"), "w") as f:
+                f.write(f"/usr/bin/{self.comms[i]}\x00--fake\x00{pid}\x00")
+            self.write_process(i)
+        self.write_globals()
+
+    def write_process(self, i):
+        # written in place, so that handles healthy keeps open see the changes
+        path = os.path.join(self.root, str(self.pids[i]))
+        with open(os.path.join(path, "stat"), "w") as f:
+            f.write(f"{self.pids[i]} ({self.comms[i]}) S {self.ppids[i]} {self.pids[i]} {self.pids[i]} 0 -1 "
+                    f"4194560 {self.utimes[i] * 3} 0 12 0 {self.utimes[i]} {self.stimes[i]} 0 0 20 0 1 0 "
+                    f"{self.starttimes[i]} {self.residents[i] * 4096 * 3} {self.residents[i]} "
+                    f"18446744073709551615 94000000000000 94000000100000 140720000000000 0 0 0 0 0 0 "
+                    f"0 0 0 17 {i % self.num_cpus} 0 0 0 0 0 94000000200000 94000000300000 "
+                    f"94000001000000 140720000001000 140720000001100 140720000001100 140720000002000 0\n")
+        with open(os.path.join(path, "statm"), "w") as f:
+            f.write(f"{self.residents[i] * 3} {self.residents[i]} {self.residents[i] // 4} 100 0 "
+                    f"{self.residents[i] // 2} 0\n")
+        with open(os.path.join(path, "io"), "w") as f:
+            f.write(f"rchar: {self.read_bytes[i] * 2}\nwchar: {self.write_bytes[i] * 2}\n"
+                    f"syscr: {self.read_bytes[i] // 4096}\nsyscw: {self.write_bytes[i] // 4096}\n"
+                    f"read_bytes: {self.read_bytes[i]}\nwrite_bytes: {self.write_bytes[i]}\n"
+                    f"cancelled_write_bytes: 0\n")
+
+    def write_globals(self):
+        with open(os.path.join(self.root, "stat"), "w") as f:
+            f.write("cpu  " + " ".join(str(n) for n in self.global_cpu) + " 0 0\n")
+            for cpu in range(self.num_cpus):
+                f.write(f"cpu{cpu} " + " ".join(str(n // self.num_cpus) for n in self.global_cpu) + " 0 0\n")
+            f.write(f"processes {len(self.pids)}\nprocs_running 2\nprocs_blocked 0\n")
+        os.makedirs(os.path.join(self.root, "pressure"), exist_ok=True)
+        for name, (some, full) in zip(("cpu", "memory", "io"), self.pressure):
+            with open(os.path.join(self.root, "pressure", name), "w") as f:
+                f.write(f"some avg10=0.00 avg60=0.00 avg300=0.00 total={some}\n"
+                        f"full avg10=0.00 avg60=0.00 avg300=0.00 total={full}\n")
+        with open(os.path.join(self.root, "diskstats"), "w") as f:
+            read, written, busy = self.disk
+            f.write(f"   7       0 loop0 10 0 1000 5 0 0 0 0 0 10 5 0 0 0 0 0 0\n"
+                    f" 259       0 nvme0n1 500 10 {read} 300 800 20 {written} 900 0 {busy} 1200 0 0 0 0 0 0\n"
+                    f" 259       1 nvme0n1p1 400 10 {read // 2} 200 700 20 {written // 2} 800 0 {busy} 1000 "
+                    f"0 0 0 0 0 0\n")
+        with open(os.path.join(self.root, "vmstat"), "w") as f:
+            f.write(f"nr_free_pages 2000000\nnr_zone_inactive_anon 1000\npgpgin 5000\npgpgout 6000\n"
+                    f"pswpin {self.swap[0]}\npswpout {self.swap[1]}\npgmajfault 30\n")
+        with open(os.path.join(self.root, "meminfo"), "w") as f:
+            f.write("MemTotal:       32000000 kB\nMemFree:         8000000 kB\n"
+                    "MemAvailable:   16000000 kB\nBuffers:          500000 kB\n")
+        with open(os.path.join(self.root, "ss.txt"), "w") as f:
+            for pid, connections in self.connections.items():
+                for fd, sent, received in connections:
+                    f.write(f'ESTAB 0      0      192.168.1.2:{40000 + fd} 10.0.0.1:443 '
+                            f'users:(("{self.comms[pid - 1]}",pid={pid},fd={fd})) '
+                            f'uid:1000 ino:{pid * 100 + fd} sk:1 cubic '
+                            f'wscale:7,7 rto:204 rtt:1.5/0.7 mss:1448 cwnd:10 '
+                            f'bytes_sent:{sent} bytes_acked:{sent} bytes_received:{received} '
+                            f'segs_out:100 segs_in:100 send 77226667bps lastsnd:4 '
+                            f'lastrcv:4 lastack:4 rcv_space:14600 minrtt:0.9\n')
+
+    def tick(self, seconds=1.0, busy=0.05):
+        """ Lets some processes use cpu, memory, network and io for seconds. """
+        busy_cpus = 0
+        for i in self.rand.sample(range(len(self.pids)), max(1, int(len(self.pids) * busy))):
+            used = self.rand.randrange(int(100 * seconds))
+            self.utimes[i] += used
+            busy_cpus += used
+            self.residents[i] += self.rand.randrange(-10, 100)
+            self.read_bytes[i] += self.rand.randrange(1 << 20)
+            self.write_bytes[i] += self.rand.randrange(1 << 16)
+            self.write_process(i)
+        for connections in self.connections.values():
+            for connection in connections:
+                connection[1] += self.rand.randrange(1 << 12)
+                connection[2] += self.rand.randrange(1 << 16)
+        self.global_cpu[0] += busy_cpus
+        self.global_cpu[3] += int(100 * seconds * self.num_cpus)
+        self.write_globals()
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(fake, cycles, run, prepare=lambda: None, opened=lambda: 0):
+    """ Returns the median wall time in ms, and the syscalls and files opened by run() per cycle.
+
+    The kernel only counts reads and writes, opened counts the files
+    opened so far.  Cycles are measured after a first one that isn't.
+    """
+    # handles are opened by the first cycle, the others show what a sample costs
+    run(prepare())
+    times = []
+    syscalls = files = 0
+    for _ in range(cycles):
+        fake.tick()
+        args = prepare()
+        before_syscalls, before_opened = healthy.read_syscalls(), opened()
+        start = time.perf_counter()
+        run(args)
+        times.append((time.perf_counter() - start) * 1000)
+        syscalls += healthy.read_syscalls() - before_syscalls
+        files += opened() - before_opened
+    return statistics.median(times), syscalls // cycles, files // cycles
+
+
+def bench(size, cycles, tmp, workers=(), parse_processes=0):
+    fake = FakeProc(os.path.join(tmp, str(size)), size)
+    fake.create()
+
+    healthy.PROC_ROOT = fake.root
+    healthy.NET_BACKEND = "ss"
+    healthy.SS_COMMAND = fake.ss_command
+    healthy.PAGE_SIZE = 4096
+
+    pids = [str(pid) for pid in fake.pids]
+    handles = healthy.ProcHandles()
+    scanner = healthy.ProcScanner()
+    collector = healthy.PIDStatsCollector(1.0)
+    snapshot = [healthy.take_snapshot(scanner)]
+
+    def diff(group_by=None):
+        def run(after):
+            return healthy.diff_snapshots(snapshot[0], after, group_by=group_by)
+        return run
+
+    def collect_top_k(stats):
+        top_cpu, top_mem, top_net, top_io = stats.top_k(healthy.TOP_K)
+        collector.collect_top_k(collector.cpu, top_cpu, usage=lambda stat: stat.cpu_usage)
+        collector.collect_top_k(collector.mem, top_mem, usage=lambda stat: stat.mem_usage)
+        collector.collect_top_k(collector.net, top_net, usage=lambda stat: stat.net_usage)
+        collector.collect_top_k(collector.io, top_io, usage=lambda stat: stat.io_usage)
+
+    def take_snapshot(scanner):
+        def run(_):
+            snapshot[0] = healthy.take_snapshot(scanner)
+        return run
+
+    stages = [
+        ("read_stat (uncached)", lambda _: [healthy.read_stat(pid) for pid in pids], lambda: None),
+        ("read_stat (handles)", lambda _: [healthy.read_stat(pid, handles) for pid in pids], lambda: None),
+        ("take_snapshot", take_snapshot(scanner), lambda: None),
+        ("diff_snapshots", diff(), lambda: healthy.take_snapshot(scanner)),
+        ("grouping (name)", diff("tcomm"), lambda: healthy.take_snapshot(scanner)),
+        ("collect_top_k", collect_top_k,
+         lambda: healthy.diff_snapshots(snapshot[0], healthy.take_snapshot(scanner))),
+    ]
+    sharded = []
+    for n in workers:
+        sharded.append(healthy.ProcScanner(n, parse_processes))
+        parse = f"+{parse_processes}p" if parse_processes else ""
+        stages.append((f"take_snapshot ({n}t{parse})", take_snapshot(sharded[-1]), lambda: None))
+
+    # all files are read through these
+    readers = [healthy.uncached_handles, handles, scanner] + sharded
+
+    def opened():
+        return sum(reader.opened for reader in readers)
+
+    for name, run, prepare in stages:
+        wall_ms, syscalls, files = measure(fake, cycles, run, prepare, opened)
+        print(f"{size:>7} {name:<22} {wall_ms:>10.2f} {syscalls:>10} {files:>10} {peak_rss_mb():>10.1f}",
+              flush=True)
+
+    handles.close_all()
+    for closing in [scanner, collector.scanner] + sharded:
+        closing.close()
+    shutil.rmtree(fake.root)
+
+
+def bench_startup(size, cycles, tmp):
+    """ Measures what it takes until the window shows its first sample. """
+    fake = FakeProc(os.path.join(tmp, str(size)), size)
+    fake.create()
+
+    healthy.PROC_ROOT = fake.root
+    healthy.NET_BACKEND = "ss"
+    healthy.SS_COMMAND = fake.ss_command
+    healthy.PAGE_SIZE = 4096
+
+    def spawn(code):
+        times = []
+        for _ in range(cycles):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, "-c", code], check=True, cwd=os.path.dirname(__file__) or ".")
+            times.append((time.perf_counter() - start) * 1000)
+        return statistics.median(times)
+
+    # python itself starts in this time, too
+    interpreter = spawn("pass")
+    stages = [("import", spawn("import healthy") - interpreter, 0, 0)]
+
+    times, syscalls, files = [], 0, 0
+    for _ in range(cycles):
+        fake.tick()
+        first = threading.Event()
+        collector = healthy.PIDStatsCollector(1.0, consumers=[lambda sample: first.set()],
+                                              first_sample=healthy.Healthy.FIRST_SAMPLE)
+        before_syscalls = healthy.read_syscalls()
+        start = time.perf_counter()
+        collector.start()
+        first.wait()
+        times.append((time.perf_counter() - start) * 1000)
+        syscalls += healthy.read_syscalls() - before_syscalls
+        collector.stop()
+        collector.bg_thread.join()
+        files += collector.scanner.opened
+    stages.append(("first sample", statistics.median(times), syscalls // cycles, files // cycles))
+
+    if healthy.Gtk and healthy.Gtk.init_check()[0]:
+        times = []
+        for _ in range(cycles):
+            start = time.perf_counter()
+            healthy.GraphCollection(1.0, "cpu", new_graph=healthy.CPUGraph).destroy()
+            times.append((time.perf_counter() - start) * 1000)
+        stages.append(("build a tab", statistics.median(times), 0, 0))
+
+    for name, wall_ms, syscalls, files in stages:
+        print(f"{size:>7} {name:<22} {wall_ms:>10.2f} {syscalls:>10} {files:>10} {peak_rss_mb():>10.1f}",
+              flush=True)
+    shutil.rmtree(fake.root)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks healthy against fake /proc trees.")
+    parser.add_argument("--sizes", default="1000,10000,50000",
+                        help="comma-separated numbers of processes")
+    parser.add_argument("--cycles", type=int, default=5, help="samples per stage")
+    parser.add_argument("--tmp", help="where to create the fake trees, preferably a tmpfs")
+    parser.add_argument("--workers", default="2,4,8",
+                        help="comma-separated scan thread counts to compare with a single thread")
+    parser.add_argument("--parse-processes", type=int, default=0,
+                        help="processes to parse in for the sharded scans")
+    parser.add_argument("--startup", action="store_true",
+                        help="measure the time until the first sample is shown instead")
+    args = parser.parse_args()
+    workers = [int(n) for n in args.workers.split(",") if n]
+
+    print(f"{'procs':>7} {'stage':<22} {'wall ms':>10} {'rw calls':>10} {'opened':>10} {'peak MB':>10}")
+    with tempfile.TemporaryDirectory(dir=args.tmp) as tmp:
+        for size in [int(size) for size in args.sizes.split(",")]:
+            if args.startup:
+                bench_startup(size, args.cycles, tmp)
+            else:
+                bench(size, args.cycles, tmp, workers, args.parse_processes)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,23 @@
+from collections import defaultdict
+import io
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
-from healthy import ConnectionInfo, parse_ss_tip, read_net_per_process
+import healthy
+from healthy import (AgentStream, Aggregator, BurstSampler, CSVWriter, ConnectionInfo, History, HistoryFile,
+                     MetricsExporter, NDJSONWriter, ProcTable, Profiler, ProcessInfoCache, RecordedStat, RotatingFile,
+                     Sample, SockDiag, Usages, parse_ss_tip, read_net_per_process,
+                     read_net_per_process_ss, read_stat, scroll_shift, top_k,
+                     totals_by_name)
+from healthy_bench import FakeProc
 
 
 class TestParseSSTip(unittest.TestCase):
@@ -24,10 +41,15 @@ class TestParseSSTip(unittest.TestCase):
                                         bytes_sent=276685,
                                         bytes_received=810911))
 
+    def test_extended(self):
+        line = ('ESTAB 0 0 10.0.0.2:40004 10.0.0.1:443 users:(("curl",pid=42,fd=5)) '
+                'uid:1000 ino:98765 sk:3f cgroup:/user.slice <-> cubic bytes_sent:10 bytes_received:20')
+        self.assertEqual(parse_ss_tip(line), ConnectionInfo(42, 5, 10, 20, inode=98765))
+
 
 class TestReadNetPerProcess(unittest.TestCase):
     def test_parse(self):
-        for info in read_net_per_process():
+        for info in read_net_per_process_ss():
             self.assertIsNotNone(info)
             self.assertIsInstance(info.pid, int)
             self.assertTrue(info.pid > 0)
@@ -37,5 +59,859 @@ class TestReadNetPerProcess(unittest.TestCase):
             self.assertIsInstance(info.bytes_received, int)
 
 
+class TestSockDiag(unittest.TestCase):
+    def test_connections(self):
+        server = socket.create_server(("127.0.0.1", 0))
+        client = socket.create_connection(server.getsockname())
+        conn, _ = server.accept()
+        client.sendall(b"x" * 1000)
+        conn.recv(1000)
+
+        sock_diag = SockDiag()
+        try:
+            connections = sock_diag.connections()
+        finally:
+            sock_diag.close()
+            for s in (conn, client, server):
+                s.close()
+
+        own = [info for info in connections if info.pid == os.getpid()]
+        self.assertEqual(len(own), 2)
+        self.assertEqual(sorted(info.bytes_sent for info in own), [0, 1000])
+        self.assertEqual(sorted(info.bytes_received for info in own), [0, 1000])
+
+    def test_closed(self):
+        server = socket.create_server(("127.0.0.1", 0))
+        client = socket.create_connection(server.getsockname())
+        conn, _ = server.accept()
+        sock_diag = SockDiag()
+        try:
+            inode = os.fstat(client.fileno()).st_ino
+            self.assertIn(inode, [info.inode for info in sock_diag.connections()])
+            client.sendall(b"x" * 1000)
+            conn.recv(1000)
+            # waits for the server to close its side, too
+            client.close()
+
+            closed = [info for info in sock_diag.connections() if info.inode == inode]
+            self.assertEqual(len(closed), 1)
+            self.assertEqual((closed[0].pid, closed[0].bytes_sent), (os.getpid(), 1000))
+        finally:
+            sock_diag.close()
+            conn.close()
+            server.close()
+
+    def test_freed(self):
+        sock_diag = SockDiag()
+        if sock_diag.events is None:
+            sock_diag.close()
+            self.skipTest("listening for freed sockets needs CAP_NET_ADMIN")
+
+        counter = healthy.NetCounter()
+        server = socket.create_server(("127.0.0.1", 0))
+        # keeps this process in the totals after the other connection closed
+        idle = socket.create_connection(server.getsockname())
+        idle_conn, _ = server.accept()
+        client = socket.create_connection(server.getsockname())
+        conn, _ = server.accept()
+        try:
+            pid = os.getpid()
+            before = dict((info.pid, info) for info in counter.update(sock_diag.connections()))[pid]
+
+            client.sendall(b"x" * 100000)
+            conn.sendall(b"y" * 100000)
+            for s in (conn, client):
+                received = 0
+                while received < 100000:
+                    received += len(s.recv(65536))
+            client.close()
+            conn.close()
+
+            # they are gone from the dump, freeing them is reported a little later
+            for _ in range(100):
+                after = dict((info.pid, info) for info in counter.update(sock_diag.connections()))[pid]
+                if after.bytes_received - before.bytes_received >= 200000:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(after.bytes_sent - before.bytes_sent, 200000)
+            # the FINs are counted as a byte received
+            self.assertIn(after.bytes_received - before.bytes_received, range(200000, 200003))
+        finally:
+            sock_diag.close()
+            for s in (idle, idle_conn, server):
+                s.close()
+
+    def test_read_net_per_process(self):
+        for info in read_net_per_process():
+            self.assertIsInstance(info, ConnectionInfo)
+            self.assertTrue(info.pid > 0)
+            self.assertTrue(info.fd >= 0)
+
+
+class TestHistory(unittest.TestCase):
+    def test_window(self):
+        history = History(num_samples=3, max_keys=2)
+        history.advance()
+        history.append("a", 1)
+        history.advance()
+        history.advance()
+        history.append("a", 3)
+        self.assertEqual(history.window("a"), [1, 0, 3])
+        history.advance()
+        self.assertEqual(history.window("a"), [0, 3, 0])
+
+    def test_evicts_zero_windows(self):
+        history = History(num_samples=3, max_keys=2)
+        history.advance()
+        history.append("a", 1)
+        history.append("b", 0)
+        history.advance()
+        history.append("a", 1)
+        history.advance()
+        history.advance()
+        self.assertNotIn("b", history)
+        self.assertIn("a", history)
+        history.advance()
+        self.assertEqual(len(history), 0)
+
+    def test_bounded(self):
+        history = History(num_samples=3, max_keys=2)
+        for key in range(100):
+            history.advance()
+            history.append(key, 1)
+        self.assertEqual(len(history), 2)
+        self.assertEqual(history.window(99), [0, 0, 1])
+
+    def test_allocates_on_demand(self):
+        history = History(num_samples=3, max_keys=1000)
+        self.assertEqual(len(history.values), 0)
+        for key in range(10):
+            history.advance()
+            history.append(key, 1)
+        # rows of expired keys are reused
+        self.assertEqual(len(history.values), 3 * 3)
+
+    def test_top(self):
+        history = History(num_samples=3, max_keys=6)
+        for values in ({"a": 1, "b": 5}, {"a": 3, "c": 2}, {"a": 3}, {"c": 1}):
+            history.advance()
+            for key, value in values.items():
+                history.append(key, value)
+        self.assertEqual(history.sum("a"), 6)
+        self.assertEqual(history.sum("c"), 3)
+        self.assertNotIn("b", history)
+        self.assertEqual(history.top(2), ["a", "c"])
+        self.assertEqual(history.top(1), ["a"])
+
+
+class TestScrollShift(unittest.TestCase):
+    def test_scrolled(self):
+        self.assertEqual(scroll_shift([0, 1, 2, 3], [1, 2, 3, 4]), 1)
+        self.assertEqual(scroll_shift([0, 1, 2, 3], [2, 3, 0, 5]), 2)
+
+    def test_redraw(self):
+        self.assertIsNone(scroll_shift([0, 1, 2, 3], [5, 5, 5, 5]))
+        self.assertIsNone(scroll_shift([0, 1, 2, 3], [0, 1, 2]))
+
+
+class FakeStat():
+    def __init__(self, cpu_usage, mem_usage, net_usage, io_usage):
+        self.cpu_usage = cpu_usage
+        self.mem_usage = mem_usage
+        self.net_usage = net_usage
+        self.io_usage = io_usage
+
+
+class TestTopK(unittest.TestCase):
+    def test_top_k(self):
+        stats = [FakeStat(i, -i, i % 5, 0) for i in range(100)]
+        columns = [[getattr(stat, f"{metric}_usage") for stat in stats] for metric in healthy.METRICS]
+        cpu, mem, net, io = top_k(columns, 3)
+        self.assertEqual([stats[i].cpu_usage for i in cpu], [99, 98, 97])
+        self.assertEqual([stats[i].mem_usage for i in mem], [0, -1, -2])
+        self.assertEqual([stats[i].net_usage for i in net], [4, 4, 4])
+        self.assertEqual(len(io), 3)
+
+    def test_fewer_than_k(self):
+        cpu, _ = top_k([[1, 2], [0, 0]], 20)
+        self.assertEqual(cpu, [1, 0])
+
+
+class TestProcessInfoCache(unittest.TestCase):
+    def test_resolve(self):
+        infos = ProcessInfoCache()
+        stat = read_stat(str(os.getpid()))
+        infos.resolve(stat)
+        self.assertIn("python", stat.cmdline)
+        self.assertIsNotNone(stat.user)
+        self.assertIs(infos.get(stat.pid, stat.starttime), infos.get(stat.pid, stat.starttime))
+
+    def test_pid_reuse(self):
+        infos = ProcessInfoCache()
+        stat = read_stat(str(os.getpid()))
+        info = infos.get(stat.pid, stat.starttime)
+        self.assertIsNot(infos.get(stat.pid, stat.starttime + 1), info)
+
+        table = ProcTable()
+        table.append(stat.pid, stat.tcomm, starttime=stat.starttime)
+        infos.retain(table)
+        self.assertEqual(list(infos.infos), [(stat.pid, stat.starttime)])
+        infos.retain(ProcTable())
+        self.assertEqual(infos.infos, {})
+
+
+class TestFakeProc(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.fake = FakeProc(self.tmp.name, 50, num_cpus=os.cpu_count())
+        self.fake.create()
+        self.globals = (healthy.PROC_ROOT, healthy.NET_BACKEND, healthy.SS_COMMAND, healthy.PAGE_SIZE)
+        healthy.PROC_ROOT = self.fake.root
+        healthy.NET_BACKEND = "ss"
+        healthy.SS_COMMAND = self.fake.ss_command
+        healthy.PAGE_SIZE = 4096
+
+    def tearDown(self):
+        healthy.PROC_ROOT, healthy.NET_BACKEND, healthy.SS_COMMAND, healthy.PAGE_SIZE = self.globals
+        self.tmp.cleanup()
+
+    def test_diff_snapshots(self):
+        scanner = healthy.ProcScanner(max_fds=100)
+        before = healthy.take_snapshot(scanner)
+        self.assertEqual(len(before.stats), 50)
+
+        self.fake.utimes[4] += 50
+        self.fake.read_bytes[4] += 1000
+        self.fake.write_process(4)
+        self.fake.global_cpu[3] += 100 * self.fake.num_cpus - 50
+        self.fake.global_cpu[0] += 50
+        self.fake.write_globals()
+
+        stats = healthy.diff_snapshots(before, healthy.take_snapshot(scanner))
+        scanner.close()
+
+        busy = max(stats, key=lambda stat: stat.cpu_usage)
+        self.assertEqual(busy.pid, 5)
+        self.assertEqual(busy.tcomm, self.fake.comms[4])
+        self.assertAlmostEqual(busy.cpu_usage, 50.0)
+        self.assertEqual(busy.io_usage, 1000)
+        self.assertEqual(sum(stat.cpu_usage for stat in stats), busy.cpu_usage)
+
+    def test_group(self):
+        before = healthy.take_snapshot()
+        for i in range(len(self.fake.pids)):
+            self.fake.utimes[i] += 1
+            self.fake.write_process(i)
+        self.fake.global_cpu[0] += len(self.fake.pids)
+        self.fake.write_globals()
+
+        after = healthy.take_snapshot()
+        stats = healthy.diff_snapshots(before, after, group_by="tcomm")
+        self.assertEqual(len(stats), len(set(self.fake.comms)))
+        by_name = {stat.key: stat for stat in stats}
+        name = self.fake.comms[0]
+        self.assertEqual(by_name[name].pid, 1)
+        self.assertEqual(by_name[name].tcomm, f"{name} ({self.fake.comms.count(name)})")
+        self.assertAlmostEqual(sum(stat.cpu_usage for stat in stats),
+                               sum(stat.cpu_usage for stat in healthy.diff_snapshots(before, after)))
+
+    def test_smaps_cache(self):
+        for pid, pss in ((1, 100), (2, 200)):
+            with open(os.path.join(self.fake.root, str(pid), "smaps_rollup"), "w") as f:
+                f.write(f"00400000-7fff0000 ---p 00000000 00:00 0    [rollup]\nRss: 9000 kB\n"
+                        f"Pss: {pss} kB\nPrivate_Clean: 10 kB\nPrivate_Dirty: 20 kB\n")
+        table = healthy.take_snapshot().stats
+        biggest = max(range(len(table)), key=lambda row: table.resident[row])
+
+        budgeted = healthy.SmapsCache("pss", budget=0)
+        budgeted.refresh(table)
+        self.assertEqual(list(budgeted.entries), [(table.pid[biggest], table.starttime[biggest])])
+
+        memory = healthy.SmapsCache("uss", budget=10)
+        memory.refresh(table)
+        self.assertEqual(len(memory.entries), 50)
+        rows = [table.index[1], table.index[3]]
+        self.assertEqual(memory.estimate(table, rows), [30 * 1024, table.resident[rows[1]] * 4096])
+
+        self.fake.residents[0] *= 2
+        self.fake.write_process(0)
+        table = healthy.take_snapshot().stats
+        self.assertEqual(memory.estimate(table, [table.index[1]]), [60 * 1024])
+
+    def test_sharded_scan(self):
+        scanner = healthy.ProcScanner(workers=4, max_fds=100)
+        try:
+            table = scanner.scan()
+            self.assertEqual(sorted(table.pid), self.fake.pids)
+            self.assertEqual(dict(zip(table.pid, table.utime)), dict(zip(self.fake.pids, self.fake.utimes)))
+        finally:
+            scanner.close()
+
+    def test_net_per_pid(self):
+        counter = healthy.NetCounter()
+
+        def snapshot(*connections):
+            net = counter.update(ConnectionInfo(*info) for info in connections)
+            return healthy.Snapshot(ProcTable(), net, 0, 0, 0)
+
+        before = snapshot((1, 3, 100, 100, 11), (1, 4, 500, 0, 12), (2, 3, 10, 0, 21), (3, 5, 7, 0))
+        self.assertEqual(before.net_totals(), {1: 0, 2: 0, 3: 0})
+        # 12 closed and 4 is reused, 21 sent more, 3 has no inode from `ss` without -e
+        after = snapshot((1, 3, 100, 150, 11), (1, 4, 20, 0, 13), (2, 3, 30, 0, 21), (3, 5, 9, 0))
+        self.assertEqual(healthy.net_per_pid(before, after), {1: 70, 2: 20, 3: 2})
+
+        # 21 was handed to 4, which doesn't get what it sent before
+        later = snapshot((4, 3, 35, 0, 21), (3, 5, 9, 0))
+        self.assertEqual(healthy.net_per_pid(after, later), {4: 5, 3: 0})
+        # the final counters of 11 and 13 only come now
+        last = snapshot((1, 3, 100, 160, 11), (1, 4, 25, 0, 13), (3, 5, 9, 0))
+        self.assertEqual(healthy.net_per_pid(later, last), {1: 15, 3: 0})
+
+    def test_process_index(self):
+        index = healthy.ProcessIndex()
+        index.update(healthy.take_snapshot().stats)
+        self.assertEqual(index.search("--fake 7"), {7})
+        name = self.fake.comms[0].lower()
+        self.assertEqual(index.search(name), {pid for pid, comm in zip(self.fake.pids, self.fake.comms)
+                                              if name in comm.lower()})
+
+        # only the new processes are read, and the exited ones dropped from the matches
+        shutil.rmtree(os.path.join(self.fake.root, "1"))
+        index.update(healthy.take_snapshot().stats)
+        self.assertNotIn(1, index.texts)
+        self.assertNotIn(1, index.search(name))
+
+    def test_pinned(self):
+        before = healthy.take_snapshot()
+        self.fake.tick()
+        self.fake.write_globals()
+        after = healthy.take_snapshot()
+        stats = healthy.diff_snapshots(before, after)
+
+        collector = healthy.PIDStatsCollector(1.0)
+        self.assertIsNone(collector.pinned)
+        pinned = collector.collect_pinned("--FAKE 7", stats, after, cgroup_mode=False)
+        for metric in healthy.METRICS:
+            self.assertEqual([stat.pid for stat, _ in pinned[metric]], [7])
+        stat, window = pinned["cpu"][0]
+        self.assertEqual(len(window), collector.num_samples)
+        self.assertEqual(window[-1], stat.cpu_usage)
+
+        # every tab has the matches that use the most of its metric
+        collector.pinned = None
+        pinned = collector.collect_pinned("--fake", stats, after, cgroup_mode=False)
+        for metric in healthy.METRICS:
+            top = sorted(stats, key=lambda stat: getattr(stat, f"{metric}_usage"), reverse=True)[:healthy.TOP_K]
+            self.assertEqual({getattr(stat, f"{metric}_usage") for stat, _ in pinned[metric]},
+                             {getattr(stat, f"{metric}_usage") for stat in top})
+
+        grouped = healthy.diff_snapshots(before, after, group_by="tcomm")
+        collector.pinned = None
+        pinned = collector.collect_pinned("--fake 7", grouped, after, cgroup_mode=False)
+        self.assertEqual([stat.key for stat, _ in pinned["cpu"]], [self.fake.comms[6]])
+
+    def test_system(self):
+        scanner = healthy.SystemScanner()
+        before = scanner.scan()
+        self.fake.global_cpu[0] += 100 * self.fake.num_cpus
+        self.fake.global_cpu[3] += 300 * self.fake.num_cpus
+        self.fake.pressure[1][0] += 250000
+        self.fake.disk = [self.fake.disk[0] + 8, self.fake.disk[1] + 16, self.fake.disk[2] + 500]
+        self.fake.swap[1] += 2
+        self.fake.write_globals()
+        after = scanner.scan()
+        scanner.close()
+        self.assertEqual(after.disks, [b"nvme0n1"])
+
+        # as if a second passed
+        after.timestamp = before.timestamp + 1.0
+        usages = dict(healthy.system_usages(before, after, 1.0))
+        self.assertAlmostEqual(usages["cpu"], 25.0)
+        self.assertAlmostEqual(usages["cpu0"], 25.0)
+        self.assertAlmostEqual(usages["memory pressure"], 25.0)
+        self.assertEqual(usages["io pressure"], 0.0)
+        self.assertAlmostEqual(usages["disk busy"], 50.0)
+        self.assertEqual(usages["disk read"], 8 * 512)
+        self.assertEqual(usages["disk written"], 16 * 512)
+        self.assertEqual(usages["swapped out"], 2 * 4096)
+        self.assertEqual(len(usages), 13 + self.fake.num_cpus)
+
+    def test_first_sample(self):
+        first = threading.Event()
+        samples = []
+        collector = healthy.PIDStatsCollector(5.0, consumers=[samples.append, lambda sample: first.set()],
+                                              first_sample=0.05, system=True)
+        start = time.monotonic()
+        collector.start()
+        try:
+            self.assertTrue(first.wait(2))
+            self.assertLess(time.monotonic() - start, 2)
+        finally:
+            collector.stop()
+            collector.bg_thread.join()
+        # the system is sampled in the same cycle
+        names = [name for name, window in samples[0].system]
+        self.assertIn("cpu0", names)
+        self.assertEqual(len(samples[0].system[0][1]), collector.num_samples)
+
+    def record(self, path, count):
+        writer = healthy.CaptureWriter(path, 1.0, chunk_snapshots=2)
+        snapshots = []
+        for i in range(count):
+            snapshot = healthy.take_snapshot()
+            writer.write(snapshot)
+            snapshots.append(snapshot)
+            self.fake.tick()
+            self.fake.write_globals()
+            if i == 1:
+                self.fake.comms[3] = "renamed"
+                self.fake.write_process(3)
+            elif i == 2:
+                shutil.rmtree(os.path.join(self.fake.root, "7"))
+        writer.close()
+        return snapshots
+
+    def test_capture(self):
+        path = os.path.join(self.tmp.name, "capture")
+        snapshots = self.record(path, 5)
+
+        reader = healthy.CaptureReader(path)
+        self.assertEqual((reader.page_size, reader.num_cpus, reader.sample_seconds), (4096, os.cpu_count(), 1.0))
+        self.assertEqual(len(reader.chunks), 3)
+        replayed = list(reader.snapshots())
+        self.assertEqual(len(replayed), 5)
+        for snapshot, read in zip(snapshots, replayed):
+            for column in ProcTable.COLUMNS:
+                self.assertEqual(getattr(read.stats, column), getattr(snapshot.stats, column))
+            self.assertEqual(read.stats.tcomm, snapshot.stats.tcomm)
+            self.assertEqual(read.net, snapshot.net)
+            self.assertEqual((read.global_cpu, read.global_mem, read.timestamp, read.wall_time),
+                             (snapshot.global_cpu, snapshot.global_mem, snapshot.timestamp, snapshot.wall_time))
+        self.assertTrue(replayed[0].net)
+        self.assertIn("renamed", replayed[2].stats.tcomm)
+        self.assertNotIn(7, replayed[3].stats.pid)
+
+        later = [snapshot.wall_time for snapshot in reader.snapshots(snapshots[3].wall_time)]
+        self.assertEqual(later, [snapshot.wall_time for snapshot in snapshots[3:]])
+        reader.close()
+
+    def test_capture_chunk_seconds(self):
+        path = os.path.join(self.tmp.name, "capture")
+        writer = healthy.CaptureWriter(path, 1.0, chunk_seconds=2)
+        snapshot = healthy.take_snapshot()
+        for wall_time in (100.0, 101.0, 102.0, 103.0):
+            snapshot.wall_time = wall_time
+            writer.write(snapshot)
+
+        # the first two seconds are there before the writer is closed
+        reader = healthy.CaptureReader(path)
+        self.assertEqual(len(reader), 3)
+        writer.close()
+        reader.refresh()
+        self.assertEqual(len(reader), 4)
+        reader.close()
+
+    def test_replay(self):
+        path = os.path.join(self.tmp.name, "capture")
+        snapshots = self.record(path, 5)
+        reader = healthy.CaptureReader(path)
+
+        samples = []
+        collector = healthy.PIDStatsCollector(1.0, consumers=[samples.append],
+                                              replay=healthy.Replay(reader, speed=0))
+        collector.update()
+        self.assertEqual([sample.time for sample in samples], [snapshot.wall_time for snapshot in snapshots[1:]])
+        busy = max(healthy.diff_snapshots(snapshots[0], snapshots[1]), key=lambda stat: stat.cpu_usage)
+        stat, window = samples[0].cpu[0]
+        self.assertEqual(stat.key, busy.key)
+        self.assertAlmostEqual(window[-1], busy.cpu_usage)
+
+        replay = healthy.Replay(reader, speed=0)
+        self.assertEqual(replay.next().wall_time, snapshots[0].wall_time)
+        replay.seek(snapshots[3].wall_time)
+        self.assertEqual(replay.next().wall_time, snapshots[3].wall_time)
+        self.assertTrue(replay.jumped)
+        reader.close()
+
+
+class TestCgroups(unittest.TestCase):
+    container_id = "0123456789ab" + "c" * 52
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        self.cgroup_root = healthy.CGROUP_ROOT
+        healthy.CGROUP_ROOT = self.root
+
+        self.write("", "cgroup.controllers", "cpu io memory pids\n")
+        self.write_cgroup("system.slice/sshd.service", 1000, 4096, 0)
+        self.write_cgroup(f"system.slice/docker-{self.container_id}.scope", 5000, 8192, 100)
+        self.write_cgroup("user.slice/user-1000.slice/user@1000.service/app.slice/app-firefox.scope", 0, 0, 0)
+        self.write_cgroup("user.slice/user-1000.slice/user@1000.service/app.slice/app-firefox.scope/tab", 0, 0, 0)
+
+    def tearDown(self):
+        healthy.CGROUP_ROOT = self.cgroup_root
+        self.tmp.cleanup()
+
+    def write(self, path, name, content):
+        os.makedirs(os.path.join(self.root, path), exist_ok=True)
+        with open(os.path.join(self.root, path, name), "w") as f:
+            f.write(content)
+
+    def write_cgroup(self, path, cpu_usec, memory, io_bytes):
+        self.write(path, "cpu.stat", f"usage_usec {cpu_usec}\nuser_usec {cpu_usec}\nsystem_usec 0\n")
+        self.write(path, "memory.current", f"{memory}\n")
+        self.write(path, "io.stat", f"8:0 rbytes={io_bytes} wbytes={io_bytes} rios=1 wios=1 dbytes=0 dios=0\n")
+        self.write(path, "cgroup.procs", "")
+
+    def found(self, mode):
+        return sorted(name for _, name in healthy.find_cgroups(mode))
+
+    def test_find_cgroups(self):
+        self.assertEqual(self.found("unit"), ["app-firefox.scope", f"docker-{self.container_id}.scope",
+                                              "sshd.service"])
+        self.assertEqual(self.found("container"), ["0123456789ab"])
+        self.assertEqual(self.found("cgroup"), [
+            f"system.slice/docker-{self.container_id}.scope", "system.slice/sshd.service",
+            "user.slice/user-1000.slice/user@1000.service/app.slice/app-firefox.scope/tab"])
+
+    def test_diff(self):
+        before = healthy.Snapshot({path: healthy.read_cgroup(path, name)
+                                   for path, name in healthy.find_cgroups("unit")},
+                                  [], None, 16384, 10.0)
+        self.write_cgroup("system.slice/sshd.service", 501000, 4096, 50)
+        after = healthy.Snapshot({path: healthy.read_cgroup(path, name)
+                                  for path, name in healthy.find_cgroups("unit")},
+                                 [], None, 16384, 11.0)
+
+        stats = {stat.tcomm: stat for stat in healthy.diff_cgroup_snapshots(before, after)}
+        self.assertAlmostEqual(stats["sshd.service"].cpu_usage, 50.0)
+        self.assertEqual(stats["sshd.service"].mem_usage, 25.0)
+        self.assertEqual(stats["sshd.service"].io_usage, 100)
+        self.assertEqual(stats["app-firefox.scope"].cpu_usage, 0)
+        self.assertTrue(all(stat.pid < 0 for stat in stats.values()))
+
+
+class FakePIDStat():
+    def __init__(self, pid, tcomm):
+        self.pid = pid
+        self.tcomm = tcomm
+
+
+def fake_sample():
+    alive_pids = defaultdict(lambda: False)
+    alive_pids[1] = True
+    return Sample(time=1000.0,
+                  cpu=[(FakePIDStat(1, "init"), [0, 2, 4]), (FakePIDStat(2, "gone"), [3, 0, 0])],
+                  mem=[(FakePIDStat(1, "init"), [1, 1, 1])],
+                  net=[], io=[], alive_pids=alive_pids)
+
+
+class TestWriters(unittest.TestCase):
+    def test_ndjson(self):
+        out = io.StringIO()
+        NDJSONWriter(out)(fake_sample())
+        line = json.loads(out.getvalue())
+        self.assertEqual(line["time"], 1000.0)
+        self.assertEqual(line["cpu"][0], {"pid": 1, "name": "init", "usage": 4,
+                                          "avg": 2, "max": 4, "alive": True})
+        self.assertFalse(line["cpu"][1]["alive"])
+        self.assertEqual(line["net"], [])
+
+    def test_csv(self):
+        out = io.StringIO()
+        CSVWriter(out)(fake_sample())
+        self.assertEqual(out.getvalue().splitlines(), [
+            "1000.0,cpu,0,1,init,4,2.0,4,1",
+            "1000.0,cpu,1,2,gone,0,1.0,3,0",
+            "1000.0,mem,0,1,init,1,1.0,1,1",
+        ])
+
+    def test_rotation(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "out.csv")
+            out = RotatingFile(path, max_bytes=25, backup_count=2, header="header\n")
+            for i in range(5):
+                out.write(f"line {i}\n")
+            out.flush()
+            self.assertEqual(sorted(os.listdir(tmp)), ["out.csv", "out.csv.1", "out.csv.2"])
+            with open(path) as f:
+                self.assertEqual(f.read(), "header\nline 4\n")
+            with open(path + ".1") as f:
+                self.assertEqual(f.read(), "header\nline 2\nline 3\n")
+
+
+class TestMetricsExporter(unittest.TestCase):
+    def test_render(self):
+        sample = fake_sample()._replace(totals={"cpu": {"init": 4, "other": 1}, "mem": {}, "net": {}, "io": {}})
+        text = MetricsExporter("").render(sample)
+        self.assertIn('healthy_top_pid{metric="cpu",rank="1"} 2\n', text)
+        self.assertIn('healthy_top_cpu_percent{rank="0",name="init"} 4\n', text)
+        self.assertIn('healthy_group_cpu_percent{name="other"} 1\n', text)
+        self.assertTrue(text.endswith("# EOF\n"))
+        self.assertIn("# HELP healthy_top_memory_percent Resident memory", text)
+
+        text = MetricsExporter("", memory_mode="pss").render(sample)
+        self.assertIn("# HELP healthy_top_memory_percent Proportional memory", text)
+
+    def test_unix_socket(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            exporter = MetricsExporter("unix:" + os.path.join(tmp, "metrics"))
+            exporter.serve()
+            exporter(fake_sample())
+            try:
+                with socket.socket(socket.AF_UNIX) as s:
+                    s.connect(os.path.join(tmp, "metrics"))
+                    s.sendall(b"GET /metrics HTTP/1.0\r\n\r\n")
+                    response = b""
+                    while chunk := s.recv(4096):
+                        response += chunk
+            finally:
+                exporter.close()
+        self.assertTrue(response.startswith(b"HTTP/1.0 200"))
+        self.assertTrue(response.endswith(exporter.body))
+
+    def test_keeps_other_files(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "metrics")
+            with open(path, "w") as f:
+                f.write("not a socket")
+            with self.assertRaises(FileExistsError):
+                MetricsExporter("unix:" + path).serve()
+            with open(path) as f:
+                self.assertEqual(f.read(), "not a socket")
+
+    def test_totals_by_name(self):
+        table = ProcTable()
+        for pid, name in enumerate(("a", "b", "a")):
+            table.append(pid, name)
+        stats = Usages(table, range(3), [1, 2, 3], [0] * 3, [0] * 3, [0] * 3)
+        self.assertEqual(totals_by_name(stats, 1)["cpu"], {"a": 4, "other": 2})
+
+
+class TestAgents(unittest.TestCase):
+    def sample(self, usages, dead=()):
+        alive_pids = defaultdict(lambda: False)
+        cpu, net = [], []
+        for pid, name, usage in usages:
+            stat = RecordedStat(pid, name)
+            stat.cmdline = f"/usr/bin/{name}"
+            alive_pids[pid] = pid not in dead
+            cpu.append((stat, [0, usage]))
+            net.append((stat, [0, usage * 1000]))
+        return Sample(time=time.time(), cpu=cpu, mem=[], net=net, io=[], alive_pids=alive_pids)
+
+    def wait(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def test_only_changes(self):
+        agent = AgentStream("127.0.0.1:0")
+        ids, dead, sent = {}, set(), {}
+        next_id = iter(range(100))
+
+        def rows(sample):
+            return healthy.AGENT_CYCLE_HEADER.unpack_from(agent.encode(sample, ids, dead, next_id, sent))[1]
+
+        self.assertEqual(rows(self.sample([(100, "make", 10), (200, "cc1plus", 50)])), 2)
+        self.assertEqual(rows(self.sample([(100, "make", 10), (200, "cc1plus", 50)])), 0)
+        self.assertEqual(rows(self.sample([(100, "make", 10), (200, "cc1plus", 60)])), 1)
+        # going back to no usage is a change, too
+        self.assertEqual(rows(self.sample([(100, "make", 0), (200, "cc1plus", 60)])), 1)
+        self.assertEqual(rows(self.sample([(100, "make", 0), (200, "cc1plus", 60)])), 0)
+
+    def test_loopback(self):
+        aggregator = Aggregator("127.0.0.1:0", 1.0)
+        aggregator.serve()
+        address = f"127.0.0.1:{aggregator.server.server_address[1]}"
+        agents = [AgentStream(address, name=f"host{i}") for i in range(3)]
+        try:
+            for i, agent in enumerate(agents):
+                agent(self.sample([(100, "make", 0)]))
+                # only the latest sample is sent
+                agent(self.sample([(100, "make", 10 * i), (200 + i, "cc1plus", 50 + i)]))
+                self.assertEqual(agent.skipped, 1)
+                agent.start()
+            self.wait(lambda: len(aggregator.hosts) == 3 and all(host.latest for host in aggregator.hosts.values()))
+
+            sample = aggregator.sample()
+            self.assertEqual([(stat.tcomm, window[-1]) for stat, window in sample.cpu[:4]],
+                             [("cc1plus@host2", 52), ("cc1plus@host1", 51), ("cc1plus@host0", 50), ("make@host2", 20)])
+            self.assertEqual(sample.cpu[0][0].cmdline, "/usr/bin/cc1plus")
+            self.assertEqual(sample.net[0][1][-1], 52000)
+
+            # host0's make died, its cc1plus isn't ranked anymore
+            agents[0](self.sample([(100, "make", 30)], dead={100}))
+            host = aggregator.hosts["host0"]
+            self.wait(lambda: len(host.latest[1]) == 1 and len(host.labels) == 1)
+            sample = aggregator.sample()
+            make, window = next((stat, window) for stat, window in sample.cpu if stat.tcomm == "make@host0")
+            self.assertFalse(make.alive)
+            self.assertEqual(window[-2:], [0, 30])
+            # the other hosts sent nothing new, their last usages are kept for a late cycle
+            self.assertEqual(sample.cpu[0][1][-2:], [52, 52])
+
+            # unchanged usages aren't sent again, the aggregator keeps them
+            host = aggregator.hosts["host1"]
+            cycle = host.latest[0]
+            agents[1](self.sample([(100, "make", 10), (201, "cc1plus", 51)]))
+            self.wait(lambda: host.latest[0] != cycle)
+            self.assertEqual(sorted(usage[0] for usage in host.latest[1].values()), [10, 51])
+        finally:
+            for agent in agents:
+                agent.stop()
+            aggregator.close()
+
+
+class TestBurstSampler(unittest.TestCase):
+    def test_burst(self):
+        busy = subprocess.Popen([sys.executable, "-c", "while True: pass"])
+        try:
+            table = ProcTable()
+            table.append(busy.pid, "python3")
+            stats = Usages(table, [0], [100.0], [0], [0], [0])
+            stat = stats.view(0)
+
+            bursts = BurstSampler(1.0, 60, interval=0.05, duration=0.3, cpu=50, io=0)
+            bursts.trigger(stats, [stat], [])
+            self.assertIn(stat.key, bursts.bursts)
+            bursts.run_until(time.monotonic() + 0.5)
+            # the burst is over, the rest was slept
+            self.assertEqual(bursts.bursts, {})
+
+            sample = Sample(time=time.time(), cpu=[(stat, [100.0])], mem=[], net=[], io=[],
+                            alive_pids=defaultdict(lambda: False))
+            points = bursts.detail(sample)["cpu"][stat.key]
+            self.assertGreaterEqual(len(points), 4)
+            self.assertGreater(max(usage for _, usage in points), 20)
+
+            # still busy, no new burst until it was below the threshold
+            bursts.trigger(stats, [stat], [])
+            self.assertEqual(bursts.bursts, {})
+            bursts.trigger(stats, [], [])
+            bursts.trigger(stats, [stat], [])
+            self.assertIn(stat.key, bursts.bursts)
+        finally:
+            busy.kill()
+            busy.wait()
+
+    def test_member_exits(self):
+        busy = [subprocess.Popen([sys.executable, "-c", "while True: pass"]) for _ in range(2)]
+        try:
+            table = ProcTable()
+            for process in busy:
+                table.append(process.pid, "python3")
+            stats = Usages(table, [0, 1], [100.0, 100.0], [0, 0], [0, 0], [0, 0],
+                           names=["python3 (2)"], keys=["python3"], column="tcomm")
+            stat = stats.view(0)
+
+            bursts = BurstSampler(1.0, 60, interval=0.05, duration=10, cpu=50, io=0)
+            bursts.trigger(stats, [stat], [])
+            bursts.tick()
+            busy[0].kill()
+            busy[0].wait()
+            bursts.tick()
+            cpu_points, _ = bursts.points["python3"]
+            self.assertEqual(len(cpu_points), 2)
+            self.assertTrue(all(usage >= 0 for _, usage in cpu_points))
+        finally:
+            for process in busy:
+                process.kill()
+                process.wait()
+
+
+class TestThreads(unittest.TestCase):
+    def test_collect_threads(self):
+        waiting = threading.Event()
+        thread = threading.Thread(target=waiting.wait)
+        thread.start()
+
+        page_size, healthy.PAGE_SIZE = healthy.PAGE_SIZE, 4096
+        samples = []
+        collector = healthy.PIDStatsCollector(0.1, consumers=[samples.append], pid=os.getpid())
+        collector.start()
+        try:
+            deadline = time.monotonic() + 5
+            while len(samples) < 2 and time.monotonic() < deadline:
+                time.sleep(0.05)
+        finally:
+            collector.stop()
+            collector.bg_thread.join()
+            waiting.set()
+            thread.join()
+            healthy.PAGE_SIZE = page_size
+
+        tids = [tid for tid, alive in samples[-1].alive_pids.items() if alive]
+        self.assertIn(os.getpid(), tids)
+        self.assertIn(thread.native_id, tids)
+        self.assertIn(collector.bg_thread.native_id, tids)
+
+
+class TestProfiler(unittest.TestCase):
+    def test_report(self):
+        profiler = Profiler(num_cycles=2)
+        for _ in range(3):
+            profiler.start(0.002)
+            profiler.lap("scan")
+            profiler.finish()
+            # the ui draws after the cycle is over
+            profiler.add("ui", 5)
+
+        self.assertEqual(len(profiler.cycles), 2)
+        self.assertEqual(profiler.cycles[-1]["late"], 2)
+        self.assertEqual(profiler.cycles[-1]["ui"], 5)
+        report = profiler.report()
+        self.assertIn("scan ms", report)
+        self.assertIn("open fds", report)
+
+
+class TestHistoryFile(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "state", "history")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def sample(self, t, cpu):
+        return Sample(time=t, cpu=[(FakePIDStat(pid, name), [usage]) for pid, name, usage in cpu],
+                      mem=[], net=[], io=[], alive_pids=defaultdict(lambda: False))
+
+    def test_tiers(self):
+        history = HistoryFile(self.path, top_k=2, tiers=((1, 10), (5, 4)))
+        for t in range(1000, 1011):
+            history(self.sample(t, [(1, "init", 10), (2, "cc1plus", 20 if t < 1005 else 0), (3, "sh", 1)]))
+
+        seconds = history.read(0, "cpu", now=1010)
+        self.assertEqual([start for start, _ in seconds], list(range(1000, 1010)))
+        self.assertEqual(seconds[-1][1], [(1, "init", 10, 10), (3, "sh", 1, 1)])
+
+        buckets = history.read(1, "cpu", now=1010)
+        self.assertEqual([start for start, _ in buckets], [1000, 1005])
+        self.assertEqual(buckets[0][1], [(2, "cc1plus", 20, 20), (1, "init", 10, 10)])
+
+        top = history.top(1, "cpu", 3, now=1010)
+        self.assertEqual([(stat.pid, window) for stat, window in top],
+                         [(2, [0, 0, 20, 0]), (1, [0, 0, 10, 10]), (3, [0, 0, 0, 1])])
+        history.close()
+
+    def test_reopen(self):
+        history = HistoryFile(self.path, top_k=2, tiers=((1, 10),))
+        history(self.sample(1000, [(1, "init", 10)]))
+        history(self.sample(1001, [(1, "init", 12)]))
+        history.close()
+
+        reopened = HistoryFile(self.path, top_k=2, tiers=((1, 10),))
+        self.assertEqual(reopened.read(0, "cpu", now=1001), [(1000, [(1, "init", 10, 10)])])
+        reopened.close()
+
+        # different settings start over
+        other = HistoryFile(self.path, top_k=3, tiers=((1, 10),))
+        self.assertEqual(other.read(0, "cpu", now=1001), [])
+        other.close()
+
+
 if __name__ == '__main__':
     unittest.main()